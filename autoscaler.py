@@ -0,0 +1,411 @@
+"""
+Run this node's Celery workers as pools that grow and shrink with the work queued for them.
+
+Pools (solo workers, one task each):
+  download     every lane of the node queue: scan_playlist, prefetch and sync, which also
+               runs the transcode, so it is gated on CPU as well as on link bandwidth
+  reserved     a fixed YTDL_RESERVED_WORKERS taking only the interactive and first-sync
+               lanes, so a user's request never waits behind the download backlog
+  maintenance  the default queue's lanes: scan dispatch, GC, dedup, backfills
+
+Every --interval seconds the autoscaler reads each pool's backlog (broker queue depth,
+plus the fair-share work queue for downloads), how long the oldest download has waited,
+the load average per core and the receive rate from /proc/net/dev. A pool grows by one
+worker when its backlog or wait is high and the host has headroom, and shrinks by one
+when it has been idle for a while or the CPU is saturated. Changes are rate-limited by
+separate up/down cooldowns. The download pool's size is published as the node's sync
+slots, so the scheduler hands out as much work as there are workers to run it.
+
+Workers are stopped with SIGTERM only (Celery's warm shutdown): a draining worker takes
+no new tasks and exits once its current download finishes; an idle one is picked first.
+Stopping the autoscaler drains every worker, then marks the node inactive.
+
+Usage: python autoscaler.py [--interval 15] [--dry-run]
+Bounds: YTDL_DOWNLOAD_WORKERS_MIN/MAX, YTDL_MAINTENANCE_WORKERS_MIN/MAX
+"""
+import argparse
+import asyncio
+import json
+import logging
+import logging.config
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import aiosqlite
+import yaml
+
+from celery_app import DB_PATH, NODE_NAME, celery, dispatch
+import lanes
+import sharding
+
+logger = logging.getLogger("dev")
+
+INTERVAL = float(os.getenv("YTDL_AUTOSCALE_INTERVAL", "15"))
+# Grow when a pool has more than this many queued tasks per worker...
+BACKLOG_PER_WORKER = int(os.getenv("YTDL_AUTOSCALE_BACKLOG_PER_WORKER", "2"))
+# ...or its oldest queued download has waited this long (seconds)
+MAX_WAIT = int(os.getenv("YTDL_AUTOSCALE_MAX_WAIT", "120"))
+# Load average per core above which CPU-bound pools stop growing, and above which they shrink
+CPU_HIGH = float(os.getenv("YTDL_AUTOSCALE_CPU_HIGH", "0.85"))
+CPU_CRITICAL = float(os.getenv("YTDL_AUTOSCALE_CPU_CRITICAL", "1.25"))
+# Downlink capacity in bytes/s (0: unknown, bandwidth does not gate growth)...
+LINK_BYTES_PER_SEC = float(os.getenv("YTDL_LINK_BYTES_PER_SEC", "0"))
+# ...and the share of it above which download pools stop growing
+BANDWIDTH_HIGH = float(os.getenv("YTDL_AUTOSCALE_BANDWIDTH_HIGH", "0.85"))
+# Interface to measure (unset: every interface but loopback)
+INTERFACE = os.getenv("YTDL_AUTOSCALE_IFACE")
+# Minimum seconds between two changes of the same pool, growing and shrinking
+UP_COOLDOWN = int(os.getenv("YTDL_AUTOSCALE_UP_COOLDOWN", "60"))
+DOWN_COOLDOWN = int(os.getenv("YTDL_AUTOSCALE_DOWN_COOLDOWN", "300"))
+# A pool shrinks only after its backlog has been empty this long
+IDLE_BEFORE_SHRINK = int(os.getenv("YTDL_AUTOSCALE_IDLE", "300"))
+
+
+@dataclass
+class PoolSpec:
+	name: str
+	queues: list[str]
+	min_workers: int
+	max_workers: int
+	# Counts the node's fair-share work queue as backlog and publishes its size as sync slots
+	scheduled: bool = False
+	cpu_bound: bool = False
+	uses_bandwidth: bool = False
+	env: dict = field(default_factory=dict)
+
+
+def default_pools(node: str) -> list[PoolSpec]:
+	return [
+		PoolSpec(
+			"download",
+			# The bare node queue holds tasks sent before there were lanes
+			[*lanes.queues(node), sharding.node_queue(node)],
+			int(os.getenv("YTDL_DOWNLOAD_WORKERS_MIN", "1")),
+			int(os.getenv("YTDL_DOWNLOAD_WORKERS_MAX", "4")),
+			scheduled=True,
+			cpu_bound=True,
+			uses_bandwidth=True,
+			env={"YTDL_NODE_QUEUE": "0"},
+		),
+		PoolSpec(
+			"reserved",
+			[q for lane in lanes.RESERVED_LANES for q in (lanes.queue(lane, node), lanes.queue(lane))],
+			lanes.RESERVED_WORKERS,
+			lanes.RESERVED_WORKERS,
+			env={"YTDL_NODE_QUEUE": "0"},
+		),
+		PoolSpec(
+			"maintenance",
+			lanes.queues(None),
+			int(os.getenv("YTDL_MAINTENANCE_WORKERS_MIN", "1")),
+			int(os.getenv("YTDL_MAINTENANCE_WORKERS_MAX", "2")),
+			env={"YTDL_NODE_QUEUE": "0"},
+		),
+	]
+
+
+class ScalingPolicy:
+	"""
+	Decides each pool's next size from its signals. One step per decision, bounded by the
+	pool's min/max, with separate cooldowns for growing and shrinking.
+	"""
+
+	def __init__(self, pools: list[PoolSpec], clock=time.monotonic):
+		self.pools = {pool.name: pool for pool in pools}
+		self._clock = clock
+		self._last_change: dict[str, float] = {}
+		self._last_busy: dict[str, float] = {}
+
+	def decide(self, name: str, size: int, signals: dict) -> tuple[int, str]:
+		"""
+		signals: backlog (tasks), wait (seconds), cpu (load per core), bandwidth (share of
+		the link in use, or None). Returns (target size, reason).
+		"""
+		pool = self.pools[name]
+		now = self._clock()
+		self._last_busy.setdefault(name, now)
+		if signals["backlog"]:
+			self._last_busy[name] = now
+		# Bounds apply at once and do not start a cooldown
+		if size < pool.min_workers:
+			return pool.min_workers, "below_min"
+		if size > pool.max_workers:
+			return pool.max_workers, "above_max"
+
+		bandwidth = signals.get("bandwidth")
+		if pool.cpu_bound and signals["cpu"] >= CPU_CRITICAL and size > pool.min_workers:
+			target, reason = size - 1, "cpu_saturated"
+		elif signals["backlog"] > size * BACKLOG_PER_WORKER or signals.get("wait", 0) >= MAX_WAIT:
+			if size >= pool.max_workers:
+				return size, "at_max"
+			if pool.cpu_bound and signals["cpu"] >= CPU_HIGH:
+				return size, "cpu_high"
+			if pool.uses_bandwidth and bandwidth is not None and bandwidth >= BANDWIDTH_HIGH:
+				return size, "bandwidth_high"
+			target, reason = size + 1, "backlog"
+		elif not signals["backlog"] and size > pool.min_workers and now - self._last_busy[name] >= IDLE_BEFORE_SHRINK:
+			target, reason = size - 1, "idle"
+		else:
+			return size, "steady"
+
+		cooldown = UP_COOLDOWN if target > size else DOWN_COOLDOWN
+		if now - self._last_change.get(name, float("-inf")) < cooldown:
+			return size, "cooldown"
+		self._last_change[name] = now
+		return target, reason
+
+
+class NetRate:
+	"""
+	Receive rate from /proc/net/dev between successive calls.
+	"""
+
+	def __init__(self, interface: str | None = INTERFACE, clock=time.monotonic):
+		self.interface = interface
+		self._clock = clock
+		self._last: tuple[float, int] | None = None
+
+	def _rx_bytes(self) -> int | None:
+		try:
+			lines = Path("/proc/net/dev").read_text().splitlines()[2:]
+		except OSError:
+			return None
+		total = 0
+		for line in lines:
+			name, _, data = line.partition(":")
+			name = name.strip()
+			if (self.interface and name != self.interface) or (not self.interface and name == "lo"):
+				continue
+			total += int(data.split()[0])
+		return total
+
+	def rate(self) -> float | None:
+		rx = self._rx_bytes()
+		if rx is None:
+			return None
+		now = self._clock()
+		last, self._last = self._last, (now, rx)
+		if last is None or now <= last[0]:
+			return None
+		return max(rx - last[1], 0) / (now - last[0])
+
+
+def broker_depth(queue: str) -> int:
+	"""
+	Messages waiting in a broker queue (LLEN on Redis), 0 if the queue does not exist yet.
+	"""
+	try:
+		with celery.connection_for_read() as conn:
+			return conn.default_channel.queue_declare(queue=queue, passive=True).message_count
+	except Exception:
+		return 0
+
+
+def scheduler_backlog(node: str) -> tuple[int, float]:
+	"""
+	Queued, dispatchable fair-share items for the node and the age of the oldest.
+	"""
+	now = int(time.time())
+	with closing(sqlite3.connect(DB_PATH, timeout=30)) as conn, conn:
+		count, oldest = conn.execute(
+			"""
+			SELECT COUNT(*), MIN(created_at) FROM work_queue
+			WHERE state = 'queued' AND node IS ? AND (not_before IS NULL OR not_before <= ?)
+			""",
+			(node, now),
+		).fetchone()
+	return count, (now - oldest) if oldest else 0.0
+
+
+def cpu_load() -> float:
+	return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+@dataclass
+class Worker:
+	hostname: str
+	process: subprocess.Popen
+	started_at: float
+
+
+class WorkerPool:
+	"""
+	The running workers of one pool. Draining workers were sent SIGTERM and no longer
+	count towards the pool's size; they are reaped once their current task is done.
+	"""
+
+	def __init__(self, spec: PoolSpec, node: str):
+		self.spec = spec
+		self.node = node
+		self.active: list[Worker] = []
+		self.draining: list[Worker] = []
+		self._serial = 0
+
+	def spawn(self):
+		self._serial += 1
+		hostname = f"{self.spec.name}{self._serial}.{self.node}@{socket.gethostname()}"
+		env = {**os.environ, **self.spec.env, "YTDL_NODE": self.node, "YTDL_SCALED_WORKER": "1"}
+		process = subprocess.Popen(
+			[
+				sys.executable, "-m", "celery", "-A", "celery_app", "worker", "--loglevel=info",
+				"--pool=solo", "-Q", ",".join(self.spec.queues), "-n", hostname,
+			],
+			env=env,
+			cwd=Path(__file__).parent,
+		)
+		self.active.append(Worker(hostname, process, time.monotonic()))
+		logger.info("Autoscaler started %s (pid %d)", hostname, process.pid)
+
+	def busy_hostnames(self) -> set[str] | None:
+		try:
+			replies = celery.control.inspect(destination=[w.hostname for w in self.active], timeout=1.0).active()
+		except Exception:
+			return None
+		if replies is None:
+			return None
+		return {hostname for hostname, tasks in replies.items() if tasks}
+
+	def drain_one(self):
+		busy = self.busy_hostnames()
+		idle = [w for w in self.active if busy is not None and w.hostname not in busy]
+		# An idle worker exits at once; otherwise the newest finishes its task first
+		worker = (idle or sorted(self.active, key=lambda w: w.started_at))[-1]
+		self.active.remove(worker)
+		self.draining.append(worker)
+		worker.process.send_signal(signal.SIGTERM)
+		logger.info("Autoscaler draining %s (%s)", worker.hostname, "idle" if worker in idle else "busy")
+
+	def scale_to(self, size: int):
+		while len(self.active) < size:
+			self.spawn()
+		while len(self.active) > size:
+			self.drain_one()
+
+	def reap(self):
+		for worker in list(self.draining):
+			if worker.process.poll() is not None:
+				self.draining.remove(worker)
+				logger.info("Autoscaler: %s drained", worker.hostname)
+		for worker in list(self.active):
+			if worker.process.poll() is not None:
+				# Crashed; the next tick restores the pool's minimum
+				self.active.remove(worker)
+				logger.warning("Autoscaler: %s exited with %s", worker.hostname, worker.process.returncode)
+
+
+def ensure_node_columns():
+	with closing(sqlite3.connect(DB_PATH, timeout=30)) as conn, conn:
+		columns = {row[1] for row in conn.execute("PRAGMA table_info(node)")}
+		for column, definition in sharding.NODE_CAPACITY_COLUMNS:
+			if columns and column not in columns:
+				conn.execute(f"ALTER TABLE node ADD COLUMN {column} {definition}")
+
+
+def publish_capacity(node: str, slots: int | None, workers: dict):
+	with closing(sqlite3.connect(DB_PATH, timeout=30)) as conn, conn:
+		conn.execute(
+			"UPDATE node SET slots = ?, workers = ? WHERE name = ?",
+			(slots, json.dumps(workers) if workers else None, node),
+		)
+
+
+async def deactivate_node():
+	# The workers leave the node registered; it leaves the ring only when the whole pool stops
+	async with aiosqlite.connect(DB_PATH) as db:
+		await sharding.set_node_active(db, NODE_NAME, False)
+
+
+def collect_signals(pools: dict[str, WorkerPool], net: NetRate) -> dict:
+	rate = net.rate()
+	common = {
+		"cpu": cpu_load(),
+		"bandwidth": rate / LINK_BYTES_PER_SEC if rate is not None and LINK_BYTES_PER_SEC > 0 else None,
+		"rx_bytes_per_sec": rate,
+	}
+	signals = {}
+	for name, pool in pools.items():
+		backlog = sum(broker_depth(queue) for queue in pool.spec.queues)
+		wait = 0.0
+		if pool.spec.scheduled:
+			queued, wait = scheduler_backlog(pool.node)
+			backlog += queued
+		signals[name] = {**common, "backlog": backlog, "wait": wait}
+	return signals
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--interval", type=float, default=INTERVAL)
+	parser.add_argument("--dry-run", action="store_true", help="print decisions without starting or stopping workers")
+	args = parser.parse_args()
+	with open(Path(__file__).parent / "logger_config.yaml") as f:
+		logging.config.dictConfig(yaml.safe_load(f))
+
+	specs = default_pools(NODE_NAME)
+	policy = ScalingPolicy(specs)
+	pools = {spec.name: WorkerPool(spec, NODE_NAME) for spec in specs}
+	net = NetRate()
+	ensure_node_columns()
+
+	stopping = False
+
+	def stop(signum, frame):
+		nonlocal stopping
+		stopping = True
+
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+
+	try:
+		while not stopping:
+			for pool in pools.values():
+				pool.reap()
+			signals = collect_signals(pools, net)
+			sizes = {}
+			for name, pool in pools.items():
+				size = len(pool.active)
+				target, reason = policy.decide(name, size, signals[name])
+				if target != size or args.dry_run:
+					logger.info(
+						"Autoscaler %s: %d -> %d (%s; backlog=%d wait=%.0fs cpu=%.2f bandwidth=%s)",
+						name, size, target, reason, signals[name]["backlog"], signals[name]["wait"],
+						signals[name]["cpu"], signals[name]["bandwidth"],
+					)
+				if not args.dry_run:
+					pool.scale_to(target)
+				sizes[name] = target
+
+			if not args.dry_run:
+				slots = sum(sizes[name] for name, pool in pools.items() if pool.spec.scheduled)
+				publish_capacity(NODE_NAME, slots or None, sizes)
+				# Raised slots only take effect when something claims
+				dispatch()
+			deadline = time.monotonic() + args.interval
+			while not stopping and time.monotonic() < deadline:
+				time.sleep(0.5)
+	finally:
+		if not args.dry_run:
+			logger.info("Autoscaler stopping, draining all workers")
+			for pool in pools.values():
+				for worker in pool.active:
+					worker.process.send_signal(signal.SIGTERM)
+				pool.draining += pool.active
+				pool.active = []
+			# Never SIGKILL: in-flight downloads finish first
+			for pool in pools.values():
+				for worker in pool.draining:
+					worker.process.wait()
+			publish_capacity(NODE_NAME, None, {})
+			asyncio.run(deactivate_node())
+
+
+if __name__ == "__main__":
+	main()
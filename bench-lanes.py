@@ -0,0 +1,117 @@
+"""
+Measure how long interactive tasks wait behind a full download backlog.
+
+Runs in-process Celery workers for one node the way startup does: a main worker on every
+lane of the node queue and, unless --no-reserved, a reserved worker on the interactive
+and first-sync lanes only. Fills the bulk-download lane with --bulk tasks of
+--bulk-seconds each, then sends --interactive short tasks at --interval, and prints each
+lane's queue wait (publish to start, from the same headers lane_wait is fed from) and
+how long the run took.
+
+The default in-memory broker has no priorities, so it shows what the reserved worker
+buys; pass --broker redis://... to see the lane priorities as well.
+
+Usage: python bench-lanes.py [--bulk 40] [--bulk-seconds 0.5] [--interactive 10]
+                             [--interval 0.5] [--no-reserved] [--broker memory://]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent
+NODE = "bench"
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--bulk", type=int, default=40)
+	parser.add_argument("--bulk-seconds", type=float, default=0.5)
+	parser.add_argument("--interactive", type=int, default=10)
+	parser.add_argument("--interval", type=float, default=0.5)
+	parser.add_argument("--no-reserved", action="store_true")
+	parser.add_argument("--broker", default="memory://")
+	args = parser.parse_args()
+
+	tmp = Path(tempfile.mkdtemp(prefix="ytdl-bench-lanes-"))
+	os.environ.update({
+		"DB_PATH": str(tmp / "database.db"),
+		"DATA_ROOT_PATH": str(tmp / "data"),
+		"CELERY_BROKER_URL": args.broker,
+		"CELERY_RESULT_BACKEND": "cache+memory://",
+		"YTDL_NODE": NODE,
+	})
+	shutil.copy(REPO / "logger_config.yaml", tmp / "logger_config.yaml")
+	os.chdir(tmp)
+	sys.path.insert(0, str(REPO))
+
+	import aiosqlite
+	from celery.contrib.testing.worker import start_worker
+	from celery.signals import task_prerun
+
+	import celery_app
+	import lanes
+	from writebehind import percentile
+
+	async def init():
+		async with aiosqlite.connect(os.environ["DB_PATH"]) as db:
+			await lanes.init_lanes(db)
+			await db.commit()
+
+	asyncio.run(init())
+	app = celery_app.celery
+	# The in-memory transport polls; keep that out of the measured waits
+	app.conf.broker_transport_options = {**app.conf.broker_transport_options, "polling_interval": 0.01}
+
+	@app.task(name="bench_lanes.work")
+	def work(seconds: float) -> float:
+		time.sleep(seconds)
+		return seconds
+
+	waits: dict[str, list[float]] = {lane: [] for lane in lanes.LANES}
+	lock = threading.Lock()
+
+	@task_prerun.connect(weak=False)
+	def sample(task=None, **kwargs):
+		published_at, lane = task.request.get("ytdl_published_at"), task.request.get("ytdl_lane")
+		if published_at and lane:
+			with lock:
+				waits[lane].append(time.time() - published_at)
+
+	started = time.monotonic()
+	with ExitStack() as stack:
+		stack.enter_context(start_worker(
+			app, pool="solo", perform_ping_check=False, queues=lanes.queues(NODE), hostname=f"main@{NODE}",
+		))
+		if not args.no_reserved:
+			stack.enter_context(start_worker(
+				app, pool="solo", perform_ping_check=False,
+				queues=lanes.queues(NODE, lanes.RESERVED_LANES), hostname=f"reserved@{NODE}",
+			))
+		results = [work.apply_async((args.bulk_seconds,), **lanes.route("bulk_download", NODE)) for _ in range(args.bulk)]
+		for _ in range(args.interactive):
+			time.sleep(args.interval)
+			results.append(work.apply_async((0.01,), **lanes.route("interactive", NODE)))
+		for result in results:
+			result.get(timeout=args.bulk * args.bulk_seconds + 60)
+	elapsed = time.monotonic() - started
+	celery_app.db_buffer.flush()
+
+	print(f"{args.bulk} bulk tasks of {args.bulk_seconds}s, {args.interactive} interactive, "
+		f"{'no reserved worker' if args.no_reserved else 'reserved worker'}, broker {args.broker}\n")
+	print(f"  {'lane':<15} {'tasks':>6} {'p50 s':>8} {'p95 s':>8} {'max s':>8}")
+	for lane, samples in waits.items():
+		if samples:
+			print(f"  {lane:<15} {len(samples):>6} {percentile(samples, 50):>8.2f} {percentile(samples, 95):>8.2f} {max(samples):>8.2f}")
+	print(f"\nDone in {elapsed:.1f}s")
+	shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
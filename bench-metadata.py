@@ -0,0 +1,167 @@
+"""
+Compare per-item .info.json files with the per-playlist metadata pack.
+
+Generates a playlist folder of synthetic items whose info.json carries what yt-dlp
+writes for a YouTube video (format list with signed URLs, thumbnails, automatic
+captions, description), next to small stand-in media files. Then measures disk usage,
+the directory glob sync/validate do, and random reads by video ID, first for the
+info.json layout and again after packing it with metapack.pack_info_files.
+
+Usage: python bench-metadata.py [--items 2000] [--reads 2000] [--formats 25]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import time
+from pathlib import Path
+
+import metapack
+from writebehind import percentile
+
+LANGUAGES = ("en", "de", "fr", "es", "ja", "pt", "ru", "ko", "it", "nl")
+
+
+def random_text(rng: random.Random, words: int) -> str:
+	return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(words))
+
+
+def signed_url(rng: random.Random, video_id: str, itag: int) -> str:
+	token = "".join(rng.choices(string.ascii_letters + string.digits + "_-", k=180))
+	return (
+		f"https://rr3---sn-abcdef.googlevideo.com/videoplayback?expire=1790000000&ei={token[:20]}"
+		f"&ip=203.0.113.7&id=o-{video_id}&itag={itag}&source=youtube&requiressl=yes&sig={token}"
+	)
+
+
+def synthetic_info(rng: random.Random, index: int, formats: int) -> dict:
+	video_id = "".join(rng.choices(string.ascii_letters + string.digits + "_-", k=11))
+	return {
+		"id": video_id,
+		"title": f"Track {index} {random_text(rng, 4)}",
+		"fulltitle": f"Track {index}",
+		"description": random_text(rng, rng.randint(20, 300)),
+		"uploader": random_text(rng, 2),
+		"channel_id": "UC" + video_id * 2,
+		"duration": rng.randint(120, 600),
+		"upload_date": "20240101",
+		"view_count": rng.randint(0, 10**7),
+		"tags": random_text(rng, 15).split(),
+		"webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+		"playlist_id": "PLbench",
+		"playlist_index": index,
+		"format_id": "251",
+		"ext": "mp3",
+		"acodec": "opus",
+		"formats": [
+			{
+				"format_id": str(100 + i),
+				"url": signed_url(rng, video_id, 100 + i),
+				"ext": rng.choice(("webm", "m4a", "mp4")),
+				"tbr": rng.random() * 3000,
+				"filesize": rng.randint(10**6, 10**8),
+				"http_headers": {"User-Agent": "Mozilla/5.0 " + random_text(rng, 6), "Accept": "*/*"},
+				"downloader_options": {"http_chunk_size": 10485760},
+			}
+			for i in range(formats)
+		],
+		"thumbnails": [
+			{"url": f"https://i.ytimg.com/vi/{video_id}/{i}.jpg", "preference": -i, "id": str(i)}
+			for i in range(40)
+		],
+		"automatic_captions": {
+			lang: [{"ext": ext, "url": signed_url(rng, video_id, 0) + f"&lang={lang}&fmt={ext}"} for ext in ("json3", "srv1", "vtt")]
+			for lang in LANGUAGES
+		},
+	}
+
+
+def disk_usage(paths: list[Path]) -> int:
+	return sum(path.stat().st_blocks * 512 for path in paths)
+
+
+def timed_glob(folder: Path, pattern: str, repeats: int = 20) -> float:
+	started = time.perf_counter()
+	for _ in range(repeats):
+		list(folder.glob(pattern))
+	return (time.perf_counter() - started) / repeats
+
+
+def read_latencies(read, video_ids: list[str], reads: int, rng: random.Random) -> list[float]:
+	latencies = []
+	for _ in range(reads):
+		video_id = rng.choice(video_ids)
+		started = time.perf_counter()
+		record = read(video_id)
+		latencies.append(time.perf_counter() - started)
+		assert record and record["id"] == video_id
+	return latencies
+
+
+def report(name: str, size: int, glob_seconds: float, latencies: list[float]) -> None:
+	print(
+		f"  {name:<10} {size / 1024**2:>9.2f} {glob_seconds * 1000:>9.2f} "
+		f"{percentile(latencies, 50) * 1e6:>9.0f} {percentile(latencies, 95) * 1e6:>9.0f} "
+		f"{percentile(latencies, 99) * 1e6:>9.0f}"
+	)
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--items", type=int, default=2000)
+	parser.add_argument("--reads", type=int, default=2000)
+	parser.add_argument("--formats", type=int, default=25, help="format entries per info.json")
+	parser.add_argument("--seed", type=int, default=1)
+	args = parser.parse_args()
+	rng = random.Random(args.seed)
+
+	work = Path(tempfile.mkdtemp(prefix="ytdl-bench-metadata-"))
+	try:
+		folder = work / "playlist"
+		folder.mkdir()
+		info_paths: dict[str, Path] = {}
+		for index in range(args.items):
+			info = synthetic_info(rng, index, args.formats)
+			stem = f"{info['title']} [{info['id']}]"
+			(folder / f"{stem}.mp3").write_bytes(b"\0" * 1024)
+			info_paths[info["id"]] = folder / f"{stem}.info.json"
+			info_paths[info["id"]].write_text(json.dumps(info))
+		video_ids = list(info_paths)
+		print(f"{args.items} items, {args.reads} random reads\n")
+		print(f"  {'layout':<10} {'size MiB':>9} {'glob ms':>9} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9}")
+
+		# The old layout has no index: finding an item by ID means matching file names
+		def read_info(video_id: str) -> dict:
+			matches = [p for p in os.scandir(folder) if p.name.endswith(f"[{video_id}].info.json")]
+			return json.loads(Path(matches[0].path).read_text())
+
+		def read_known(video_id: str) -> dict:
+			return json.loads(info_paths[video_id].read_text())
+
+		info_size = disk_usage(list(info_paths.values()))
+		glob_before = timed_glob(folder, "*.mp3")
+		report("info.json", info_size, glob_before, read_latencies(read_info, video_ids, min(args.reads, 200), rng))
+		report("(by path)", info_size, glob_before, read_latencies(read_known, video_ids, args.reads, rng))
+
+		started = time.perf_counter()
+		result = metapack.pack_info_files(folder, list(info_paths.values()))
+		pack_seconds = time.perf_counter() - started
+
+		pack_size = disk_usage([metapack.pack_path(folder)])
+		report("pack", pack_size, timed_glob(folder, "*.mp3"), read_latencies(
+			lambda video_id: metapack.read(folder, video_id), video_ids, args.reads, rng,
+		))
+		print(
+			f"\nPacked {result['files']} files in {pack_seconds:.2f}s; "
+			f"{info_size / max(pack_size, 1):.1f}x smaller on disk; "
+			f"{len(os.listdir(folder))} directory entries left (was {2 * args.items})"
+		)
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
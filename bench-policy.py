@@ -0,0 +1,97 @@
+"""
+Compare CPU seconds per item across download policies.
+
+Generates synthetic source files in the formats YouTube serves (opus in webm, aac in m4a),
+then runs the exact postprocessor chain that get_ydl_opts builds for each policy and
+measures the CPU time spent in ffmpeg/ffprobe child processes.
+
+Usage: python bench-policy.py [--seconds 240] [--items 3]
+"""
+import argparse
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from yt_dlp import YoutubeDL
+
+from helpers import get_ydl_opts
+
+SOURCES = {
+	"webm": ["-c:a", "libopus", "-b:a", "128k"],
+	"m4a": ["-c:a", "aac", "-b:a", "128k"],
+}
+
+POLICIES = {
+	"mp3": {"format": "mp3"},
+	"passthrough": {"format": "passthrough"},
+	"passthrough-notags": {"format": "passthrough", "write_metadata": False},
+}
+
+
+def make_source(path: Path, seconds: int, codec_args: list[str]) -> None:
+	subprocess.run(
+		["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+		 "-ac", "2", *codec_args, str(path)],
+		check=True,
+	)
+
+
+def children_cpu() -> float:
+	usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return usage.ru_utime + usage.ru_stime
+
+
+def run_policy(work_dir: Path, source: Path, policy: dict, items: int) -> tuple[float, float]:
+	"""
+	Run the policy's postprocessors over `items` copies of source; returns (cpu, wall) per item.
+	"""
+	opts = get_ydl_opts(work_dir, playlist_folder=False, policy=policy)
+	opts["quiet"] = True
+	cpu_total = wall_total = 0.0
+	with YoutubeDL(opts) as ydl:
+		for i in range(items):
+			item = work_dir / f"item{i}.{source.suffix.lstrip('.')}"
+			shutil.copy(source, item)
+			info = {
+				"id": f"bench{i:06d}",
+				"title": f"Bench {i}",
+				"uploader": "bench",
+				"playlist_id": "PLbench",
+				"ext": item.suffix.lstrip("."),
+				"filepath": str(item),
+			}
+			cpu_start, wall_start = children_cpu(), time.perf_counter()
+			info = ydl.run_all_pps("pre_process", info)
+			info = ydl.post_process(str(item), info)
+			cpu_total += children_cpu() - cpu_start
+			wall_total += time.perf_counter() - wall_start
+	return cpu_total / items, wall_total / items
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--seconds", type=int, default=240, help="duration of each synthetic track")
+	parser.add_argument("--items", type=int, default=3, help="items per policy/source pair")
+	args = parser.parse_args()
+
+	if not shutil.which("ffmpeg"):
+		raise SystemExit("ffmpeg not found")
+
+	with tempfile.TemporaryDirectory(prefix="bench-policy-") as tmp:
+		tmp = Path(tmp)
+		print(f"{'source':<6} {'policy':<20} {'cpu s/item':>10} {'wall s/item':>11}")
+		for ext, codec_args in SOURCES.items():
+			source = tmp / f"source.{ext}"
+			make_source(source, args.seconds, codec_args)
+			for name, policy in POLICIES.items():
+				work_dir = tmp / f"{ext}-{name}"
+				work_dir.mkdir()
+				cpu, wall = run_policy(work_dir, source, policy, args.items)
+				print(f"{ext:<6} {name:<20} {cpu:>10.3f} {wall:>11.3f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,370 @@
+import json
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Iterator
+
+import aiosqlite
+
+logger = logging.getLogger("dev")
+
+# One row per video, one membership row per (video, owner, playlist), per-item sync
+# state, and an external-content FTS5 index over catalog(title, uploader) kept in sync by triggers.
+CATALOG_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS catalog (
+		video_id TEXT PRIMARY KEY,
+		title TEXT,
+		uploader TEXT,
+		duration REAL,
+		updated_at INTEGER NOT NULL
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS catalog_membership (
+		video_id TEXT NOT NULL,
+		owner TEXT NOT NULL,
+		playlist_id TEXT NOT NULL,
+		file_path TEXT,
+		file_size INTEGER,
+		updated_at INTEGER NOT NULL,
+		PRIMARY KEY (video_id, owner, playlist_id)
+	)
+	""",
+	"""
+	CREATE INDEX IF NOT EXISTS idx_catalog_membership_playlist
+	ON catalog_membership(owner, playlist_id)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS playlist_item (
+		owner TEXT NOT NULL,
+		playlist_id TEXT NOT NULL,
+		video_id TEXT NOT NULL,
+		state TEXT NOT NULL,
+		error TEXT,
+		updated_at INTEGER NOT NULL,
+		PRIMARY KEY (owner, playlist_id, video_id)
+	)
+	""",
+	"""
+	CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+		title, uploader, content='catalog', content_rowid='rowid'
+	)
+	""",
+	"""
+	CREATE TRIGGER IF NOT EXISTS catalog_ai AFTER INSERT ON catalog BEGIN
+		INSERT INTO catalog_fts(rowid, title, uploader) VALUES (new.rowid, new.title, new.uploader);
+	END
+	""",
+	"""
+	CREATE TRIGGER IF NOT EXISTS catalog_ad AFTER DELETE ON catalog BEGIN
+		INSERT INTO catalog_fts(catalog_fts, rowid, title, uploader) VALUES ('delete', old.rowid, old.title, old.uploader);
+	END
+	""",
+	"""
+	CREATE TRIGGER IF NOT EXISTS catalog_au AFTER UPDATE OF title, uploader ON catalog BEGIN
+		INSERT INTO catalog_fts(catalog_fts, rowid, title, uploader) VALUES ('delete', old.rowid, old.title, old.uploader);
+		INSERT INTO catalog_fts(rowid, title, uploader) VALUES (new.rowid, new.title, new.uploader);
+	END
+	""",
+)
+
+UPSERT_CATALOG = """
+	INSERT INTO catalog (video_id, title, uploader, duration, updated_at)
+	VALUES (:video_id, :title, :uploader, :duration, :updated_at)
+	ON CONFLICT(video_id) DO UPDATE SET
+		title = excluded.title,
+		uploader = excluded.uploader,
+		duration = excluded.duration,
+		updated_at = excluded.updated_at
+"""
+
+UPSERT_MEMBERSHIP = """
+	INSERT INTO catalog_membership (video_id, owner, playlist_id, file_path, file_size, updated_at)
+	VALUES (:video_id, :owner, :playlist_id, :file_path, :file_size, :updated_at)
+	ON CONFLICT(video_id, owner, playlist_id) DO UPDATE SET
+		file_path = excluded.file_path,
+		file_size = excluded.file_size,
+		updated_at = excluded.updated_at
+"""
+
+# Per-item sync state: downloaded, failed, deferred or removed
+UPSERT_ITEM_STATE = """
+	INSERT INTO playlist_item (owner, playlist_id, video_id, state, error, updated_at)
+	VALUES (?, ?, ?, ?, ?, ?)
+	ON CONFLICT(owner, playlist_id, video_id) DO UPDATE SET
+		state = excluded.state,
+		error = excluded.error,
+		updated_at = excluded.updated_at
+"""
+
+BACKFILL_BATCH = 1000
+
+
+async def init_catalog(db: aiosqlite.Connection):
+	"""
+	Create the catalog tables, indexes and FTS triggers if missing. Does not commit.
+	"""
+	for statement in CATALOG_SCHEMA:
+		await db.execute(statement)
+
+
+def catalog_record(info: dict, file_path: Path | None = None) -> dict | None:
+	"""
+	Trim a yt-dlp info dict down to the catalog columns.
+	If file_path is not given, the final post-processed path from requested_downloads is used.
+	Returns None for entries without an ID (failed or unavailable items).
+	"""
+	if not info or not info.get("id"):
+		return None
+
+	if file_path is None:
+		downloads = info.get("requested_downloads") or []
+		path = (downloads[-1].get("filepath") if downloads else None) or info.get("filepath")
+		file_path = Path(path) if path else None
+
+	file_size = None
+	if file_path is not None:
+		try:
+			file_size = file_path.stat().st_size
+		except OSError:
+			file_size = None
+
+	return {
+		"video_id": info["id"],
+		"title": info.get("title"),
+		"uploader": info.get("uploader") or info.get("channel"),
+		"duration": info.get("duration"),
+		"file_path": str(file_path) if file_path is not None else None,
+		"file_size": file_size,
+	}
+
+
+def ingest_statements(owner: str, playlist_id: str, records: list[dict]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pairs that upsert catalog rows and playlist memberships for the given records.
+	"""
+	if not records:
+		return []
+	now = int(time.time())
+	rows = [{**r, "owner": owner, "playlist_id": playlist_id, "updated_at": now} for r in records]
+	return [(UPSERT_CATALOG, rows), (UPSERT_MEMBERSHIP, rows)]
+
+
+def remove_statements(owner: str, playlist_id: str, video_ids: list[str]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pairs that drop playlist memberships and prune catalog rows left without any.
+	"""
+	if not video_ids:
+		return []
+	return [
+		(
+			"DELETE FROM catalog_membership WHERE video_id = ? AND owner = ? AND playlist_id = ?",
+			[(video_id, owner, playlist_id) for video_id in video_ids],
+		),
+		(
+			"""
+			DELETE FROM catalog WHERE video_id = ?
+			AND NOT EXISTS (SELECT 1 FROM catalog_membership m WHERE m.video_id = catalog.video_id)
+			""",
+			[(video_id,) for video_id in video_ids],
+		),
+	]
+
+
+def item_state_statements(owner: str, playlist_id: str, states: list[tuple[str, str, str | None]]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that records per-item sync state from (video_id, state, error) tuples.
+	"""
+	if not states:
+		return []
+	now = int(time.time())
+	return [(
+		UPSERT_ITEM_STATE,
+		[(owner, playlist_id, video_id, state, error, now) for video_id, state, error in states],
+	)]
+
+
+async def execute_statements(db: aiosqlite.Connection, statements: list[tuple[str, list]]):
+	"""
+	Run (sql, rows) pairs on an aiosqlite connection. Does not commit.
+	"""
+	for sql, rows in statements:
+		await db.executemany(sql, rows)
+
+
+async def ingest(db: aiosqlite.Connection, owner: str, playlist_id: str, records: list[dict]):
+	"""
+	Upsert catalog rows and playlist memberships for the given records. Does not commit.
+	"""
+	await execute_statements(db, ingest_statements(owner, playlist_id, records))
+
+
+async def remove_memberships(db: aiosqlite.Connection, owner: str, playlist_id: str, video_ids: list[str]):
+	"""
+	Drop playlist memberships for removed items and prune catalog rows left without any. Does not commit.
+	"""
+	await execute_statements(db, remove_statements(owner, playlist_id, video_ids))
+
+
+def media_for_info(info_path: Path) -> Path | None:
+	"""
+	Find the media file that sits next to an `.info.json` file (same stem).
+	"""
+	stem = info_path.name[: -len(".info.json")]
+	candidates = [
+		p for p in info_path.parent.glob(f"{glob_escape(stem)}.*")
+		if p != info_path and not p.name.endswith((".info.json", ".part", ".ytdl"))
+	]
+	if not candidates:
+		return None
+	candidates.sort(key=lambda p: p.suffix != ".mp3")
+	return candidates[0]
+
+
+def glob_escape(value: str) -> str:
+	return re.sub(r"([*?\[])", r"[\1]", value)
+
+
+def iter_info_files(root: Path) -> Iterator[tuple[str, str, dict]]:
+	"""
+	Walk {root}/{owner}/{playlist_id}/*.info.json and yield (owner, playlist_id, record).
+	"""
+	for info_path in root.glob("*/*/*.info.json"):
+		owner = info_path.parent.parent.name
+		playlist_id = info_path.parent.name
+		try:
+			info = json.loads(info_path.read_text())
+		except Exception:
+			logger.warning("Skipping unreadable %s", info_path)
+			continue
+		record = catalog_record(info, media_for_info(info_path))
+		if record:
+			yield owner, playlist_id, record
+
+
+async def backfill(db: aiosqlite.Connection, root: Path) -> dict:
+	"""
+	Bulk-load the catalog from existing info.json files under root, in a single transaction.
+	"""
+	now = int(time.time())
+	ingested = 0
+	batch: list[dict] = []
+	for owner, playlist_id, record in iter_info_files(root):
+		batch.append({**record, "owner": owner, "playlist_id": playlist_id, "updated_at": now})
+		if len(batch) >= BACKFILL_BATCH:
+			await db.executemany(UPSERT_CATALOG, batch)
+			await db.executemany(UPSERT_MEMBERSHIP, batch)
+			ingested += len(batch)
+			batch = []
+	if batch:
+		await db.executemany(UPSERT_CATALOG, batch)
+		await db.executemany(UPSERT_MEMBERSHIP, batch)
+		ingested += len(batch)
+	await db.commit()
+	return {"ingested": ingested}
+
+
+def fts_query(text: str) -> str:
+	"""
+	Turn free text into a safe FTS5 query: every word becomes a quoted prefix term.
+	"""
+	tokens = re.findall(r"\w+", text, re.UNICODE)
+	return " ".join(f'"{token}"*' for token in tokens)
+
+
+async def search(
+	db: aiosqlite.Connection,
+	text: str,
+	owner: str | None = None,
+	page: int = 1,
+	per_page: int = 50,
+) -> dict:
+	"""
+	Full-text search over the catalog, ranked by bm25.
+	If owner is given only videos in that owner's playlists are returned.
+	Each item lists the playlists it belongs to.
+	"""
+	query = fts_query(text)
+	if not query:
+		raise ValueError("Empty search query")
+
+	scope = "AND m.owner = :owner" if owner else ""
+	params = {"query": query, "owner": owner, "limit": per_page, "offset": (page - 1) * per_page}
+	where = f"""
+		WHERE catalog_fts MATCH :query
+		AND EXISTS (SELECT 1 FROM catalog_membership m WHERE m.video_id = c.video_id {scope})
+	"""
+
+	cur = await db.execute(
+		f"SELECT COUNT(*) FROM catalog_fts JOIN catalog c ON c.rowid = catalog_fts.rowid {where}",
+		params,
+	)
+	total = (await cur.fetchone())[0]
+
+	cur = await db.execute(
+		f"""
+		SELECT c.video_id, c.title, c.uploader, c.duration
+		FROM catalog_fts JOIN catalog c ON c.rowid = catalog_fts.rowid
+		{where}
+		ORDER BY catalog_fts.rank
+		LIMIT :limit OFFSET :offset
+		""",
+		params,
+	)
+	items = [dict(r) for r in await cur.fetchall()]
+
+	if items:
+		placeholders = ",".join("?" for _ in items)
+		args = [item["video_id"] for item in items]
+		owner_filter = ""
+		if owner:
+			owner_filter = "AND owner = ?"
+			args.append(owner)
+		cur = await db.execute(
+			f"""
+			SELECT video_id, owner, playlist_id, file_path, file_size
+			FROM catalog_membership
+			WHERE video_id IN ({placeholders}) {owner_filter}
+			""",
+			args,
+		)
+		playlists: dict[str, list[dict]] = {}
+		for row in await cur.fetchall():
+			row = dict(row)
+			playlists.setdefault(row.pop("video_id"), []).append(row)
+		for item in items:
+			item["playlists"] = playlists.get(item["video_id"], [])
+
+	return {"items": items, "page": page, "per_page": per_page, "total": total}
+
+
+async def playlist_version(db: aiosqlite.Connection, owner: str, playlist_id: str) -> tuple:
+	"""
+	Cheap change marker for a playlist's memberships; changes whenever rows are added, replaced or removed.
+	"""
+	cur = await db.execute(
+		"""
+		SELECT COUNT(*), MAX(updated_at), TOTAL(rowid)
+		FROM catalog_membership WHERE owner = ? AND playlist_id = ?
+		""",
+		(owner, playlist_id),
+	)
+	return tuple(await cur.fetchone())
+
+
+async def playlist_entries(db: aiosqlite.Connection, owner: str, playlist_id: str) -> list[dict]:
+	"""
+	Downloaded items of a playlist with the metadata needed to render an M3U.
+	"""
+	cur = await db.execute(
+		"""
+		SELECT c.video_id, c.title, c.uploader, c.duration
+		FROM catalog_membership m JOIN catalog c ON c.video_id = m.video_id
+		WHERE m.owner = ? AND m.playlist_id = ? AND m.file_path IS NOT NULL
+		ORDER BY c.title
+		""",
+		(owner, playlist_id),
+	)
+	return [dict(r) for r in await cur.fetchall()]
@@ -1,29 +1,192 @@
 import asyncio
 import json
 import logging
+import os
 import shutil
+import socket
+import subprocess
+import time
+from datetime import datetime
+from itertools import islice
 from pathlib import Path
+from typing import Iterable, Iterator
 
 import aiosqlite
 from celery import Celery
+from celery.signals import before_task_publish, celeryd_init, task_postrun, task_prerun, worker_process_shutdown, worker_ready, worker_shutdown
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import PagedList, locked_file
 
-from helpers import get_ydl_opts
+from helpers import get_ydl_opts, normalize_policy, policy_key
+from download_control import WAIT, DownloadController, download_items, decision_statements
+from writebehind import WriteBehindBuffer
+import catalog
+import lanes
+import mediastore
+import metapack
+import prefetch
+import reindex
+import runhistory
+import scheduler
+import shared
+import sharding
+import staging
+import storage
+import strategy
 
 celery = Celery(
     "ytdl_worker",
-    broker="redis://localhost:6379/0",
-    backend="redis://localhost:6379/1",
+    broker=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"),
+    backend=os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/1"),
 )
 
-celery.conf.task_routes = {
-    "tasks.download_playlist": {"queue": "downloads"}
+# Tasks sent without an explicit lane (see lanes.py); node-bound tasks pass lanes.route(lane, node)
+TASK_LANES = {
+    "celery_app.scan": "scheduled_scan",
+    "celery_app.scan_playlist": "scheduled_scan",
+    "celery_app.sync": "bulk_download",
+    "celery_app.prefetch_items": "bulk_download",
+    "celery_app.migrate_playlist": "bulk_download",
 }
-# Data paths
-DATA_ROOT_PATH = Path("/srv/hgst/ytdl/")
-DB_PATH = Path(".database/database.db")
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+	return lanes.route(TASK_LANES.get(name, "maintenance"))
+
+celery.conf.task_routes = (route_task,)
+# Each lane's queue is polled highest lane first; priority steps keep the order within a queue too
+celery.conf.broker_transport_options = {
+    "priority_steps": lanes.PRIORITY_STEPS,
+    "queue_order_strategy": "priority",
+}
+celery.conf.task_default_priority = lanes.LANES["maintenance"]
+# A solo worker holding prefetched bulk tasks would make interactive ones wait behind them
+celery.conf.worker_prefetch_multiplier = 1
+# Data paths; each node has its own data root, the DB is shared
+DATA_ROOT_PATH = Path(os.getenv("DATA_ROOT_PATH", "/srv/hgst/ytdl/"))
+DB_PATH = Path(os.getenv("DB_PATH", Path(__file__).parent / ".database" / "database.db"))
+
+# This worker's node; scan_playlist/sync for playlists placed here arrive on node.<name>
+NODE_NAME = os.getenv("YTDL_NODE", socket.gethostname())
+# host:/path other nodes rsync into when playlists migrate here (unset: same machine, plain copy)
+RSYNC_TARGET = os.getenv("YTDL_RSYNC_TARGET")
+
+# New items found while a listing streams in are handed to sync in batches of this size
+SCAN_CHUNK_SIZE = int(os.getenv("YTDL_SCAN_CHUNK_SIZE", "50"))
+# Entry fields carried from the listing to sync (size estimates need the hints)
+ENTRY_FIELDS = ("id", "duration", "filesize", "filesize_approx")
 
 logger = logging.getLogger("dev")
+
+# Batched status/catalog/item-state writes from this worker process
+db_buffer = WriteBehindBuffer(DB_PATH)
+
+@task_postrun.connect
+def flush_db_buffer(**kwargs):
+	try:
+		db_buffer.flush()
+	except Exception:
+		logger.exception("Failed to flush DB writes after task %s", kwargs.get("task_id"))
+
+@task_postrun.connect
+def finish_scheduled_work(sender=None, kwargs=None, retval=None, state=None, **extra):
+	# A fair-share slot frees up only once a sync is done for good, not when it is retried
+	work_id = (kwargs or {}).get("work_id")
+	if not work_id or sender is None or sender.name != sync.name or state not in ("SUCCESS", "FAILURE"):
+		return
+	nbytes = retval.get("downloaded_bytes", 0) if isinstance(retval, dict) else 0
+
+	async def finish():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await scheduler.finish(db, work_id, nbytes)
+
+	try:
+		asyncio.run(finish())
+		dispatch()
+	except Exception:
+		logger.exception("Failed to finish scheduled work %s", work_id)
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_db_buffer(**kwargs):
+	db_buffer.close()
+
+@celeryd_init.connect
+def add_node_queue(sender=None, instance=None, **kwargs):
+	# Consume this worker's lanes (YTDL_WORKER_LANES), shared and on this node, in addition
+	# to whatever -Q selected, unless the autoscaler gave this worker its queues
+	if os.getenv("YTDL_NODE_QUEUE", "1") == "0":
+		return
+	queues = instance.app.amqp.queues
+	for name in lanes.queues(None, lanes.WORKER_LANES) + lanes.queues(NODE_NAME, lanes.WORKER_LANES):
+		queues.select_add(name)
+	if set(lanes.WORKER_LANES) == set(lanes.LANES):
+		# Tasks sent before there were lanes
+		queues.select_add(sharding.node_queue(NODE_NAME))
+	else:
+		# A reserved worker takes nothing but its lanes
+		queues.deselect(sharding.DEFAULT_QUEUE)
+
+@before_task_publish.connect
+def stamp_lane(headers=None, routing_key=None, **kwargs):
+	# Publish time and lane travel with the message so the worker can measure the queue wait
+	headers["ytdl_published_at"] = time.time()
+	headers["ytdl_lane"] = lanes.lane_of(routing_key)
+
+@task_prerun.connect
+def record_lane_wait(task=None, **kwargs):
+	request = task.request
+	published_at, lane = request.get("ytdl_published_at"), request.get("ytdl_lane")
+	if not published_at or not lane:
+		return
+	# A countdown (retry, deferral) is not waiting in the queue
+	start = published_at
+	eta = request.eta
+	try:
+		if isinstance(eta, str):
+			eta = datetime.fromisoformat(eta)
+		if eta:
+			start = max(start, eta.timestamp())
+	except (TypeError, ValueError):
+		pass
+	db_buffer.extend(lanes.wait_statements(lane, NODE_NAME, time.time() - start))
+
+@worker_ready.connect
+def register_node(**kwargs):
+	async def register():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await sharding.init_nodes(db)
+			await sharding.register_node(db, NODE_NAME, str(DATA_ROOT_PATH), RSYNC_TARGET)
+
+	asyncio.run(register())
+	logger.info("Registered node %s (%s)", NODE_NAME, DATA_ROOT_PATH)
+
+@worker_ready.connect
+def clean_staging(**kwargs):
+	# Runs of workers that died mid-download; nothing of theirs was archived, so scans refetch it
+	if not staging.STAGING_PATH:
+		return
+	try:
+		removed = staging.clean_stale(Path(staging.STAGING_PATH), NODE_NAME, DATA_ROOT_PATH)
+		logger.info("Cleaned staging for node %s: %s", NODE_NAME, removed)
+	except Exception:
+		logger.exception("Failed to clean staging for node %s", NODE_NAME)
+
+@worker_shutdown.connect
+def deactivate_node(**kwargs):
+	# Drops the node from the ring; its playlists move only when rebalance runs
+	if os.getenv("YTDL_SCALED_WORKER") or set(lanes.WORKER_LANES) != set(lanes.LANES):
+		# One of several autoscaled workers, or a reserved one next to the node's main worker;
+		# the node goes inactive when the autoscaler or the main worker stops
+		return
+	async def deactivate():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await sharding.set_node_active(db, NODE_NAME, False)
+
+	try:
+		asyncio.run(deactivate())
+	except Exception:
+		logger.exception("Failed to mark node %s inactive", NODE_NAME)
+
 # Data structure: {user}/{playlist_id}/{uploader - title.mp3, archive.txt}
 
 # Periodic task `scan`: List remote IDs (flat playlist) and local files per playlist, diff them, and queue a `sync` task when new/removed items are found. Keep a per-playlist archive.txt for yt-dlp.
@@ -156,98 +319,550 @@ logger = logging.getLogger("dev")
 #     except Exception as e:
 #         raise self.retry(exc=e, countdown=60)
 
-@celery.task(bind=True, max_retries=3)
-def sync(self, owner: str, playlist: str, url: str | None = None, removed_ids: list[str] | None = None):
+class ListingLogger:
 	"""
-	Sync a playlist: apply deletions, then download new items via yt-dlp archive.
+	yt-dlp logger for playlist listings; notes warnings that mean pages were dropped.
 	"""
-	playlist_folder = DATA_ROOT_PATH / owner / playlist
+
+	def __init__(self):
+		self.incomplete = False
+
+	def debug(self, msg):
+		logger.debug(msg)
+
+	def info(self, msg):
+		logger.debug(msg)
+
+	def warning(self, msg):
+		self.incomplete = self.incomplete or "Incomplete" in msg
+		logger.warning(msg)
+
+	def error(self, msg):
+		logger.error(msg)
+
+def iter_remote_entries(playlist_url: str, listing: ListingLogger | None = None) -> Iterator[dict]:
+	"""
+	List a playlist lazily, yielding entries that carry an ID as each page arrives.
+	Entries are trimmed to the fields scan/sync need. Raises if the listing fails; if it
+	ends normally and listing.incomplete is unset, every remote entry was seen.
+	"""
+	ydl_opts = {
+		"quiet": True,
+		"skip_download": True,
+		"logger": listing or ListingLogger(),
+	}
+	with YoutubeDL(ydl_opts) as ydl:
+		# process=False keeps `entries` as the extractor's page-by-page generator
+		info = ydl.extract_info(playlist_url, download=False, process=False)
+		while info and info.get("_type") in ("url", "url_transparent"):
+			info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+		if not info:
+			raise RuntimeError(f"Failed to list {playlist_url}")
+		entries = info.get("entries") or []
+		if isinstance(entries, PagedList):
+			entries = entries.getslice()
+		for entry in entries:
+			if entry and entry.get("id"):
+				yield {key: entry.get(key) for key in ENTRY_FIELDS}
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+	iterator = iter(iterable)
+	while chunk := list(islice(iterator, size)):
+		yield chunk
+
+def read_archive_ids(archive_file: Path) -> set[str]:
+	"""
+	Video IDs recorded in a yt-dlp archive file ("<extractor> <id>" per line).
+	"""
+	archived_ids = set()
+	if archive_file.exists():
+		for line in archive_file.read_text().splitlines():
+			parts = line.split()
+			if len(parts) >= 2:
+				archived_ids.add(parts[1])
+	return archived_ids
+
+def sync_ydl_opts(playlist_folder: Path, policy: dict | None) -> dict:
+	"""
+	yt-dlp options for downloading into a shared playlist folder. Prefetch resolves formats
+	with the same options so the cached selection matches what sync would pick.
+	"""
+	ydl_opts = get_ydl_opts(playlist_folder, playlist_folder=False, policy=policy)
+	ydl_opts.update({
+		"download_archive": str(playlist_folder / shared.ARCHIVE_NAME),
+		"retries": 10,
+		"fragment_retries": 20,
+		"sleep_interval": 2,
+		"max_sleep_interval": 6,
+
+		# If you export cookies once, add this:
+		"cookiefile": "cookies.txt",
+	})
+	return ydl_opts
+
+@celery.task(bind=True, max_retries=3, acks_late=True)
+def sync(
+	self,
+	owners: list[str] | str,
+	playlist: str,
+	url: str | None = None,
+	removed_ids: list[str] | None = None,
+	policy: dict | None = None,
+	entries: list[dict] | None = None,
+	work_id: int | None = None,
+):
+	"""
+	Sync a playlist for every owner following it with the same policy: apply deletions,
+	then download new items once into the shared folder and link them into each owner's view.
+	`entries` limits the downloads to a batch handed over by scan_playlist; without it
+	the playlist is listed here. The playlist's download policy selects transcode vs
+	passthrough (see helpers.normalize_policy). Queued through schedule_sync; work_id
+	ties the run to its fair-share work item. With YTDL_STAGING_PATH set, items download
+	into a staging folder and are committed to the library in batches (see staging.py).
+	"""
+	owners = [owners] if isinstance(owners, str) else list(owners)
+	policy = normalize_policy(policy)
+	playlist_folder = shared.shared_folder(DATA_ROOT_PATH, playlist, policy)
 	playlist_folder.mkdir(parents=True, exist_ok=True)
-	archive_file = playlist_folder / "archive.txt"
+	views = {owner: shared.view_folder(DATA_ROOT_PATH, owner, playlist) for owner in owners}
+	archive_file = playlist_folder / shared.ARCHIVE_NAME
 	removed_ids = removed_ids or []
 	playlist_url = url or f"https://www.youtube.com/playlist?list={playlist}"
+	# Reservations are per item, not per follower
+	reservation_owner = owners[0]
+	stage = None
+	# Wall-clock and per-phase timings of this run, kept in run_history
+	timer = runhistory.RunTimer("sync", playlist, NODE_NAME)
+	failed = 0
+	downloaded_bytes = 0
 
 	try:
 		removed_archive_entries = 0
 		removed_files = 0
 
 		if removed_ids and archive_file.exists():
-			existing_lines = archive_file.read_text().splitlines()
-			updated_lines = []
-			for line in existing_lines:
-				if not line.strip():
-					continue
-				parts = line.split()
-				if len(parts) >= 2 and parts[1] in removed_ids:
-					removed_archive_entries += 1
-					continue
-				updated_lines.append(line)
-			archive_file.write_text("\n".join(updated_lines) + ("\n" if updated_lines else ""))
+			# Same lock yt-dlp takes to append, so concurrent batch syncs do not lose lines
+			with locked_file(archive_file, "a", encoding="utf-8"), open(archive_file, "r+", encoding="utf-8") as f:
+				existing_lines = f.read().splitlines()
+				updated_lines = []
+				for line in existing_lines:
+					if not line.strip():
+						continue
+					parts = line.split()
+					if len(parts) >= 2 and parts[1] in removed_ids:
+						removed_archive_entries += 1
+						continue
+					updated_lines.append(line)
+				f.seek(0)
+				f.truncate()
+				f.write("\n".join(updated_lines) + ("\n" if updated_lines else ""))
 
 		if removed_ids:
-			for info_path in playlist_folder.glob("*.info.json"):
+			async def fetch_removed_files():
+				async with aiosqlite.connect(DB_PATH) as db:
+					cur = await db.execute(
+						f"""
+						SELECT DISTINCT file_path FROM catalog_membership
+						WHERE playlist_id = ? AND file_path IS NOT NULL
+						AND owner IN ({",".join("?" * len(owners))})
+						AND video_id IN ({",".join("?" * len(removed_ids))})
+						""",
+						(playlist, *owners, *removed_ids),
+					)
+					return [row[0] for row in await cur.fetchall()]
+
+			# Views carry the same file names as the shared folder; the views are pruned below
+			with timer.phase("db"):
+				removed_paths = asyncio.run(fetch_removed_files())
+			for name in {Path(path).name for path in removed_paths}:
+				media_path = playlist_folder / name
 				try:
-					info = json.loads(info_path.read_text())
-				except Exception:
-					continue
-				if info.get("id") not in removed_ids:
-					continue
-				stem = info_path.stem.replace(".info", "")
-				for media_path in playlist_folder.glob(f"{stem}.*"):
-					if media_path == info_path:
-						continue
-					try:
-						media_path.unlink(missing_ok=True)
+					if media_path.exists():
+						media_path.unlink()
 						removed_files += 1
-					except Exception:
-						logger.warning("Failed to delete %s", media_path)
-				try:
-					info_path.unlink(missing_ok=True)
 				except Exception:
-					logger.warning("Failed to delete %s", info_path)
+					logger.warning("Failed to delete %s", media_path)
+			metapack.remove(playlist_folder, removed_ids)
 
-		ydl_opts = get_ydl_opts(playlist_folder, playlist_folder=False)
-		ydl_opts.update({
-			"format": "bestaudio[protocol!=m3u8_native][protocol!=m3u8]/bestaudio/best",
+		if staging.STAGING_PATH:
+			stage = staging.StagingArea(Path(staging.STAGING_PATH), NODE_NAME, playlist_folder)
+		# When staging, yt-dlp's own archive lives there too; the library archive is written on commit
+		ydl_opts = sync_ydl_opts(stage.folder if stage else playlist_folder, policy)
 
-			"extractor_args": {
-				"youtube": {"player_client": ["default", "-android_sdkless"]}
-			},
+		archived_ids = read_archive_ids(archive_file)
+		video_count = 0
+		deferred_entries: list[dict] = []
+		job_ids: dict[str, str] = {}
 
-			"concurrent_fragment_downloads": 1,
-			"retries": 10,
-			"fragment_retries": 20,
-			"sleep_interval": 2,
-			"max_sleep_interval": 6,
+		def pending_entries():
+			nonlocal video_count
+			for entry in entries if entries is not None else timer.iterate("listing", iter_remote_entries(playlist_url)):
+				video_count += 1
+				if entry["id"] not in archived_ids:
+					yield entry
 
-			# If you export cookies once, add this:
-			"cookiefile": "cookies.txt",
-		})
+		async def reserve_item(video_id: str, nbytes: int) -> bool:
+			async with aiosqlite.connect(DB_PATH) as db:
+				return await storage.reserve(db, DATA_ROOT_PATH, NODE_NAME, reservation_owner, playlist, video_id, nbytes)
 
+		async def find_stored(video_id: str) -> dict | None:
+			async with aiosqlite.connect(DB_PATH) as db:
+				return await mediastore.find_object(db, NODE_NAME, video_id, policy)
 
-		with YoutubeDL(ydl_opts) as ydl:
-			info = ydl.extract_info(playlist_url, download=True)
-			video_count = len(info.get("entries", [])) if info else 0
+		async def load_strategy() -> strategy.ClientStrategy:
+			async with aiosqlite.connect(DB_PATH) as db:
+				return strategy.ClientStrategy(policy, outcomes=await strategy.load_outcomes(db, NODE_NAME))
 
-		async def update_db():
+		async def find_prefetched(video_id: str) -> dict | None:
 			async with aiosqlite.connect(DB_PATH) as db:
-				await db.execute(
-					"UPDATE playlist SET active = 1 WHERE playlist_id = ? AND owner = ?",
-					(playlist, owner),
-				)
-				await db.commit()
+				return await prefetch.find_cached(db, NODE_NAME, video_id, policy)
+
+		def publish(video_id: str, record: dict):
+			for owner, view in views.items():
+				# Link before the catalog row can be flushed, so streams never see a missing file
+				owner_record = record
+				if record["file_path"]:
+					source = Path(record["file_path"])
+					view.mkdir(parents=True, exist_ok=True)
+					shared.link_file(source, view / source.name)
+					owner_record = {**record, "file_path": str(view / source.name)}
+				db_buffer.extend(catalog.ingest_statements(owner, playlist, [owner_record]))
+				db_buffer.extend(catalog.item_state_statements(owner, playlist, [(video_id, "downloaded", None)]))
+
+		def link_stored(video_id: str, stored: dict):
+			# Already downloaded under this policy for another playlist: link it and archive it as done
+			target = playlist_folder / stored["file_name"]
+			shared.link_file(Path(stored["path"]), target)
+			with locked_file(archive_file, "a", encoding="utf-8") as f:
+				f.write(f"youtube {video_id}\n")
+			publish(video_id, {**stored, "file_path": str(target)})
+			db_buffer.extend(mediastore.reuse_statements(NODE_NAME, policy, video_id, stored["file_size"] or 0))
+
+		def finish_item(video_id: str, record: dict):
+			publish(video_id, record)
+			if video_id in metadata:
+				packed.append(metapack.trim_info(metadata.pop(video_id), Path(record["file_path"] or "").name or None))
+			if record["file_path"]:
+				try:
+					_, rows = mediastore.put(DATA_ROOT_PATH, NODE_NAME, policy, record)
+					db_buffer.extend(rows)
+				except OSError:
+					logger.warning("Failed to add %s to the media store", record["file_path"])
+
+		def commit_staged():
+			for video_id, record in stage.commit():
+				finish_item(video_id, record)
+
+		def admitted_jobs():
+			nonlocal reused
+			# Reserve space right before each item starts; stop at the low-water mark
+			pending = pending_entries()
+			for entry in pending:
+				with timer.phase("db"):
+					stored = asyncio.run(find_stored(entry["id"]))
+				if stored:
+					link_stored(entry["id"], stored)
+					reused += 1
+					continue
+				with timer.phase("db"):
+					admitted = asyncio.run(reserve_item(entry["id"], storage.estimate_size(entry, policy)))
+				if not admitted:
+					deferred_entries.append(entry)
+					deferred_entries.extend(pending)
+					logger.warning(
+						"Low on space, deferring %d items of %s", len(deferred_entries), playlist
+					)
+					return
+				if stage:
+					nbytes = storage.estimate_size(entry, policy)
+					while not stage.fits(nbytes):
+						if stage.pending:
+							commit_staged()
+						else:
+							# Staging is full of running items
+							yield WAIT
+					stage.reserve(entry["id"], nbytes)
+				job_url = f"https://www.youtube.com/watch?v={entry['id']}"
+				job_ids[job_url] = entry["id"]
+				with timer.phase("db"):
+					prefetched = asyncio.run(find_prefetched(entry["id"]))
+				yield (job_url, {"playlist_id": playlist}, prefetched)
 
-		asyncio.run(update_db())
+		# Fragment concurrency and parallel items are tuned per run by the controller
+		controller = DownloadController()
+		# Player client and format per item, ordered by their recent success on this node
+		with timer.phase("db"):
+			client_strategy = asyncio.run(load_strategy())
+		cataloged = 0
+		reused = 0
+		cache_counts = {"hits": 0, "misses": 0, "stale": 0}
+		# Trimmed metadata goes to the playlist's pack instead of per-item .info.json files
+		metadata: dict[str, dict] = {}
+		packed: list[dict] = []
+		for outcome in download_items(ydl_opts, admitted_jobs(), controller, client_strategy):
+			video_id = job_ids[outcome["url"]]
+			downloaded_bytes += outcome["bytes"]
+			# Summed over parallel items; postprocessing runs inside the item's download
+			timer.add("download", outcome["seconds"])
+			timer.add("transcode", outcome.get("postprocess_seconds", 0.0))
+			db_buffer.extend(storage.release_statements(NODE_NAME, reservation_owner, playlist, [video_id]))
+			if stage:
+				stage.release(video_id)
+			cache_counts[{"hit": "hits", "miss": "misses", "stale": "stale"}[outcome["cache"]]] += 1
+			if outcome["cache"] != "miss":
+				db_buffer.extend(prefetch.consume_statements(NODE_NAME, policy, [video_id]))
+			if outcome["error"]:
+				failed += 1
+				for owner in owners:
+					db_buffer.extend(catalog.item_state_statements(owner, playlist, [(video_id, "failed", outcome["error"])]))
+				continue
+			record = catalog.catalog_record(outcome["info"])
+			if record and outcome["info"].get("requested_downloads"):
+				metadata[video_id] = outcome["info"]
+				if stage and record["file_path"]:
+					if stage.add(video_id, record):
+						commit_staged()
+				else:
+					finish_item(video_id, record)
+				cataloged += 1
+		if stage:
+			commit_staged()
+		metapack.write(playlist_folder, packed)
 
+		linked = 0
+		for view in views.values():
+			linked += shared.materialize_view(playlist_folder, view)["linked"]
+
+		for owner in owners:
+			db_buffer.execute(
+				"UPDATE playlist SET active = 1 WHERE playlist_id = ? AND owner = ?",
+				(playlist, owner),
+			)
+			db_buffer.extend(catalog.remove_statements(owner, playlist, removed_ids))
+			db_buffer.extend(catalog.item_state_statements(owner, playlist, [(i, "removed", None) for i in removed_ids]))
+			db_buffer.extend(catalog.item_state_statements(owner, playlist, [(e["id"], "deferred", None) for e in deferred_entries]))
+		db_buffer.extend(decision_statements(reservation_owner, playlist, controller.decisions))
+		db_buffer.extend(prefetch.stats_statements(NODE_NAME, **cache_counts))
+		db_buffer.extend(client_strategy.statements(NODE_NAME))
+		# Commit before the task returns so the broker ack (acks_late) implies durable writes
+		with timer.phase("db"):
+			db_buffer.flush()
+
+		if deferred_entries:
+			# Deletions are done; only the deferred downloads are retried once space frees up
+			schedule_sync(
+				owners,
+				playlist,
+				{"url": url, "policy": policy, "entries": deferred_entries},
+				cost=sum(storage.estimate_size(entry, policy) for entry in deferred_entries),
+				delay=storage.DEFER_SECONDS,
+			)
+
+		# The run's own row goes out with the post-task flush
+		db_buffer.extend(timer.statements(
+			"deferred" if deferred_entries else "success",
+			items_added=cataloged + reused,
+			items_removed=len(removed_ids),
+			items_failed=failed,
+			nbytes=downloaded_bytes,
+		))
 		return {
-			"status": "success",
+			"status": "deferred" if deferred_entries else "success",
+			"owners": len(owners),
 			"video_count": video_count,
+			"deferred": len(deferred_entries),
 			"removed_ids": len(removed_ids),
 			"removed_archive_entries": removed_archive_entries,
 			"removed_files": removed_files,
+			"cataloged": cataloged,
+			"reused": reused,
+			"linked": linked,
+			"failed": failed,
+			"downloaded_bytes": downloaded_bytes,
+			"prefetch": cache_counts,
+			"packed": len(packed),
+			"fragments": controller.fragments,
+			"parallel_items": controller.items,
+			"player_client": "/".join(client_strategy.ranking()[0]),
+			"db_writes": db_buffer.stats(),
 		}
 	except Exception as e:
+		db_buffer.extend(timer.statements("error", items_failed=failed, nbytes=downloaded_bytes))
 		raise self.retry(exc=e, countdown=60)
+	finally:
+		if stage:
+			stage.close()
+
+def schedule_sync(
+	owners: list[str],
+	playlist_id: str,
+	payload: dict,
+	cost: int,
+	lane: str = "routine",
+	delay: int = 0,
+):
+	"""
+	Queue a sync on this node behind the fair-share scheduler instead of straight on the broker.
+	payload holds sync's keyword arguments (url, removed_ids, policy, entries).
+	"""
+	async def submit():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await scheduler.submit(db, owners, playlist_id, NODE_NAME, payload, cost, lane, delay)
+
+	asyncio.run(submit())
+	dispatch()
+
+# Wake-up times this process has already sent a wake_dispatch for
+_wakeups: set[int] = set()
+
+def dispatch():
+	"""
+	Send this node's next fair-share items to its queue, as many as it has free slots.
+	Items held back by not_before or a daily quota get a delayed wake_dispatch, so an
+	otherwise idle node still picks them up.
+	"""
+	async def claim():
+		async with aiosqlite.connect(DB_PATH) as db:
+			return await scheduler.claim(db, NODE_NAME), await scheduler.next_wakeup(db, NODE_NAME)
+
+	async def requeue(work_id: int):
+		async with aiosqlite.connect(DB_PATH) as db:
+			await scheduler.requeue(db, work_id)
+
+	claimed, wakeup = asyncio.run(claim())
+	for item in claimed:
+		try:
+			sync.apply_async(
+				(item["owners"], item["playlist_id"]),
+				{**item["payload"], "work_id": item["id"]},
+				**lanes.route(lanes.SCHEDULER_LANES[item["lane"]], NODE_NAME),
+			)
+		except Exception:
+			logger.exception("Failed to send work item %s", item["id"])
+			asyncio.run(requeue(item["id"]))
+
+	now = int(time.time())
+	_wakeups.difference_update({at for at in _wakeups if at <= now})
+	if wakeup is not None:
+		# Rounded up to the minute so a burst of deferrals shares one wake-up
+		wakeup = -(-wakeup // 60) * 60
+		if wakeup not in _wakeups:
+			try:
+				wake_dispatch.apply_async(countdown=wakeup - now, **lanes.route("maintenance", NODE_NAME))
+				_wakeups.add(wakeup)
+			except Exception:
+				logger.exception("Failed to schedule a dispatch wake-up at %s", wakeup)
+
+@celery.task
+def wake_dispatch():
+	"""
+	Dispatch this node's fair-share queue once deferred or quota-held items become eligible.
+	"""
+	dispatch()
+
+@celery.task
+def prefetch_items(playlist_id: str, video_ids: list[str], policy: dict | None = None) -> dict:
+	"""
+	Resolve upcoming downloads ahead of their sync: extraction and format selection run
+	PREFETCH_WORKERS at a time and the results are cached per node until shortly before
+	their media URLs expire, so sync goes straight to the transfer. IDs already cached or
+	in the media store are skipped.
+	"""
+	policy = normalize_policy(policy)
+
+	async def pending_ids():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await prefetch.prune_expired(db)
+			cached = await prefetch.cached_ids(db, NODE_NAME, policy, video_ids)
+			pending = []
+			for video_id in video_ids:
+				if video_id not in cached and not await mediastore.find_object(db, NODE_NAME, video_id, policy):
+					pending.append(video_id)
+			return pending
+
+	async def load_strategy() -> strategy.ClientStrategy:
+		async with aiosqlite.connect(DB_PATH) as db:
+			return strategy.ClientStrategy(policy, outcomes=await strategy.load_outcomes(db, NODE_NAME))
+
+	# Resolve with the choice sync tries first, so the cached format selection is the one it would make
+	client_strategy = asyncio.run(load_strategy())
+	ydl_opts = sync_ydl_opts(shared.shared_folder(DATA_ROOT_PATH, playlist_id, policy), policy)
+	ydl_opts = client_strategy.apply(ydl_opts, client_strategy.ranking()[0])
+	resolved = []
+	failed = 0
+	for video_id, info in prefetch.resolve_many(ydl_opts, asyncio.run(pending_ids())):
+		if info:
+			resolved.append(info)
+		else:
+			failed += 1
+	db_buffer.extend(prefetch.cache_statements(NODE_NAME, policy, resolved))
+	db_buffer.extend(prefetch.stats_statements(NODE_NAME, prefetched=len(resolved), failed=failed))
+	return {"status": "success", "requested": len(video_ids), "prefetched": len(resolved), "failed": failed}
+
+@celery.task
+def backfill_catalog() -> dict:
+	"""
+	Bulk-load the video catalog from the info.json files already on disk.
+	"""
+	async def run():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await catalog.init_catalog(db)
+			return await catalog.backfill(db, DATA_ROOT_PATH)
+
+	result = asyncio.run(run())
+	logger.info("Catalog backfill ingested %d items", result["ingested"])
+	return {"status": "success", **result}
+
+@celery.task
+def collect_media() -> dict:
+	"""
+	Garbage-collect media store objects no playlist links to any more.
+	"""
+	async def run():
+		async with aiosqlite.connect(DB_PATH) as db:
+			return await mediastore.collect_garbage(db, DATA_ROOT_PATH, NODE_NAME)
+
+	result = asyncio.run(run())
+	logger.info("Media GC removed %d objects (%d bytes)", result["removed"], result["freed_bytes"])
+	return {"status": "success", **result}
+
+@celery.task
+def dedup_media() -> dict:
+	"""
+	One-shot pass that collapses duplicate copies in the existing library into the media store.
+	"""
+	async def run():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await mediastore.init_media(db)
+			return await mediastore.dedup_library(db, DATA_ROOT_PATH, NODE_NAME)
+
+	result = asyncio.run(run())
+	return {"status": "success", **result}
+
+@celery.task
+def pack_metadata() -> dict:
+	"""
+	Move this node's legacy .info.json files into the per-playlist metadata packs.
+	"""
+	async def fetch_policies():
+		async with aiosqlite.connect(DB_PATH) as db:
+			cur = await db.execute("SELECT owner, playlist_id, policy FROM playlist")
+			return {(owner, playlist_id): policy for owner, playlist_id, policy in await cur.fetchall()}
+
+	return {"status": "success", **metapack.migrate_library(DATA_ROOT_PATH, asyncio.run(fetch_policies()))}
+
+@celery.task
+def reindex_library(full: bool = False, dry_run: bool = False) -> dict:
+	"""
+	Rebuild this node's archives, metadata packs and catalog rows from the IDs tagged into
+	its media files (see reindex.py).
+	"""
+	async def run():
+		async with aiosqlite.connect(DB_PATH) as db:
+			await catalog.init_catalog(db)
+			return await reindex.reindex(db, DATA_ROOT_PATH, full=full, dry_run=dry_run)
+
+	return {"status": "success", **asyncio.run(run())}
 
 def validate(owner: str, playlist: str) -> dict:
 	"""
@@ -269,90 +884,291 @@ def validate(owner: str, playlist: str) -> dict:
 def sanitize() -> dict:
 	"""
 	Delete local data for inactive playlists or deactivated users.
+	Owner folders only hold links, so removing one leaves the shared copy to the other
+	followers; a shared folder goes once no active owner references it.
 	"""
 	removed = 0
 
-	async def fetch_inactive():
+	async def fetch_playlists():
 		async with aiosqlite.connect(DB_PATH) as db:
 			db.row_factory = aiosqlite.Row
 			cur = await db.execute(
 				"""
-				SELECT p.playlist_id, p.owner
+				SELECT p.playlist_id, p.owner, p.policy, p.active AND u.active AS live
 				FROM playlist p
 				JOIN user u ON p.owner = u.name
-				WHERE p.active = 0 OR u.active = 0
 				"""
 			)
 			return await cur.fetchall()
 
-	rows = asyncio.run(fetch_inactive())
+	rows = asyncio.run(fetch_playlists())
 	for row in rows:
-		playlist_folder = DATA_ROOT_PATH / row["owner"] / row["playlist_id"]
+		if row["live"]:
+			continue
+		playlist_folder = shared.view_folder(DATA_ROOT_PATH, row["owner"], row["playlist_id"])
 		if playlist_folder.exists():
 			shutil.rmtree(playlist_folder, ignore_errors=True)
 			removed += 1
 
-	return {"status": "success", "removed_playlists": removed}
+	referenced = shared.referenced_folders([(row["playlist_id"], row["policy"]) for row in rows if row["live"]])
+	removed_shared = shared.remove_unreferenced(DATA_ROOT_PATH, referenced)
+
+	return {"status": "success", "removed_playlists": removed, "removed_shared": removed_shared}
+
+@celery.task
+def downsample_history() -> dict:
+	"""
+	Fold old scan and sync runs into daily rows and drop expired history (see runhistory.py).
+	"""
+	async def run():
+		async with aiosqlite.connect(DB_PATH) as db:
+			return await runhistory.downsample(db)
+
+	return {"status": "success", **asyncio.run(run())}
 
 @celery.task(bind=True, max_retries=3)
 def scan(self):
 	"""
-	Scan active playlists, diff remote IDs vs archive, and queue sync tasks.
+	Queue a scan_playlist task for every active playlist, on the node that holds its files.
 	"""
 	try:
 		async def fetch_playlists():
 			async with aiosqlite.connect(DB_PATH) as db:
 				db.row_factory = aiosqlite.Row
+				await sharding.place_unassigned(db)
+				await db.commit()
+				# Playlists being migrated are skipped until their files have landed
 				cur = await db.execute(
-					"SELECT owner, playlist_id FROM playlist WHERE active = 1"
+					"SELECT owner, playlist_id, policy, node FROM playlist WHERE active = 1 AND node_target IS NULL"
 				)
 				return await cur.fetchall()
 
 		rows = asyncio.run(fetch_playlists())
-		queued = 0
+		# Owners following the same playlist with the same policy share one scan and one download
+		groups: dict[tuple[str, str], dict] = {}
 		for row in rows:
-			owner = row["owner"]
-			playlist_id = row["playlist_id"]
-			playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
+			policy = json.loads(row["policy"]) if row["policy"] else None
+			group = groups.setdefault(
+				(row["playlist_id"], policy_key(policy)),
+				{"owners": [], "policy": policy, "node": row["node"]},
+			)
+			group["owners"].append(row["owner"])
+
+		for (playlist_id, _), group in groups.items():
+			scan_playlist.apply_async(
+				(group["owners"], playlist_id),
+				{"policy": group["policy"]},
+				**lanes.route("scheduled_scan", group["node"]),
+			)
+		downsample_history.delay()
+
+		return {"status": "success", "queued": len(groups), "playlists": len(rows)}
+	except Exception as e:
+		raise self.retry(exc=e, countdown=60)
+
+@celery.task(bind=True, max_retries=3)
+def scan_playlist(self, owners: list[str] | str, playlist_id: str, policy: dict | None = None, lane: str = "routine"):
+	"""
+	Stream one shared playlist's listing against its archive and queue syncs on this node.
+
+	New items are handed to sync in batches of SCAN_CHUNK_SIZE as pages arrive, so
+	downloads start while the listing is still running. Only archived IDs seen remotely
+	are kept, not the listing itself. Removals are queued once the listing has
+	completed; a failed or truncated listing never counts as items being removed.
+	Syncs go through the fair-share scheduler; a playlist's first sync, and updates
+	requested with lane="priority", use the priority lane.
+	"""
+	timer = runhistory.RunTimer("scan", playlist_id, NODE_NAME)
+	try:
+		async def fetch_space():
+			async with aiosqlite.connect(DB_PATH) as db:
+				return await storage.space_status(db, DATA_ROOT_PATH, NODE_NAME)
+
+		owners = [owners] if isinstance(owners, str) else list(owners)
+		playlist_url = f"https://www.youtube.com/playlist?list={playlist_id}"
 
+		for owner in owners:
 			validation = validate(owner, playlist_id)
 			if validation["issues"]:
 				logger.info("Validation issues for %s/%s: %s", owner, playlist_id, validation["issues"])
 
-			playlist_folder = DATA_ROOT_PATH / owner / playlist_id
-			playlist_folder.mkdir(parents=True, exist_ok=True)
-			archive_file = playlist_folder / "archive.txt"
-
-			ydl_opts = {
-				"quiet": True,
-				"skip_download": True,
-				"extract_flat": True,
-				"ignoreerrors": True,
-			}
-
-			with YoutubeDL(ydl_opts) as ydl:
-				info = ydl.extract_info(playlist_url, download=False)
-				entries = info.get("entries", []) if info else []
-				remote_ids = {entry["id"] for entry in entries if entry and entry.get("id")}
-
-			archived_ids = set()
-			if archive_file.exists():
-				for line in archive_file.read_text().splitlines():
-					parts = line.split()
-					if len(parts) >= 2:
-						archived_ids.add(parts[1])
+		playlist_folder = shared.shared_folder(DATA_ROOT_PATH, playlist_id, policy)
+		views = [shared.view_folder(DATA_ROOT_PATH, owner, playlist_id) for owner in owners]
+		adopted = shared.adopt_legacy_views(playlist_folder, views)
+		# Owners who joined (or came back) since the last sync get their links here
+		for view in views:
+			shared.materialize_view(playlist_folder, view)
+		archive_file = playlist_folder / shared.ARCHIVE_NAME
+		if not archive_file.exists():
+			lane = "priority"
+		archived_ids = read_archive_ids(archive_file)
+
+		listing = ListingLogger()
+		seen_archived: set[str] = set()
+		queued_ids: set[str] = set()
+		video_count = 0
+		batches = 0
+		deferred = 0
+		for chunk in chunked(timer.iterate("listing", iter_remote_entries(playlist_url, listing)), SCAN_CHUNK_SIZE):
+			video_count += len(chunk)
+			new_entries = []
+			for entry in chunk:
+				if entry["id"] in archived_ids:
+					seen_archived.add(entry["id"])
+				elif entry["id"] not in queued_ids:
+					queued_ids.add(entry["id"])
+					new_entries.append(entry)
+			if not new_entries:
+				continue
+			with timer.phase("db"):
+				admitting = asyncio.run(fetch_space())["admitting"]
+			if not admitting:
+				# No room to download; keep listing for removals, the next scan picks these up
+				deferred += len(new_entries)
+				continue
+			# Queued ahead of the sync so the batch's extractions are resolved before it starts
+			prefetch_items.apply_async(
+				(playlist_id, [entry["id"] for entry in new_entries]),
+				{"policy": policy},
+				**lanes.route(lanes.SCHEDULER_LANES[lane], NODE_NAME),
+			)
+			with timer.phase("db"):
+				schedule_sync(
+					owners,
+					playlist_id,
+					{"url": playlist_url, "policy": policy, "entries": new_entries},
+					cost=sum(storage.estimate_size(entry, policy) for entry in new_entries),
+					lane=lane,
+				)
+			batches += 1
 
-			removed_ids = list(archived_ids - remote_ids)
-			new_ids = remote_ids - archived_ids
+		removed_ids = []
+		if listing.incomplete:
+			logger.warning("Listing of %s was incomplete, skipping removal detection", playlist_id)
+		else:
+			removed_ids = list(archived_ids - seen_archived)
+		if removed_ids:
+			with timer.phase("db"):
+				schedule_sync(
+					owners,
+					playlist_id,
+					{"url": playlist_url, "removed_ids": removed_ids, "policy": policy, "entries": []},
+					cost=0,
+					lane=lane,
+				)
+		if deferred:
+			logger.warning("Data volume below low-water mark, deferred %d items of %s", deferred, playlist_id)
 
-			if new_ids or removed_ids:
-				sync.delay(owner, playlist_id, playlist_url, removed_ids)
-				queued += 1
+		# Items found here are queued, not yet downloaded; the syncs record what landed
+		db_buffer.extend(timer.statements(
+			"deferred" if deferred else "incomplete" if listing.incomplete else "success",
+			items_added=len(queued_ids),
+			items_removed=len(removed_ids),
+		))
 
-		return {"status": "success", "queued": queued, "playlists": len(rows)}
+		return {
+			"status": "deferred" if deferred else "success",
+			"lane": lane,
+			"owners": len(owners),
+			"adopted": adopted,
+			"video_count": video_count,
+			"new": len(queued_ids),
+			"batches": batches,
+			"deferred": deferred,
+			"removed": len(removed_ids),
+			"complete": not listing.incomplete,
+		}
 	except Exception as e:
+		db_buffer.extend(timer.statements("error"))
 		raise self.retry(exc=e, countdown=60)
 
+@celery.task(bind=True, max_retries=3)
+def rebalance(self):
+	"""
+	Move playlists whose desired node changed (nodes joined/left, overrides set) by queueing migrations on the source nodes.
+	"""
+	try:
+		async def plan():
+			async with aiosqlite.connect(DB_PATH) as db:
+				moves = await sharding.plan_rebalance(db)
+				_, nodes = await sharding.load_ring(db)
+				for move in moves:
+					await db.execute(
+						"UPDATE playlist SET node_target = ? WHERE playlist_id = ?",
+						(move["target"], move["playlist_id"]),
+					)
+				await db.commit()
+				return moves, nodes
+
+		moves, nodes = asyncio.run(plan())
+		for move in moves:
+			source = nodes.get(move["source"])
+			target = nodes[move["target"]]
+			if source is None or not source["active"]:
+				# Source node is gone; its files cannot be copied, the target will redownload
+				logger.warning("Node %s unavailable, reassigning %s without copying", move["source"], move["playlist_id"])
+				finish_migration(move["playlist_id"], move["owners"], None, target)
+				continue
+			migrate_playlist.apply_async(
+				(move["playlist_id"], move["owners"], target),
+				**lanes.route("bulk_download", move["source"]),
+			)
+		return {"status": "success", "moves": len(moves)}
+	except Exception as e:
+		raise self.retry(exc=e, countdown=60)
+
+def finish_migration(playlist_id: str, owners: list[str], source_root: Path | None, target: dict):
+	"""
+	Point the playlist and its catalog file paths at the target node.
+	"""
+	target_root = Path(target["data_root"])
+	db_buffer.execute(
+		"UPDATE playlist SET node = ?, node_target = NULL WHERE playlist_id = ?",
+		(target["name"], playlist_id),
+	)
+	if source_root is not None:
+		for owner in owners:
+			old_prefix = str(source_root / owner / playlist_id)
+			new_prefix = str(target_root / owner / playlist_id)
+			db_buffer.execute(
+				"""
+				UPDATE catalog_membership SET file_path = ? || substr(file_path, ?)
+				WHERE owner = ? AND playlist_id = ? AND substr(file_path, 1, ?) = ?
+				""",
+				(new_prefix, len(old_prefix) + 1, owner, playlist_id, len(old_prefix), old_prefix),
+			)
+	db_buffer.flush()
+
+@celery.task(bind=True, max_retries=3, acks_late=True)
+def migrate_playlist(self, playlist_id: str, owners: list[str], target: dict):
+	"""
+	Runs on the source node: copy the playlist's shared folder and owner views to the target node, then drop the local copy.
+	A single rsync -H keeps the views as links to the shared files. Goes to the target's
+	rsync_target when set, otherwise straight into its data root (nodes sharing a machine).
+	"""
+	try:
+		# "/./" marks where rsync -R starts recreating the path under the destination
+		sources = [
+			f"{DATA_ROOT_PATH}/./{relative}"
+			for relative in (f"{shared.SHARED_DIR}/{playlist_id}", *(f"{owner}/{playlist_id}" for owner in owners))
+			if (DATA_ROOT_PATH / relative).exists()
+		]
+		if sources:
+			destination = target.get("rsync_target") or target["data_root"]
+			subprocess.run(
+				["rsync", "-aHR", *sources, f"{destination.rstrip('/')}/"],
+				check=True,
+			)
+
+		finish_migration(playlist_id, owners, DATA_ROOT_PATH, target)
+		shutil.rmtree(DATA_ROOT_PATH / shared.SHARED_DIR / playlist_id, ignore_errors=True)
+		for owner in owners:
+			shutil.rmtree(DATA_ROOT_PATH / owner / playlist_id, ignore_errors=True)
+		logger.info("Migrated %s from %s to %s", playlist_id, NODE_NAME, target["name"])
+		return {"status": "success", "playlist_id": playlist_id, "target": target["name"]}
+	except Exception as e:
+		raise self.retry(exc=e, countdown=300)
+
 @celery.task
 def update_system():
 	'''
@@ -0,0 +1,347 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Iterable, Iterator
+
+import aiosqlite
+from yt_dlp import YoutubeDL
+
+logger = logging.getLogger("dev")
+
+# Limits the controller may move within
+MIN_FRAGMENTS = int(os.getenv("YTDL_MIN_FRAGMENTS", "1"))
+MAX_FRAGMENTS = int(os.getenv("YTDL_MAX_FRAGMENTS", "8"))
+MAX_PARALLEL_ITEMS = int(os.getenv("YTDL_MAX_PARALLEL_ITEMS", "3"))
+
+# Completed downloads used for the error rate
+WINDOW = 8
+# Completed downloads at a setting before its throughput is judged
+SETTLE = 2
+# Back off when more than this share of the window failed
+ERROR_RATE_LIMIT = 0.25
+# A probe step must raise throughput by at least this much to be kept
+MIN_GAIN = 0.05
+
+# Yielded by a job iterator that may not start anything until a running item finishes
+WAIT = object()
+
+THROTTLE_SIGNATURES = (
+	"HTTP Error 429",
+	"Too Many Requests",
+	"HTTP Error 403",
+	"rate-limited",
+	"confirm you’re not a bot",
+	"confirm you're not a bot",
+)
+
+DECISION_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS download_decision (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		created_at REAL NOT NULL,
+		owner TEXT,
+		playlist_id TEXT,
+		fragments INTEGER NOT NULL,
+		items INTEGER NOT NULL,
+		throughput REAL,
+		error_rate REAL,
+		reason TEXT NOT NULL
+	)
+	""",
+	"""
+	CREATE INDEX IF NOT EXISTS idx_download_decision_created
+	ON download_decision(created_at)
+	""",
+)
+
+
+async def init_decisions(db: aiosqlite.Connection):
+	"""
+	Create the controller decision log if missing. Does not commit.
+	"""
+	for statement in DECISION_SCHEMA:
+		await db.execute(statement)
+
+
+INSERT_DECISION = """
+	INSERT INTO download_decision
+	(created_at, owner, playlist_id, fragments, items, throughput, error_rate, reason)
+	VALUES (:created_at, :owner, :playlist_id, :fragments, :items, :throughput, :error_rate, :reason)
+"""
+
+
+def decision_statements(owner: str, playlist_id: str, decisions: list[dict]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that appends controller decisions to the decision log.
+	"""
+	if not decisions:
+		return []
+	return [(INSERT_DECISION, [{**d, "owner": owner, "playlist_id": playlist_id} for d in decisions])]
+
+
+def is_throttle(message: str | None) -> bool:
+	return bool(message) and any(signature in message for signature in THROTTLE_SIGNATURES)
+
+
+class DownloadController:
+	"""
+	AIMD controller for fragment concurrency and simultaneous item downloads.
+
+	Starts at the minimum and probes upwards one step at a time (fragments first,
+	then items). A step is kept only if aggregate throughput grows by MIN_GAIN;
+	otherwise it is undone and probing pauses for a window. Throttling or a high
+	error rate halves fragment concurrency and drops one item slot; after
+	throttling, fragments stay below the level that triggered it.
+	Every change is appended to `decisions`.
+	"""
+
+	def __init__(
+		self,
+		min_fragments: int = MIN_FRAGMENTS,
+		max_fragments: int = MAX_FRAGMENTS,
+		max_items: int = MAX_PARALLEL_ITEMS,
+		clock=time.time,
+	):
+		self.min_fragments = max(1, min_fragments)
+		self.max_fragments = max(self.min_fragments, max_fragments)
+		self.max_items = max(1, max_items)
+		self.fragments = self.min_fragments
+		self.items = 1
+		self.decisions: list[dict] = []
+		self._clock = clock
+		self._lock = threading.Lock()
+		self._window: deque[bool] = deque(maxlen=WINDOW)
+		# (finished_at, bytes, seconds) of successful downloads since the last change
+		self._current: list[tuple[float, int, float]] = []
+		self._baseline: float | None = None
+		self._last_step: str | None = None
+		self._hold = 0
+		self._ceiling = self.max_fragments
+
+	def observe(self, nbytes: int, seconds: float, error: str | None = None, throttled: bool = False) -> dict | None:
+		"""
+		Feed one finished download. Returns the decision taken, if any.
+		"""
+		throttled = throttled or is_throttle(error)
+		if not error and not throttled and nbytes <= 0:
+			# Skipped item (archived, filtered); says nothing about the link
+			return None
+		with self._lock:
+			self._window.append(bool(error))
+			if not error:
+				self._current.append((self._clock(), nbytes, max(seconds, 1e-3)))
+			return self._decide(throttled)
+
+	def throughput(self) -> float:
+		"""
+		Aggregate bytes/s of downloads finished at the current setting, across parallel items.
+		"""
+		if not self._current:
+			return 0.0
+		start = min(end - seconds for end, _, seconds in self._current)
+		end = max(end for end, _, _ in self._current)
+		return sum(nbytes for _, nbytes, _ in self._current) / max(end - start, 1e-3)
+
+	def error_rate(self) -> float:
+		return sum(self._window) / len(self._window) if self._window else 0.0
+
+	def _decide(self, throttled: bool) -> dict | None:
+		error_rate = self.error_rate()
+		if throttled or (len(self._window) >= SETTLE and error_rate > ERROR_RATE_LIMIT):
+			if self.fragments == self.min_fragments and self.items == 1:
+				return None
+			if throttled:
+				# Do not probe back up to a setting the server has already pushed back on
+				self._ceiling = max(self.min_fragments, self.fragments - 1)
+			self.fragments = max(self.min_fragments, self.fragments // 2)
+			self.items = max(1, self.items - 1)
+			self._baseline = None
+			self._last_step = None
+			self._hold = WINDOW
+			self._window.clear()
+			return self._record("throttled" if throttled else "errors", error_rate)
+
+		if len(self._current) < SETTLE * self.items:
+			return None
+		current = self.throughput()
+
+		if self._baseline is not None and current < self._baseline * (1 + MIN_GAIN):
+			if self._last_step == "fragments":
+				self.fragments -= 1
+			elif self._last_step == "items":
+				self.items -= 1
+			self._baseline = None
+			self._last_step = None
+			self._hold = WINDOW
+			return self._record("no_gain", error_rate, current)
+
+		if self._hold > 0:
+			self._hold -= 1
+			return None
+
+		if self.fragments < min(self.max_fragments, self._ceiling):
+			self.fragments += 1
+			self._last_step = "fragments"
+		elif self.items < self.max_items:
+			self.items += 1
+			self._last_step = "items"
+		else:
+			return None
+		self._baseline = current
+		return self._record("probe", error_rate, current)
+
+	def _record(self, reason: str, error_rate: float, throughput: float | None = None) -> dict:
+		decision = {
+			"created_at": self._clock(),
+			"fragments": self.fragments,
+			"items": self.items,
+			"throughput": throughput if throughput is not None else self.throughput(),
+			"error_rate": error_rate,
+			"reason": reason,
+		}
+		self._current = []
+		self.decisions.append(decision)
+		logger.info(
+			"Download controller: %s -> fragments=%d items=%d (%.0f B/s, %.0f%% errors)",
+			reason, self.fragments, self.items, decision["throughput"], error_rate * 100,
+		)
+		return decision
+
+
+class ItemLogger:
+	"""
+	yt-dlp logger that forwards to the dev logger and keeps errors and throttle hints for the controller.
+	"""
+
+	def __init__(self):
+		self.errors: list[str] = []
+		self.throttled = False
+
+	def debug(self, msg):
+		logger.debug(msg)
+
+	def info(self, msg):
+		logger.debug(msg)
+
+	def warning(self, msg):
+		self.throttled = self.throttled or is_throttle(msg)
+		logger.warning(msg)
+
+	def error(self, msg):
+		self.errors.append(msg)
+		self.throttled = self.throttled or is_throttle(msg)
+		logger.error(msg)
+
+
+def download_item(base_opts: dict, url: str, extra_info: dict | None, fragments: int, info: dict | None = None) -> dict:
+	"""
+	Download one item with its own YoutubeDL instance and report what the controller needs.
+	With a prefetched (sanitized) info dict the extraction is skipped and the selected formats
+	are downloaded directly; if that fails the item is extracted afresh ("stale").
+	"""
+	progress = {"bytes": 0, "seconds": 0.0, "postprocess_seconds": 0.0}
+	postprocess_started: dict[str, float] = {}
+
+	def hook(status: dict):
+		# elapsed covers only the byte transfer, not extraction or postprocessing
+		if status.get("status") == "finished":
+			progress["bytes"] += status.get("total_bytes") or status.get("downloaded_bytes") or 0
+			progress["seconds"] += status.get("elapsed") or 0.0
+
+	def postprocess_hook(status: dict):
+		# Merge, extract-audio and transcode steps, timed from start to finish of each
+		name = status.get("postprocessor")
+		if status.get("status") == "started":
+			postprocess_started[name] = time.monotonic()
+		elif status.get("status") == "finished" and name in postprocess_started:
+			progress["postprocess_seconds"] += time.monotonic() - postprocess_started.pop(name)
+
+	item_logger = ItemLogger()
+	opts = {
+		**base_opts,
+		"concurrent_fragment_downloads": fragments,
+		"progress_hooks": [*base_opts.get("progress_hooks", []), hook],
+		"postprocessor_hooks": [*base_opts.get("postprocessor_hooks", []), postprocess_hook],
+		"logger": item_logger,
+	}
+	started = time.monotonic()
+	cache = "miss"
+	result = None
+	if info is not None:
+		cache = "hit"
+		try:
+			with YoutubeDL(opts) as ydl:
+				# Same path as --load-info-json: format selection is already in the info
+				result = ydl.process_ie_result({**info, **(extra_info or {})}, download=True)
+		except Exception as e:
+			logger.warning("Prefetched info for %s failed, extracting again: %s", url, e)
+		if result is None or item_logger.errors:
+			cache = "stale"
+			result = None
+			progress.update(bytes=0, seconds=0.0, postprocess_seconds=0.0)
+			item_logger.errors.clear()
+	if result is None:
+		try:
+			with YoutubeDL(opts) as ydl:
+				result = ydl.extract_info(url, download=True, extra_info=extra_info or {})
+		except Exception as e:
+			item_logger.error(str(e))
+
+	error = item_logger.errors[-1] if item_logger.errors else None
+	return {
+		"url": url,
+		"info": result,
+		"cache": cache,
+		"bytes": progress["bytes"],
+		"seconds": progress["seconds"] or (time.monotonic() - started),
+		"postprocess_seconds": progress["postprocess_seconds"],
+		"error": error,
+		"throttled": item_logger.throttled,
+	}
+
+
+def _attempt(url: str, extra_info: dict | None, fragments: int, arm: tuple[str, str], opts: dict, info: dict | None) -> dict:
+	return download_item(opts, url, extra_info, fragments, info)
+
+
+def download_items(
+	base_opts: dict,
+	jobs: Iterable[tuple],
+	controller: DownloadController,
+	strategy=None,
+) -> Iterator[dict]:
+	"""
+	Download (url, extra_info) or (url, extra_info, prefetched_info) jobs with as many items
+	in flight as the controller allows, feeding each result back to it. Yields outcomes in
+	completion order. A WAIT from the jobs iterator holds off new items until one finishes.
+	With a strategy.ClientStrategy, each item goes through its client/format failover.
+	"""
+	jobs = iter(jobs)
+	exhausted = False
+	running = set()
+	with ThreadPoolExecutor(max_workers=controller.max_items) as pool:
+		while True:
+			while not exhausted and len(running) < controller.items:
+				job = next(jobs, None)
+				if job is None:
+					exhausted = True
+					break
+				if job is WAIT:
+					if running:
+						break
+					continue
+				if strategy is None:
+					running.add(pool.submit(download_item, base_opts, job[0], job[1], controller.fragments, *job[2:]))
+				else:
+					running.add(pool.submit(strategy.run, partial(_attempt, job[0], job[1], controller.fragments), base_opts, *job[2:]))
+			if not running:
+				break
+			done, running = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				outcome = future.result()
+				controller.observe(outcome["bytes"], outcome["seconds"], outcome["error"], outcome["throttled"])
+				yield outcome
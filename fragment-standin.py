@@ -0,0 +1,139 @@
+"""
+Exercise the adaptive download controller against a local HTTP stand-in for fragmented media.
+
+Serves HLS playlists (/item<N>.m3u8) whose segments are rate-limited per connection,
+share a global link cap, and answer 429 when too many requests are in flight. Then downloads
+every item through download_control.download_items and prints the controller's decisions.
+
+Usage: python fragment-standin.py [--items 12] [--segments 20] [--segment-kb 256]
+                                  [--conn-kbps 400] [--link-kbps 3000] [--throttle-at 10]
+"""
+import argparse
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from download_control import DownloadController, download_items
+
+
+class StandIn:
+	def __init__(self, segments: int, segment_kb: int, conn_kbps: int, link_kbps: int, throttle_at: int):
+		self.segments = segments
+		self.segment = bytes(segment_kb * 1024)
+		self.conn_rate = conn_kbps * 1024
+		self.link_rate = link_kbps * 1024
+		self.throttle_at = throttle_at
+		self.in_flight = 0
+		self.throttled = 0
+		self.lock = threading.Lock()
+
+	def playlist(self) -> bytes:
+		lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+		for i in range(self.segments):
+			lines += ["#EXTINF:2.0,", f"seg{i}.ts"]
+		lines.append("#EXT-X-ENDLIST")
+		return ("\n".join(lines) + "\n").encode()
+
+	def segment_delay(self) -> float:
+		# Each connection gets at most conn_rate; all connections share link_rate
+		with self.lock:
+			share = self.link_rate / max(self.in_flight, 1)
+		return len(self.segment) / min(self.conn_rate, share)
+
+	def handler(self):
+		standin = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def log_message(self, *args):
+				pass
+
+			def do_GET(self):
+				if self.path.endswith(".m3u8"):
+					body = standin.playlist()
+					self.send_response(200)
+					self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+					self.send_header("Content-Length", str(len(body)))
+					self.end_headers()
+					self.wfile.write(body)
+					return
+
+				with standin.lock:
+					standin.in_flight += 1
+					over = standin.in_flight > standin.throttle_at
+				try:
+					if over:
+						with standin.lock:
+							standin.throttled += 1
+						self.send_response(429)
+						self.send_header("Content-Length", "0")
+						self.end_headers()
+						return
+					time.sleep(standin.segment_delay())
+					self.send_response(200)
+					self.send_header("Content-Type", "video/mp2t")
+					self.send_header("Content-Length", str(len(standin.segment)))
+					self.end_headers()
+					self.wfile.write(standin.segment)
+				finally:
+					with standin.lock:
+						standin.in_flight -= 1
+
+		return Handler
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--items", type=int, default=12)
+	parser.add_argument("--segments", type=int, default=20)
+	parser.add_argument("--segment-kb", type=int, default=256)
+	parser.add_argument("--conn-kbps", type=int, default=400, help="per-connection rate cap")
+	parser.add_argument("--link-kbps", type=int, default=3000, help="shared link rate cap")
+	parser.add_argument("--throttle-at", type=int, default=10, help="in-flight requests that trigger 429s")
+	parser.add_argument("--max-fragments", type=int, default=8)
+	parser.add_argument("--max-items", type=int, default=3)
+	args = parser.parse_args()
+
+	standin = StandIn(args.segments, args.segment_kb, args.conn_kbps, args.link_kbps, args.throttle_at)
+	server = ThreadingHTTPServer(("127.0.0.1", 0), standin.handler())
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+	controller = DownloadController(max_fragments=args.max_fragments, max_items=args.max_items)
+	with tempfile.TemporaryDirectory(prefix="fragment-standin-") as tmp:
+		base_opts = {
+			"outtmpl": str(Path(tmp) / "%(id)s.%(ext)s"),
+			"format": "best",
+			"fixup": "never",
+			"retries": 0,
+			"fragment_retries": 2,
+			"skip_unavailable_fragments": False,
+			"quiet": True,
+			"noprogress": True,
+		}
+		jobs = [(f"{base_url}/item{i}.m3u8", None) for i in range(args.items)]
+		started = time.monotonic()
+		total = 0
+		for outcome in download_items(base_opts, jobs, controller):
+			total += outcome["bytes"]
+			status = "error" if outcome["error"] else "ok"
+			print(
+				f"{outcome['url'].rsplit('/', 1)[-1]:<12} {status:<5} {outcome['bytes'] / 1024:>8.0f} KiB "
+				f"{outcome['seconds']:>6.2f}s  fragments={controller.fragments} items={controller.items}"
+			)
+		elapsed = time.monotonic() - started
+	server.shutdown()
+
+	print(f"\n{total / 1024 / 1024:.1f} MiB in {elapsed:.1f}s ({total / 1024 / elapsed:.0f} KiB/s), "
+		f"{standin.throttled} throttled requests")
+	print("decisions:")
+	for decision in controller.decisions:
+		print(
+			f"  {decision['reason']:<9} fragments={decision['fragments']} items={decision['items']} "
+			f"throughput={decision['throughput'] / 1024:.0f} KiB/s errors={decision['error_rate']:.0%}"
+		)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,292 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import subprocess
+import time
+from contextlib import closing
+from pathlib import Path
+
+from yt_dlp.version import __version__ as YT_DLP_VERSION
+
+import lanes
+import storage
+
+logger = logging.getLogger("dev")
+
+# Seconds between probe cycles; requests only ever read the last cycle's result
+HEALTH_INTERVAL = float(os.getenv("YTDL_HEALTH_INTERVAL", "15"))
+# Binary versions only change on deploy, so they are re-read far less often
+VERSION_INTERVAL = float(os.getenv("YTDL_HEALTH_VERSION_INTERVAL", "3600"))
+# Readiness fails above these: dispatchable fair-share items, messages waiting in the broker,
+# and milliseconds for a trivial SQLite query
+MAX_QUEUED = int(os.getenv("YTDL_HEALTH_MAX_QUEUED", "1000"))
+MAX_BROKER_DEPTH = int(os.getenv("YTDL_HEALTH_MAX_BROKER_DEPTH", "1000"))
+MAX_DB_MS = float(os.getenv("YTDL_HEALTH_MAX_DB_MS", "1000"))
+
+# Per-probe limits, so one hung dependency cannot stall the whole cycle
+COMMAND_TIMEOUT = 5
+DB_TIMEOUT = 2
+BROKER_TIMEOUT = 2
+# A result older than this many intervals means the probe loop itself is stuck
+STALE_CYCLES = 3
+
+# Missing any of these answers the healthcheck with DEP_MISSING; rsync only matters for
+# migrations between machines and is reported without failing it
+REQUIRED_DEPENDENCIES = ("yt_dlp", "ffmpeg")
+VERSION_COMMANDS = {
+	"ffmpeg": ("ffmpeg", "-version"),
+	"rsync": ("rsync", "--version"),
+}
+
+PROBE_FILE = ".health-probe"
+
+
+def _serialize(status_code: int, body: dict) -> tuple[int, bytes]:
+	return status_code, json.dumps(body, separators=(",", ":")).encode()
+
+
+def command_version(command: tuple[str, ...]) -> str | None:
+	"""
+	First line of a binary's version output, None if it is not installed or does not answer.
+	"""
+	if shutil.which(command[0]) is None:
+		return None
+	try:
+		result = subprocess.run(command, capture_output=True, text=True, timeout=COMMAND_TIMEOUT)
+	except (OSError, subprocess.TimeoutExpired):
+		return None
+	lines = result.stdout.strip().splitlines()
+	return lines[0] if result.returncode == 0 and lines else None
+
+
+def probe_storage(data_root: Path) -> dict:
+	"""
+	Write, fsync and remove a small file on the data volume, and read its free space.
+	"""
+	started = time.perf_counter()
+	path = Path(data_root) / f"{PROBE_FILE}-{os.getpid()}"
+	try:
+		with open(path, "wb") as f:
+			f.write(b"ok")
+			f.flush()
+			os.fsync(f.fileno())
+		path.unlink()
+		writable, error = True, None
+	except OSError as e:
+		path.unlink(missing_ok=True)
+		writable, error = False, str(e)
+	try:
+		usage = shutil.disk_usage(data_root)
+		total, free = usage.total, usage.free
+	except OSError as e:
+		total = free = None
+		error = error or str(e)
+	return {
+		"writable": writable,
+		"total": total,
+		"free": free,
+		"write_ms": round((time.perf_counter() - started) * 1000, 3),
+		"error": error,
+	}
+
+
+def probe_database(db_path: Path, node: str) -> dict:
+	"""
+	Round-trip latency of a trivial query, plus job figures and the node's reservations read on the same connection.
+	"""
+	now = int(time.time())
+	try:
+		with closing(sqlite3.connect(db_path, timeout=DB_TIMEOUT)) as conn:
+			started = time.perf_counter()
+			conn.execute("SELECT 1").fetchone()
+			latency_ms = (time.perf_counter() - started) * 1000
+			jobs = dict(conn.execute("SELECT state, COUNT(*) FROM work_queue GROUP BY state").fetchall())
+			queued, oldest = conn.execute(
+				"""
+				SELECT COUNT(*), MIN(created_at) FROM work_queue
+				WHERE state = 'queued' AND (not_before IS NULL OR not_before <= ?)
+				""",
+				(now,),
+			).fetchone()
+			last_finished, finished_day, bytes_day = conn.execute(
+				"SELECT MAX(finished_at), COUNT(*), TOTAL(bytes) FROM work_queue WHERE state = 'done' AND finished_at >= ?",
+				(now - 86400,),
+			).fetchone()
+			reserved = conn.execute(
+				"SELECT TOTAL(bytes) FROM disk_reservation WHERE node = ? AND created_at >= ?",
+				(node, now - storage.RESERVATION_TTL),
+			).fetchone()[0]
+			nodes = [row[0] for row in conn.execute("SELECT name FROM node WHERE active = 1 ORDER BY name")]
+	except sqlite3.Error as e:
+		return {"ok": False, "error": str(e)}
+	return {
+		"ok": True,
+		"latency_ms": round(latency_ms, 3),
+		"reserved": int(reserved),
+		"nodes": nodes,
+		"last_jobs": {
+			"queued": jobs.get("queued", 0),
+			"dispatchable": queued,
+			"running": jobs.get("running", 0),
+			"done_24h": finished_day,
+			"bytes_24h": int(bytes_day),
+			"oldest_queued_seconds": now - oldest if oldest else 0,
+			"last_finished_at": last_finished,
+		},
+	}
+
+
+def probe_broker(celery, queues: list[str]) -> dict:
+	"""
+	Connect to the broker with a short timeout and read the depth of the given queues.
+	"""
+	started = time.perf_counter()
+	try:
+		with celery.connection_for_read(connect_timeout=BROKER_TIMEOUT) as conn:
+			conn.connect()
+			latency_ms = (time.perf_counter() - started) * 1000
+			depth = {}
+			for queue in queues:
+				try:
+					depth[queue] = conn.default_channel.queue_declare(queue=queue, passive=True).message_count
+				except Exception:
+					# Not declared yet: nothing was ever sent to it
+					depth[queue] = 0
+	except Exception as e:
+		return {"ok": False, "error": str(e)}
+	return {"ok": True, "latency_ms": round(latency_ms, 3), "depth": depth, "total": sum(depth.values())}
+
+
+class HealthMonitor:
+	"""
+	Probes dependencies, storage, SQLite and the broker on a background interval and keeps
+	the answers to the health endpoints as ready-made (status, body) pairs.
+
+	Requests never probe anything: a load balancer polling /health/ready every second costs
+	one attribute read, not an ffmpeg process and a broker round-trip. The probes run in a
+	thread so a slow disk or an unreachable broker does not hold up the event loop.
+	"""
+
+	def __init__(self, data_root: Path, db_path: Path, celery, node: str, app_version: str, interval: float = HEALTH_INTERVAL):
+		self.data_root = Path(data_root)
+		self.db_path = Path(db_path)
+		self.celery = celery
+		# Node whose data volume data_root is; only its reservations count against the free space
+		self.node = node
+		self.app_version = app_version
+		self.interval = interval
+		self.versions: dict[str, str | None] = {}
+		self.versions_at = 0.0
+		self.probed_at: float | None = None
+		self.result: dict = {}
+		self._task: asyncio.Task | None = None
+
+		self.live = _serialize(200, {"status": "alive"})
+		starting = _serialize(503, {"status": "starting", "checks": {}})
+		self.ready = starting
+		self.report = starting
+		self._stale = _serialize(503, {"status": "stale", "reason": "health probes have not completed recently"})
+
+	def readiness(self) -> tuple[int, bytes]:
+		# The only per-request work: the loop may be wedged on a hung mount
+		if self.probed_at is not None and time.monotonic() - self.probed_at > STALE_CYCLES * max(self.interval, 1):
+			return self._stale
+		return self.ready
+
+	def probe(self) -> dict:
+		"""
+		One blocking probe cycle.
+		"""
+		if not self.versions or time.monotonic() - self.versions_at >= VERSION_INTERVAL:
+			self.versions = {"app": self.app_version, "yt_dlp": YT_DLP_VERSION}
+			for name, command in VERSION_COMMANDS.items():
+				self.versions[name] = command_version(command)
+			self.versions_at = time.monotonic()
+
+		database = probe_database(self.db_path, self.node)
+		queues = lanes.queues(None) + [q for node in database.get("nodes", []) for q in lanes.queues(node)]
+		return {
+			"versions": dict(self.versions),
+			"storage": probe_storage(self.data_root),
+			"database": database,
+			"broker": probe_broker(self.celery, queues),
+		}
+
+	def publish(self, result: dict):
+		"""
+		Turn a probe cycle into the endpoint responses.
+		"""
+		database, disk, broker = result["database"], result["storage"], result["broker"]
+		jobs = database.get("last_jobs", {})
+		available = None
+		if disk["free"] is not None:
+			available = disk["free"] - database.get("reserved", 0) - storage.LOW_WATER_BYTES
+		disk = {**disk, "low_water": storage.LOW_WATER_BYTES, "available": available}
+
+		checks = {
+			"database": database["ok"] and database["latency_ms"] <= MAX_DB_MS,
+			"storage": disk["writable"] and available is not None and available > 0,
+			"broker": broker["ok"],
+			"backlog": jobs.get("dispatchable", 0) <= MAX_QUEUED and broker.get("total", 0) <= MAX_BROKER_DEPTH,
+		}
+		ready = all(checks.values())
+		checked_at = int(time.time())
+		self.ready = _serialize(200 if ready else 503, {
+			"status": "ready" if ready else "unready",
+			"checks": checks,
+			"checked_at": checked_at,
+		})
+
+		versions = result["versions"]
+		missing = [name for name in REQUIRED_DEPENDENCIES if not versions.get(name)]
+		# Unauthenticated: node names and per-node queues stay out (see /api/manage/nodes and /lanes)
+		database_report = {k: v for k, v in database.items() if k not in ("last_jobs", "nodes")}
+		broker_report = {k: v for k, v in broker.items() if k != "depth"}
+		body = {
+			"service": "ok" if ready else "degraded",
+			"versions": versions,
+			"last_jobs": jobs,
+			"checks": checks,
+			"storage": disk,
+			"database": database_report,
+			"broker": broker_report,
+			"limits": {"max_queued": MAX_QUEUED, "max_broker_depth": MAX_BROKER_DEPTH, "max_db_ms": MAX_DB_MS},
+			"checked_at": checked_at,
+		}
+		if missing:
+			self.report = _serialize(501, {"error": {
+				"code": "DEP_MISSING",
+				"message": f"Missing dependencies: {', '.join(missing)}",
+				"details": body,
+			}})
+		else:
+			self.report = _serialize(200, body)
+		self.result = result
+		self.probed_at = time.monotonic()
+
+	async def run(self):
+		while True:
+			try:
+				self.publish(await asyncio.to_thread(self.probe))
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				logger.exception("Health probe failed")
+			await asyncio.sleep(self.interval)
+
+	def start(self) -> asyncio.Task:
+		self._task = asyncio.create_task(self.run())
+		return self._task
+
+	async def stop(self):
+		if self._task is None:
+			return
+		self._task.cancel()
+		try:
+			await self._task
+		except asyncio.CancelledError:
+			pass
+		self._task = None
@@ -1,5 +1,6 @@
 
 # Helper functions for initialization
+import json
 import logging
 import os
 import re
@@ -8,15 +9,63 @@ from pathlib import Path
 from urllib.parse import urlparse, parse_qs
 from fastapi import HTTPException
 from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor import MetadataParserPP
 from yt_dlp.utils import DownloadError
 
-def get_ydl_opts(root_dir: Path, playlist_folder: bool = True):
+import strategy
+
+# Per-playlist download policy (see `policy` in plan.py).
+#   format: "mp3" re-encodes to 192k MP3, "passthrough" keeps the source audio stream and only remuxes
+#   audio_only: extract audio; when False the best video+audio is merged without re-encoding
+#   write_metadata: embed title/artist tags and the youtube_id/playlist_id comment
+DEFAULT_POLICY = {
+	"format": "mp3",
+	"audio_only": True,
+	"write_metadata": True,
+}
+POLICY_FORMATS = ("mp3", "passthrough")
+
+def normalize_policy(policy: dict | str | None) -> dict:
+	"""
+	Merge a stored or user-supplied policy over the defaults and validate it.
+	Accepts the JSON string stored in the playlist table. Raises ValueError on invalid policies.
+	"""
+	if isinstance(policy, str):
+		try:
+			policy = json.loads(policy)
+		except json.JSONDecodeError as exc:
+			raise ValueError(f"Invalid policy JSON: {exc}")
+	policy = policy or {}
+	unknown = set(policy) - set(DEFAULT_POLICY)
+	if unknown:
+		raise ValueError(f"Unknown policy keys: {', '.join(sorted(unknown))}")
+
+	merged = {**DEFAULT_POLICY, **{k: v for k, v in policy.items() if v is not None}}
+	if merged["format"] not in POLICY_FORMATS:
+		raise ValueError(f"Invalid policy format: {merged['format']}")
+	merged["audio_only"] = bool(merged["audio_only"])
+	merged["write_metadata"] = bool(merged["write_metadata"])
+	if not merged["audio_only"] and merged["format"] == "mp3":
+		raise ValueError("Format mp3 requires audio_only")
+	return merged
+
+def policy_key(policy: dict | str | None) -> str:
+	"""
+	Short stable name for a policy; keeps differently encoded copies of a playlist apart on disk.
+	"""
+	policy = normalize_policy(policy)
+	key = policy["format"] if policy["audio_only"] else f"{policy['format']}-video"
+	return key if policy["write_metadata"] else f"{key}-nometa"
+
+def get_ydl_opts(root_dir: Path, playlist_folder: bool = True, policy: dict | None = None):
 	"""
 	Returns a ytdlp opt dictionary for a specified root folder. Root_dir must be a Path object.
 	If playlist_folder is True, files for a playlist will be placed into a subfolder named after the playlist.
-	Embeds the video id and playlist id into the file metadata (comment tag).
+	The postprocessor chain follows the download policy (defaults to DEFAULT_POLICY).
+	With write_metadata, embeds the video id and playlist id into the file metadata (comment tag).
 	"""
 	root_dir = Path(root_dir)
+	policy = normalize_policy(policy)
 	# create directory if missing
 	if not root_dir.exists():
 		root_dir.mkdir(parents=True, exist_ok=True)
@@ -35,12 +84,8 @@ def get_ydl_opts(root_dir: Path, playlist_folder: bool = True):
 		'format': 'bestaudio/best',
 		'outtmpl': outtmpl,
 
-		# Most important for current YouTube/SABR issues
-		'extractor_args': {
-			'youtube': {
-				'player_client': ['default', '-android_sdkless'],
-			}
-		},
+		# Most important for current YouTube/SABR issues; sync reorders clients by success (strategy.py)
+		'extractor_args': strategy.extractor_args(),
 
 		# Playlist reliability
 		'ignoreerrors': True,
@@ -50,21 +95,44 @@ def get_ydl_opts(root_dir: Path, playlist_folder: bool = True):
 		'concurrent_fragment_downloads': 1,
 		'sleep_interval': 1,
 		'max_sleep_interval': 5,
-
-		'postprocessors': [{
-			'key': 'FFmpegExtractAudio',
-			'preferredcodec': 'mp3',
-			'preferredquality': '192',
-		}],
-
-		# Prefer mapping args to the specific PP
-		'postprocessor_args': {
-			'FFmpegExtractAudio': [
-				'-metadata', 'comment=youtube_id=%(id)s; playlist_id=%(playlist_id)s'
-			]
-		},
 	}
 
+	postprocessors = []
+	if policy["audio_only"]:
+		ydl_opts['format'] = 'bestaudio[protocol!=m3u8_native][protocol!=m3u8]/bestaudio/best'
+		if policy["format"] == "mp3":
+			postprocessors.append({
+				'key': 'FFmpegExtractAudio',
+				'preferredcodec': 'mp3',
+				'preferredquality': '192',
+			})
+		else:
+			# "best" copies the audio stream into its natural container (opus/m4a/...) without re-encoding
+			postprocessors.append({
+				'key': 'FFmpegExtractAudio',
+				'preferredcodec': 'best',
+			})
+	else:
+		ydl_opts['format'] = 'bestvideo*+bestaudio/best'
+		ydl_opts['merge_output_format'] = 'mkv'
+
+	if policy["write_metadata"]:
+		# meta_comment is picked up by FFmpegMetadata and written as the comment tag
+		postprocessors.append({
+			'key': 'MetadataParser',
+			'when': 'pre_process',
+			'actions': [(
+				MetadataParserPP.Actions.INTERPRET,
+				'youtube_id=%(id)s; playlist_id=%(playlist_id)s',
+				'(?P<meta_comment>.+)',
+			)],
+		})
+		postprocessors.append({
+			'key': 'FFmpegMetadata',
+			'add_metadata': True,
+		})
+
+	ydl_opts['postprocessors'] = postprocessors
 	return ydl_opts
 
 # def validate_playlist_url(url: str) -> bool:
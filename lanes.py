@@ -0,0 +1,164 @@
+import os
+import time
+
+import aiosqlite
+
+import sharding
+
+# Celery lanes, highest first, with their broker priority. With the Redis transport a lower
+# number is served first (each step is its own list, polled in step order)
+LANES = {
+	# Listings and checks a user is waiting on (playlist added or update requested)
+	"interactive": 0,
+	# Downloads of a newly added playlist and of user-requested updates
+	"first_sync": 2,
+	# The nightly scan and the per-playlist listings it fans out
+	"scheduled_scan": 4,
+	# Routine syncs, prefetch and migrations
+	"bulk_download": 6,
+	# GC, dedup, metadata packing, reindex, backfills
+	"maintenance": 9,
+}
+PRIORITY_STEPS = sorted(set(LANES.values()))
+
+# Fair-share scheduler lane -> Celery lane its syncs are sent on
+SCHEDULER_LANES = {"priority": "first_sync", "routine": "bulk_download"}
+
+# Lanes served by reserved workers, which take nothing else
+RESERVED_LANES = ("interactive", "first_sync")
+# Reserved workers per node; the scheduler dispatches this many extra priority syncs
+RESERVED_WORKERS = int(os.getenv("YTDL_RESERVED_WORKERS", "1"))
+# Lanes this worker consumes (comma-separated; unset: all)
+WORKER_LANES = tuple(lane for lane in os.getenv("YTDL_WORKER_LANES", ",".join(LANES)).split(",") if lane in LANES)
+
+# Upper bounds (seconds) of the wait-time histogram; longer waits fall in "over"
+WAIT_BOUNDS = (1, 10, 60, 300, 1800, 7200)
+WAIT_COLUMNS = tuple(f"le_{bound}" for bound in WAIT_BOUNDS) + ("over",)
+BUCKET_SECONDS = 3600
+# Hourly wait buckets older than this are dropped
+WAIT_HISTORY = 30 * 86400
+
+LANE_SCHEMA = (
+	f"""
+	CREATE TABLE IF NOT EXISTS lane_wait (
+		bucket INTEGER NOT NULL,
+		lane TEXT NOT NULL,
+		node TEXT NOT NULL,
+		tasks INTEGER NOT NULL DEFAULT 0,
+		total_seconds REAL NOT NULL DEFAULT 0,
+		max_seconds REAL NOT NULL DEFAULT 0,
+		{", ".join(f"{column} INTEGER NOT NULL DEFAULT 0" for column in WAIT_COLUMNS)},
+		PRIMARY KEY (bucket, lane, node)
+	)
+	""",
+)
+
+
+async def init_lanes(db: aiosqlite.Connection):
+	"""
+	Create the per-lane wait counters if missing. Does not commit.
+	"""
+	for statement in LANE_SCHEMA:
+		await db.execute(statement)
+
+
+def queue(lane: str, node: str | None = None) -> str:
+	"""
+	The lane's queue on a node, or on the shared default queue without one.
+	"""
+	if lane not in LANES:
+		raise ValueError(f"Unknown lane: {lane}")
+	return f"{sharding.node_queue(node)}.{lane}"
+
+
+def queues(node: str | None = None, lanes=tuple(LANES)) -> list[str]:
+	"""
+	Queues of the given lanes, highest lane first (the order workers should poll them in).
+	"""
+	return [queue(lane, node) for lane in sorted(lanes, key=LANES.__getitem__)]
+
+
+def route(lane: str, node: str | None = None) -> dict:
+	"""
+	apply_async options that send a task on a lane.
+	"""
+	return {"queue": queue(lane, node), "priority": LANES[lane]}
+
+
+def lane_of(queue_name: str | None) -> str | None:
+	lane = (queue_name or "").rpartition(".")[2]
+	return lane if lane in LANES else None
+
+
+def wait_statements(lane: str, node: str, seconds: float) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that adds one task's queue wait to the current hourly bucket.
+	"""
+	seconds = max(seconds, 0.0)
+	column = next((c for bound, c in zip(WAIT_BOUNDS, WAIT_COLUMNS) if seconds <= bound), "over")
+	bucket = int(time.time()) // BUCKET_SECONDS * BUCKET_SECONDS
+	return [(
+		f"""
+		INSERT INTO lane_wait (bucket, lane, node, tasks, total_seconds, max_seconds, {column})
+		VALUES (?, ?, ?, 1, ?, ?, 1)
+		ON CONFLICT(bucket, lane, node) DO UPDATE SET
+			tasks = tasks + 1,
+			total_seconds = total_seconds + excluded.total_seconds,
+			max_seconds = MAX(max_seconds, excluded.max_seconds),
+			{column} = {column} + 1
+		""",
+		[(bucket, lane, node, seconds, seconds)],
+	)]
+
+
+def wait_percentile(counts: list[int], max_seconds: float, q: float) -> float | None:
+	"""
+	Upper bound of the histogram bucket holding the q-th percentile wait.
+	"""
+	total = sum(counts)
+	if not total:
+		return None
+	rank = q / 100 * total
+	seen = 0
+	for bound, count in zip((*WAIT_BOUNDS, None), counts):
+		seen += count
+		if seen >= rank:
+			return min(bound, max_seconds) if bound is not None else max_seconds
+	return max_seconds
+
+
+async def wait_summary(db: aiosqlite.Connection, hours: int = 24, node: str | None = None) -> list[dict]:
+	"""
+	Per-lane queue waits over the last `hours`: tasks, mean, max and estimated percentiles.
+	Drops buckets older than WAIT_HISTORY. Commits.
+	"""
+	now = int(time.time())
+	await db.execute("DELETE FROM lane_wait WHERE bucket < ?", (now - WAIT_HISTORY,))
+	await db.commit()
+	cur = await db.execute(
+		f"""
+		SELECT lane, SUM(tasks), TOTAL(total_seconds), MAX(max_seconds), {", ".join(f"SUM({c})" for c in WAIT_COLUMNS)}
+		FROM lane_wait WHERE bucket >= ? AND (? IS NULL OR node = ?)
+		GROUP BY lane
+		""",
+		(now - hours * 3600, node, node),
+	)
+	found = {row[0]: row for row in await cur.fetchall()}
+	items = []
+	for lane, priority in LANES.items():
+		row = found.get(lane)
+		tasks, total, longest = (row[1], row[2], row[3]) if row else (0, 0.0, None)
+		counts = list(row[4:]) if row else [0] * len(WAIT_COLUMNS)
+		items.append({
+			"lane": lane,
+			"priority": priority,
+			"reserved": lane in RESERVED_LANES,
+			"tasks": tasks,
+			"mean_seconds": total / tasks if tasks else None,
+			"max_seconds": longest,
+			"p50_seconds": wait_percentile(counts, longest or 0.0, 50),
+			"p95_seconds": wait_percentile(counts, longest or 0.0, 95),
+			"p99_seconds": wait_percentile(counts, longest or 0.0, 99),
+			"histogram": dict(zip(WAIT_COLUMNS, counts)),
+		})
+	return items
@@ -0,0 +1,288 @@
+"""
+Load-test the API in-process: main.app under uvicorn with a fake playlist check, an
+in-memory Celery broker and a temporary database seeded with users and playlists.
+
+Drives a weighted mix of list / add / deactivate / check_access / scan requests at each
+concurrency level for a fixed duration, then prints p50/p95/p99 latency and throughput
+per endpoint. With --baseline, exits 1 if any endpoint's p95 rose or its throughput fell
+by more than --tolerance against the saved results (--write-baseline saves them).
+
+The fake check sleeps (blocking, like yt-dlp) for --extractor-latency seconds.
+
+Usage: python loadtest.py [--users 50] [--playlists 500] [--concurrency 8,32,128]
+                          [--duration 15] [--mix list=50,add=15,deactivate=10,check_access=15,scan=10]
+                          [--extractor-latency 0.05] [--baseline loadtest-baseline.json]
+                          [--write-baseline] [--tolerance 0.25]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import string
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+REPO = Path(__file__).resolve().parent
+PASSKEY = "loadtest"
+ENDPOINTS = ("list", "add", "deactivate", "check_access", "scan")
+
+
+def random_playlist_id(rng: random.Random) -> str:
+	return "PL" + "".join(rng.choices(string.ascii_letters + string.digits + "_-", k=32))
+
+
+def playlist_url(playlist_id: str) -> str:
+	return f"https://www.youtube.com/playlist?list={playlist_id}"
+
+
+def parse_mix(text: str) -> dict[str, int]:
+	mix = {}
+	for part in text.split(","):
+		name, _, weight = part.partition("=")
+		if name not in ENDPOINTS:
+			raise SystemExit(f"Unknown endpoint in mix: {name}")
+		mix[name] = int(weight)
+	return mix
+
+
+class Pool:
+	"""
+	Playlists the workers know about, split by whether they are currently active.
+	"""
+
+	def __init__(self, active: list[tuple[str, str]], users: list[str]):
+		self.active = active
+		self.inactive: list[tuple[str, str]] = []
+		self.users = users
+		self.lock = threading.Lock()
+
+	def take_active(self, rng: random.Random) -> tuple[str, str] | None:
+		with self.lock:
+			if not self.active:
+				return None
+			index = rng.randrange(len(self.active))
+			self.active[index], self.active[-1] = self.active[-1], self.active[index]
+			return self.active.pop()
+
+	def take_inactive(self, rng: random.Random) -> tuple[str, str] | None:
+		with self.lock:
+			if not self.inactive:
+				return None
+			return self.inactive.pop(rng.randrange(len(self.inactive)))
+
+	def put(self, item: tuple[str, str], active: bool):
+		with self.lock:
+			(self.active if active else self.inactive).append(item)
+
+
+def seed(db_path: Path, users: int, playlists: int, rng: random.Random) -> Pool:
+	names = [f"user{i}" for i in range(users)]
+	rows = [(random_playlist_id(rng), names[i % users]) for i in range(playlists)]
+	policy = json.dumps({"format": "mp3", "audio_only": True, "write_metadata": True})
+	with sqlite3.connect(db_path) as conn:
+		conn.executemany(
+			"INSERT INTO user (name, display_name, admin) VALUES (?, ?, ?)",
+			[(name, name.title(), int(i == 0)) for i, name in enumerate(names)],
+		)
+		conn.executemany(
+			"INSERT INTO playlist (playlist_id, name, owner, policy) VALUES (?, ?, ?, ?)",
+			[(pid, f"Playlist {pid[-6:]}", owner, policy) for pid, owner in rows],
+		)
+	return Pool(rows, names)
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, params: dict) -> int:
+	conn.request(method, f"{path}?{urlencode(params)}")
+	response = conn.getresponse()
+	response.read()
+	return response.status
+
+
+def run_op(op: str, conn: http.client.HTTPConnection, pool: Pool, rng: random.Random) -> int:
+	if op == "list":
+		owner = rng.choice(pool.users)
+		return request(conn, "GET", "/api/playlist/get_all", {"owner": owner, "include_all": owner == "user0"})
+	if op == "check_access":
+		return request(conn, "GET", "/api/playlist/check_access", {"url": playlist_url(random_playlist_id(rng))})
+	if op == "scan":
+		return request(conn, "POST", "/api/tasks/scan", {})
+	if op == "deactivate":
+		item = pool.take_active(rng)
+		if item is None:
+			return 0
+		status = request(conn, "DELETE", f"/api/playlist/deactivate/{item[0]}", {"owner": item[1]})
+		pool.put(item, active=status != 200)
+		return status
+	# add: half the time bring back a deactivated playlist, otherwise a new one
+	item = pool.take_inactive(rng) if rng.random() < 0.5 else None
+	item = item or (random_playlist_id(rng), rng.choice(pool.users))
+	status = request(conn, "PUT", "/api/playlist/add", {"url": playlist_url(item[0]), "owner": item[1]})
+	pool.put(item, active=status == 200)
+	return status
+
+
+def drive(port: int, pool: Pool, mix: dict[str, int], concurrency: int, duration: float, seed_value: int) -> dict:
+	samples: dict[str, list[float]] = {op: [] for op in mix}
+	errors: dict[str, int] = {op: 0 for op in mix}
+	lock = threading.Lock()
+	ops, weights = zip(*mix.items())
+	deadline = time.monotonic() + duration
+
+	def worker(index: int):
+		rng = random.Random(seed_value * 1000 + index)
+		conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+		local = {op: [] for op in ops}
+		local_errors = {op: 0 for op in ops}
+		while time.monotonic() < deadline:
+			op = rng.choices(ops, weights)[0]
+			started = time.perf_counter()
+			try:
+				status = run_op(op, conn, pool, rng)
+			except (OSError, http.client.HTTPException):
+				conn.close()
+				conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+				status = 599
+			if status == 0:
+				continue
+			local[op].append(time.perf_counter() - started)
+			if status >= 500:
+				local_errors[op] += 1
+		conn.close()
+		with lock:
+			for op in ops:
+				samples[op] += local[op]
+				errors[op] += local_errors[op]
+
+	started = time.monotonic()
+	threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.monotonic() - started
+
+	from writebehind import percentile
+
+	results = {}
+	for op, latencies in samples.items():
+		results[op] = {
+			"requests": len(latencies),
+			"errors": errors[op],
+			"p50_ms": percentile(latencies, 50) * 1000,
+			"p95_ms": percentile(latencies, 95) * 1000,
+			"p99_ms": percentile(latencies, 99) * 1000,
+			"rps": len(latencies) / elapsed,
+		}
+	return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+	regressions = []
+	for level, endpoints in results.items():
+		for op, current in endpoints.items():
+			before = baseline.get(level, {}).get(op)
+			if not before or not current["requests"]:
+				continue
+			if current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+				regressions.append(f"c={level} {op}: p95 {before['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms")
+			if current["rps"] < before["rps"] * (1 - tolerance):
+				regressions.append(f"c={level} {op}: throughput {before['rps']:.1f} -> {current['rps']:.1f} req/s")
+			if current["errors"] > before["errors"]:
+				regressions.append(f"c={level} {op}: errors {before['errors']} -> {current['errors']}")
+	return regressions
+
+
+def free_port() -> int:
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--users", type=int, default=50)
+	parser.add_argument("--playlists", type=int, default=500)
+	parser.add_argument("--concurrency", default="8,32,128", help="comma-separated levels, run in order")
+	parser.add_argument("--duration", type=float, default=15.0, help="seconds per concurrency level")
+	parser.add_argument("--mix", default="list=50,add=15,deactivate=10,check_access=15,scan=10")
+	parser.add_argument("--extractor-latency", type=float, default=0.05, help="seconds the fake playlist check blocks")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--baseline", type=Path)
+	parser.add_argument("--write-baseline", action="store_true")
+	parser.add_argument("--tolerance", type=float, default=0.25)
+	args = parser.parse_args()
+	mix = parse_mix(args.mix)
+	levels = [int(level) for level in args.concurrency.split(",")]
+
+	tmp = Path(tempfile.mkdtemp(prefix="ytdl-loadtest-"))
+	os.environ.update({
+		"DB_PATH": str(tmp / "database.db"),
+		"DATA_ROOT_PATH": str(tmp / "data"),
+		"CELERY_BROKER_URL": "memory://",
+		"CELERY_RESULT_BACKEND": "cache+memory://",
+		"PASSKEY": PASSKEY,
+	})
+	# Same logging setup as production, but the log file lands in the temp dir
+	shutil.copy(REPO / "logger_config.yaml", tmp / "logger_config.yaml")
+	os.chdir(tmp)
+	sys.path.insert(0, str(REPO))
+
+	import uvicorn
+	import main as api
+
+	def fake_check_playlist_accessible(url: str) -> dict:
+		time.sleep(args.extractor_latency)
+		playlist_id = url.rsplit("list=", 1)[-1]
+		return {"playlist_id": playlist_id, "title": f"Playlist {playlist_id[-6:]}", "count": 25}
+
+	api.check_playlist_accessible = fake_check_playlist_accessible
+
+	port = free_port()
+	server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+	thread = threading.Thread(target=server.run, daemon=True)
+	thread.start()
+	while not server.started:
+		if not thread.is_alive():
+			raise SystemExit("Server failed to start")
+		time.sleep(0.05)
+
+	pool = seed(Path(os.environ["DB_PATH"]), args.users, args.playlists, random.Random(args.seed))
+	results = {}
+	try:
+		for level in levels:
+			results[str(level)] = drive(port, pool, mix, level, args.duration, args.seed)
+			print(f"\nconcurrency {level}")
+			print(f"  {'endpoint':<13} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+			for op, r in results[str(level)].items():
+				print(
+					f"  {op:<13} {r['requests']:>8} {r['errors']:>6} {r['p50_ms']:>8.1f} "
+					f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['rps']:>8.1f}"
+				)
+	finally:
+		server.should_exit = True
+		thread.join(timeout=10)
+		shutil.rmtree(tmp, ignore_errors=True)
+
+	if args.baseline and args.write_baseline:
+		args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+		print(f"\nBaseline written to {args.baseline}")
+	elif args.baseline:
+		regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+		if regressions:
+			print("\nRegressions against baseline:")
+			for line in regressions:
+				print(f"  {line}")
+			sys.exit(1)
+		print("\nNo regressions against baseline")
+
+
+if __name__ == "__main__":
+	main()
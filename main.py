@@ -1,8 +1,13 @@
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import RedirectResponse, FileResponse, Response, PlainTextResponse
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import urlencode
 import aiosqlite
+import json
+import mimetypes
 import yaml
 import os
 import logging
@@ -12,14 +17,35 @@ from yt_dlp import YoutubeDL
 from celery import Celery
 import dotenv
 
-from helpers import validate_true_playlist_url, check_playlist_accessible
-from celery_app import scan
+from helpers import validate_true_playlist_url, check_playlist_accessible, normalize_policy, policy_key
+from celery_app import NODE_NAME, celery as celery_worker, scan, scan_playlist, backfill_catalog, rebalance, collect_media, dedup_media, pack_metadata, reindex_library, downsample_history
+import catalog
+import download_control
+import health
+import lanes
+import mediastore
+import metapack
+import prefetch
+import reindex
+import runhistory
+import scheduler
+import shared
+import sharding
+import storage
+import strategy
 
 
 cwd = Path(__file__).parent
 
-DATA_ROOT_PATH = Path("/srv/hgst/ytdl/")
-DB_PATH = cwd / ".database" / "database.db"
+DATA_ROOT_PATH = Path(os.getenv("DATA_ROOT_PATH", "/srv/hgst/ytdl/"))
+DB_PATH = Path(os.getenv("DB_PATH", cwd / ".database" / "database.db"))
+
+# Larger reads mean fewer threadpool hops per stream when the server has no pathsend support
+STREAM_CHUNK_SIZE = 1024 * 1024
+# (owner, playlist_id) -> (membership version, entries); rebuilt when the version changes,
+# least recently used playlists dropped beyond M3U_CACHE_SIZE
+M3U_CACHE: OrderedDict[tuple[str, str], tuple[tuple, list[dict]]] = OrderedDict()
+M3U_CACHE_SIZE = int(os.getenv("YTDL_M3U_CACHE_SIZE", "256"))
 
 os.makedirs(DATA_ROOT_PATH, exist_ok=True)
 os.makedirs(DB_PATH.parent, exist_ok=True)
@@ -38,6 +64,14 @@ def init_logger() -> logging.Logger:
 		logger.error(f"Logger initialization failed: {e}")
 		return logger
 
+async def add_column_if_missing(db: aiosqlite.Connection, table: str, column: str, definition: str):
+	"""
+	Lightweight migration for columns added after a table was first created.
+	"""
+	cur = await db.execute(f"PRAGMA table_info({table})")
+	if column not in {row[1] for row in await cur.fetchall()}:
+		await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 async def get_db():
 	async with aiosqlite.connect(DB_PATH) as db:
 		await db.execute("PRAGMA foreign_keys = ON")
@@ -72,6 +106,8 @@ async def lifespan(app: FastAPI):
 			active INTEGER NOT NULL DEFAULT 1
 		)
 		""")
+		for column, definition in scheduler.USER_SHARE_COLUMNS:
+			await add_column_if_missing(db, "user", column, definition)
 
 		await db.execute("""
 		CREATE TABLE IF NOT EXISTS playlist (
@@ -80,15 +116,33 @@ async def lifespan(app: FastAPI):
 			name TEXT,
 			owner TEXT NOT NULL,
 			active INTEGER NOT NULL DEFAULT 1,
+			policy TEXT,
 			FOREIGN KEY(owner) REFERENCES user(name) ON DELETE RESTRICT
 		)
 		""")
+		await add_column_if_missing(db, "playlist", "policy", "TEXT")
+		for column, definition in sharding.PLAYLIST_NODE_COLUMNS:
+			await add_column_if_missing(db, "playlist", column, definition)
 
 		await db.execute("""
 		CREATE UNIQUE INDEX IF NOT EXISTS idx_playlist_owner_pid
 		ON playlist(owner, playlist_id)
 		""")
 
+		await catalog.init_catalog(db)
+		await download_control.init_decisions(db)
+		await storage.init_reservations(db)
+		await sharding.init_nodes(db)
+		for column, definition in sharding.NODE_CAPACITY_COLUMNS:
+			await add_column_if_missing(db, "node", column, definition)
+		await mediastore.init_media(db)
+		await prefetch.init_prefetch(db)
+		await strategy.init_strategy(db)
+		await lanes.init_lanes(db)
+		await runhistory.init_history(db)
+		await reindex.init_reindex(db)
+		await scheduler.init_scheduler(db)
+
 		await db.commit()
 		logger.info("Database ready")
 		
@@ -108,7 +162,12 @@ async def lifespan(app: FastAPI):
 		logger.error(f"Celery init failed: {e}")
 		app.state.celery = None
 
+	# Dependency/readiness probes run in the background; the health endpoints serve the last result
+	app.state.health = health.HealthMonitor(DATA_ROOT_PATH, DB_PATH, celery_worker, NODE_NAME, app_version=app.version)
+	app.state.health.start()
+
 	yield
+	await app.state.health.stop()
 	logger.info("Application shutdown")
 
 app = FastAPI(
@@ -214,12 +273,25 @@ async def add_playlist(
 	url: str,
 	owner: str,
 	name: str | None = None,
+	policy_format: str | None = None,
+	audio_only: bool | None = None,
+	write_metadata: bool | None = None,
 	db: aiosqlite.Connection = Depends(get_db),
 ):
+	'''
+	Add a playlist for an owner, or reactivate it if it was deactivated.
+
+		policy_format / audio_only / write_metadata: download policy overrides, see helpers.DEFAULT_POLICY
+	'''
 	logger = app.state.logger
 	try:
 		try:
 			url = validate_true_playlist_url(url)
+			policy = normalize_policy({
+				"format": policy_format,
+				"audio_only": audio_only,
+				"write_metadata": write_metadata,
+			})
 		except ValueError as exc:
 			raise HTTPException(status_code=400, detail=str(exc))
 
@@ -243,10 +315,11 @@ async def add_playlist(
 		# Try insert or reactivate
 		try:
 			insert_cur = await db.execute(
-				"INSERT INTO playlist (playlist_id, name, owner) VALUES (?, ?, ?)",
-				(playlist_id, final_name, owner),
+				"INSERT INTO playlist (playlist_id, name, owner, policy) VALUES (?, ?, ?, ?)",
+				(playlist_id, final_name, owner, json.dumps(policy)),
 			)
 			await db.commit()
+			row_id = insert_cur.lastrowid
 		except aiosqlite.IntegrityError:
 			# Reactivate if inactive
 			cur = await db.execute(
@@ -256,23 +329,35 @@ async def add_playlist(
 			row = await cur.fetchone()
 			if row:
 				await db.execute(
-					"UPDATE playlist SET active = 1, name = ? WHERE id = ?",
-					(final_name, row["id"]),
+					"UPDATE playlist SET active = 1, name = ?, policy = ? WHERE id = ?",
+					(final_name, json.dumps(policy), row["id"]),
 				)
 				await db.commit()
-				insert_cur = row
+				row_id = row["id"]
 			else:
 				raise HTTPException(status_code=409, detail="Playlist already exists")
 
+		# The playlist is saved at this point; failing to queue its first sync must not
+		# answer 500 and send the client into a retry that hits the duplicate
+		try:
+			update_task_id = await queue_playlist_update(db, playlist_id, owner)
+		except Exception:
+			logger.exception("Failed to queue first sync of %s for %s", playlist_id, owner)
+			update_task_id = None
+
 		return {
 			"status": "success",
 			"playlist": {
-				"id": insert_cur.lastrowid,
+				"id": row_id,
 				"playlist_id": playlist_id,
 				"name": final_name,
 				"video_count": meta.get("count"),
+				"policy": policy,
 				"active": True
 			},
+			"update_task_id": update_task_id,
+			# pending: the next scheduled scan syncs it
+			"sync": "queued" if update_task_id else "pending",
 		}
 	except HTTPException:
 		raise
@@ -280,6 +365,61 @@ async def add_playlist(
 		logger.exception("Error adding playlist")
 		raise HTTPException(status_code=500, detail="Failed to add playlist")
 
+async def queue_playlist_update(db: aiosqlite.Connection, playlist_id: str, owner: str) -> str | None:
+	"""
+	Queue a priority-lane scan of one playlist for everyone sharing it with this owner's policy.
+	Best effort: returns None if the broker is unreachable; the next scheduled scan picks it up.
+	"""
+	logger = app.state.logger
+	await sharding.place_unassigned(db)
+	await db.commit()
+	cur = await db.execute(
+		"SELECT owner, policy, node FROM playlist WHERE playlist_id = ? AND active = 1 AND node_target IS NULL",
+		(playlist_id,),
+	)
+	rows = await cur.fetchall()
+	mine = next((r for r in rows if r["owner"] == owner), None)
+	if mine is None:
+		return None
+	key = policy_key(mine["policy"])
+	owners = [r["owner"] for r in rows if policy_key(r["policy"]) == key]
+	owners.sort(key=lambda name: name != owner)
+	try:
+		task = scan_playlist.apply_async(
+			(owners, playlist_id),
+			{"policy": normalize_policy(mine["policy"]), "lane": "priority"},
+			**lanes.route("interactive", mine["node"]),
+		)
+	except Exception:
+		logger.warning("Could not queue update of %s", playlist_id, exc_info=True)
+		return None
+	logger.info("Queued priority update of %s for %s (task %s)", playlist_id, owner, task.id)
+	return task.id
+
+@app.post("/api/playlist/update/{playlist_id}")
+async def update_playlist(
+	playlist_id: str,
+	owner: str,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Sync a playlist now, ahead of routine background scans.
+	"""
+	logger = app.state.logger
+	try:
+		task_id = await queue_playlist_update(db, playlist_id, owner)
+		if task_id is None:
+			raise HTTPException(status_code=404, detail="Playlist not found or inactive")
+		return {
+			"status": "queued",
+			"task_id": task_id,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error queueing playlist update")
+		raise HTTPException(status_code=500, detail="Failed to queue playlist update")
+
 @app.delete("/api/playlist/deactivate/{playlist_id}")
 async def deactivate_playlist(
 	playlist_id: str,
@@ -306,6 +446,53 @@ async def deactivate_playlist(
 		logger.exception("Error deactivating playlist")
 		raise HTTPException(status_code=500, detail="Failed to deactivate playlist")
 
+@app.put("/api/playlist/policy/{playlist_id}")
+async def set_playlist_policy(
+	playlist_id: str,
+	owner: str,
+	policy_format: str | None = None,
+	audio_only: bool | None = None,
+	write_metadata: bool | None = None,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	'''
+	Update the download policy of a playlist. Unset fields keep their current value.
+	Applies to items downloaded from now on; existing files are not re-encoded.
+	'''
+	logger = app.state.logger
+	try:
+		cur = await db.execute(
+			"SELECT policy FROM playlist WHERE playlist_id = ? AND owner = ?",
+			(playlist_id, owner),
+		)
+		row = await cur.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Playlist not found")
+		try:
+			changes = {
+				"format": policy_format,
+				"audio_only": audio_only,
+				"write_metadata": write_metadata,
+			}
+			policy = normalize_policy({
+				**normalize_policy(row["policy"]),
+				**{k: v for k, v in changes.items() if v is not None},
+			})
+		except ValueError as exc:
+			raise HTTPException(status_code=400, detail=str(exc))
+
+		await db.execute(
+			"UPDATE playlist SET policy = ? WHERE playlist_id = ? AND owner = ?",
+			(json.dumps(policy), playlist_id, owner),
+		)
+		await db.commit()
+		return {"status": "success", "playlist_id": playlist_id, "policy": policy}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error updating playlist policy")
+		raise HTTPException(status_code=500, detail="Failed to update playlist policy")
+
 @app.get("/api/playlist/get_all")
 async def get_all_playlists(
 	owner: str,
@@ -330,19 +517,19 @@ async def get_all_playlists(
 
 		if is_admin and include_all:
 			cur = await db.execute("""
-				SELECT p.id, p.playlist_id, p.name, p.owner, u.display_name AS owner_display_name, p.active
+				SELECT p.id, p.playlist_id, p.name, p.owner, u.display_name AS owner_display_name, p.policy, p.active
 				FROM playlist p
 				JOIN user u ON p.owner = u.name
 			""")
 		else:
 			cur = await db.execute("""
-				SELECT p.id, p.playlist_id, p.name, p.owner, u.display_name AS owner_display_name
+				SELECT p.id, p.playlist_id, p.name, p.owner, u.display_name AS owner_display_name, p.policy
 				FROM playlist p
 				JOIN user u ON p.owner = u.name
 				WHERE p.owner = ? AND p.active = 1
 			""", (owner,))
 
-		playlists = [dict(r) for r in await cur.fetchall()]
+		playlists = [{**dict(r), "policy": normalize_policy(r["policy"])} for r in await cur.fetchall()]
 		return {"items": playlists, "total": len(playlists)}
 	except HTTPException:
 		raise
@@ -389,6 +576,778 @@ async def trigger_scan():
 	except Exception:
 		logger.exception("Error triggering scan")
 		raise HTTPException(status_code=500, detail="Failed to trigger scan")
+
+@app.post("/api/tasks/backfill_catalog")
+async def trigger_backfill_catalog(passkey: str):
+	"""
+	Trigger a bulk load of the video catalog from existing info.json files.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task = backfill_catalog.delay()
+		logger.info("Queued catalog backfill task %s", task.id)
+		return {
+			"status": "queued",
+			"task_id": task.id,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering catalog backfill")
+		raise HTTPException(status_code=500, detail="Failed to trigger catalog backfill")
+
+def not_modified(request: Request, headers) -> bool:
+	"""
+	Evaluate If-None-Match / If-Modified-Since against the response validators.
+	"""
+	if_none_match = request.headers.get("if-none-match")
+	if if_none_match is not None:
+		tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+		return "*" in tags or headers.get("etag") in tags
+	if_modified_since = request.headers.get("if-modified-since")
+	if if_modified_since and headers.get("last-modified"):
+		try:
+			return parsedate_to_datetime(headers["last-modified"]) <= parsedate_to_datetime(if_modified_since)
+		except (TypeError, ValueError):
+			return False
+	return False
+
+@app.get("/api/library/stream/{owner}/{playlist_id}/{video_id}")
+async def stream_track(
+	owner: str,
+	playlist_id: str,
+	video_id: str,
+	passkey: str,
+	request: Request,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Stream a downloaded track by video ID.
+
+	Supports Range requests and conditional GETs (ETag/Last-Modified). Under an
+	ASGI server with the pathsend extension the body is handed to the server as
+	a path so it can use sendfile; otherwise it is read in large chunks.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		cur = await db.execute(
+			"""
+			SELECT file_path FROM catalog_membership
+			WHERE video_id = ? AND owner = ? AND playlist_id = ? AND file_path IS NOT NULL
+			""",
+			(video_id, owner, playlist_id),
+		)
+		row = await cur.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Track not found")
+
+		# Files live under the data root of whichever node holds the playlist
+		cur = await db.execute(
+			"""
+			SELECT n.data_root FROM playlist p JOIN node n ON n.name = p.node
+			WHERE p.owner = ? AND p.playlist_id = ?
+			""",
+			(owner, playlist_id),
+		)
+		node = await cur.fetchone()
+		data_root = Path(node["data_root"]) if node else DATA_ROOT_PATH
+		playlist_folder = (data_root / owner / playlist_id).resolve()
+		file_path = Path(row["file_path"]).resolve()
+		if not file_path.is_relative_to(playlist_folder):
+			raise HTTPException(status_code=404, detail="Track not found")
+		try:
+			stat_result = os.stat(file_path)
+		except FileNotFoundError:
+			raise HTTPException(status_code=404, detail="Track file missing")
+
+		media_type = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+		response = FileResponse(file_path, stat_result=stat_result, media_type=media_type)
+		response.chunk_size = STREAM_CHUNK_SIZE
+		if not request.headers.get("range") and not_modified(request, response.headers):
+			return Response(
+				status_code=304,
+				headers={k: response.headers[k] for k in ("etag", "last-modified")},
+			)
+		return response
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error streaming track")
+		raise HTTPException(status_code=500, detail="Failed to stream track")
+
+@app.get("/api/library/metadata/{owner}/{playlist_id}/{video_id}")
+async def get_track_metadata(
+	owner: str,
+	playlist_id: str,
+	video_id: str,
+	passkey: str,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Return the trimmed yt-dlp metadata kept for a track in its playlist's metadata pack.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		cur = await db.execute(
+			"""
+			SELECT p.policy, n.data_root FROM playlist p LEFT JOIN node n ON n.name = p.node
+			WHERE p.owner = ? AND p.playlist_id = ?
+			""",
+			(owner, playlist_id),
+		)
+		row = await cur.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Playlist not found")
+		data_root = Path(row["data_root"]) if row["data_root"] else DATA_ROOT_PATH
+		folder = shared.shared_folder(data_root, playlist_id, row["policy"])
+		record = metapack.read(folder, video_id)
+		if record is None:
+			raise HTTPException(status_code=404, detail="Track metadata not found")
+		return record
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error reading track metadata")
+		raise HTTPException(status_code=500, detail="Failed to read track metadata")
+
+@app.get("/api/library/m3u/{owner}/{playlist_id}")
+async def playlist_m3u(
+	owner: str,
+	playlist_id: str,
+	passkey: str,
+	request: Request,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Return an extended M3U for a playlist pointing at the stream endpoint.
+
+	Entries are cached per playlist until its catalog memberships change.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+
+		version = await catalog.playlist_version(db, owner, playlist_id)
+		if version[0] == 0:
+			raise HTTPException(status_code=404, detail="Playlist has no downloaded items")
+		etag = '"' + "-".join(str(int(part or 0)) for part in version) + '"'
+		if request.headers.get("if-none-match") == etag:
+			return Response(status_code=304, headers={"etag": etag})
+
+		key = (owner, playlist_id)
+		cached = M3U_CACHE.get(key)
+		if cached and cached[0] == version:
+			entries = cached[1]
+			M3U_CACHE.move_to_end(key)
+		else:
+			entries = await catalog.playlist_entries(db, owner, playlist_id)
+			M3U_CACHE[key] = (version, entries)
+			M3U_CACHE.move_to_end(key)
+			while len(M3U_CACHE) > M3U_CACHE_SIZE:
+				M3U_CACHE.popitem(last=False)
+
+		query = urlencode({"passkey": passkey})
+		lines = ["#EXTM3U"]
+		for entry in entries:
+			label = " - ".join(part for part in (entry["uploader"], entry["title"]) if part)
+			duration = int(entry["duration"]) if entry["duration"] is not None else -1
+			url = request.url_for(
+				"stream_track", owner=owner, playlist_id=playlist_id, video_id=entry["video_id"]
+			)
+			lines.append(f"#EXTINF:{duration},{label}")
+			lines.append(f"{url}?{query}")
+		return PlainTextResponse(
+			"\n".join(lines) + "\n",
+			media_type="audio/x-mpegurl",
+			headers={"etag": etag},
+		)
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error building playlist M3U")
+		raise HTTPException(status_code=500, detail="Failed to build playlist M3U")
+
+def health_response(snapshot: tuple[int, bytes]) -> Response:
+	status_code, body = snapshot
+	return Response(content=body, status_code=status_code, media_type="application/json", headers={"Cache-Control": "no-store"})
+
+@app.get("/health/live")
+async def health_live():
+	"""
+	Liveness: the process is up and answering. Does not depend on any probe.
+	"""
+	return health_response(app.state.health.live)
+
+@app.get("/health/ready")
+async def health_ready():
+	"""
+	Readiness from the last background probe: 503 when the database, broker or storage is
+	failing, the data volume is under the low-water mark, or the queues are backed up.
+	"""
+	return health_response(app.state.health.readiness())
+
+@app.get("/api/manage/healthcheck")
+async def healthcheck():
+	"""
+	Dependency versions (yt-dlp, ffmpeg, rsync), readiness checks and recent job figures
+	from the last background probe; 501 DEP_MISSING when a required binary is absent.
+	"""
+	return health_response(app.state.health.report)
+
+@app.get("/api/manage/storage")
+async def get_storage(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Space on this node's data volume: used, free, reserved by its in-flight downloads, and the low-water mark.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		return await storage.space_status(db, DATA_ROOT_PATH, NODE_NAME)
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting storage status")
+		raise HTTPException(status_code=500, detail="Failed to get storage status")
+
+async def queue_on_nodes(task, db: aiosqlite.Connection, **kwargs) -> list[str]:
+	"""
+	Queue a node-local maintenance task once per active node (or on the default queue if none registered).
+	"""
+	cur = await db.execute("SELECT name FROM node WHERE active = 1")
+	names = [row[0] for row in await cur.fetchall()] or [None]
+	return [task.apply_async(kwargs=kwargs, **lanes.route("maintenance", name)).id for name in names]
+
+@app.post("/api/tasks/dedup_media")
+async def trigger_dedup_media(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Collapse duplicate copies in the existing library into the media store. Results report the space reclaimed.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task_ids = await queue_on_nodes(dedup_media, db)
+		logger.info("Queued media dedup tasks %s", task_ids)
+		return {
+			"status": "queued",
+			"task_ids": task_ids,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering media dedup")
+		raise HTTPException(status_code=500, detail="Failed to trigger media dedup")
+
+@app.post("/api/tasks/pack_metadata")
+async def trigger_pack_metadata(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Move legacy .info.json files into the per-playlist metadata packs on every node.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task_ids = await queue_on_nodes(pack_metadata, db)
+		logger.info("Queued metadata pack tasks %s", task_ids)
+		return {
+			"status": "queued",
+			"task_ids": task_ids,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering metadata pack")
+		raise HTTPException(status_code=500, detail="Failed to trigger metadata pack")
+
+@app.post("/api/tasks/reindex")
+async def trigger_reindex(
+	passkey: str,
+	full: bool = False,
+	dry_run: bool = False,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Rebuild archives, metadata packs and catalog rows on every node from the IDs tagged into
+	the media files. Only new or changed files are read unless full is set; dry_run only reports.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task_ids = await queue_on_nodes(reindex_library, db, full=full, dry_run=dry_run)
+		logger.info("Queued reindex tasks %s", task_ids)
+		return {
+			"status": "queued",
+			"task_ids": task_ids,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering reindex")
+		raise HTTPException(status_code=500, detail="Failed to trigger reindex")
+
+@app.post("/api/tasks/collect_media")
+async def trigger_collect_media(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Delete media store objects that no playlist links to any more.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task_ids = await queue_on_nodes(collect_media, db)
+		logger.info("Queued media GC tasks %s", task_ids)
+		return {
+			"status": "queued",
+			"task_ids": task_ids,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering media GC")
+		raise HTTPException(status_code=500, detail="Failed to trigger media GC")
+
+@app.get("/api/manage/media")
+async def get_media_stats(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Media store size per node and policy, and the downloads it has saved.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		cur = await db.execute(
+			"""
+			SELECT node, policy_key, COUNT(*) AS objects, TOTAL(file_size) AS bytes,
+				TOTAL(hits) AS download_hits, TOTAL(bytes_saved) AS download_bytes_saved
+			FROM media_object GROUP BY node, policy_key ORDER BY node, policy_key
+			"""
+		)
+		items = [dict(r) for r in await cur.fetchall()]
+		return {"items": items, "total": len(items)}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting media store stats")
+		raise HTTPException(status_code=500, detail="Failed to get media store stats")
+
+@app.get("/api/manage/prefetch")
+async def get_prefetch_stats(passkey: str, days: int = 7, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Extraction cache size per node and daily prefetch counters with the hit rate seen by syncs.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		cur = await db.execute(
+			"""
+			SELECT node, COUNT(*) AS entries, SUM(expires_at > strftime('%s', 'now')) AS usable,
+				MIN(expires_at) AS next_expiry
+			FROM extraction_cache GROUP BY node ORDER BY node
+			"""
+		)
+		cache = [dict(r) for r in await cur.fetchall()]
+		cur = await db.execute(
+			"""
+			SELECT day, node, prefetched, failed, hits, misses, stale FROM prefetch_stats
+			WHERE day >= date('now', ?) ORDER BY day DESC, node
+			""",
+			(f"-{max(days, 1) - 1} days",),
+		)
+		items = []
+		for r in await cur.fetchall():
+			item = dict(r)
+			lookups = item["hits"] + item["misses"] + item["stale"]
+			item["hit_rate"] = item["hits"] / lookups if lookups else None
+			items.append(item)
+		return {"cache": cache, "items": items, "total": len(items), "ttl_seconds": prefetch.PREFETCH_TTL}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting prefetch stats")
+		raise HTTPException(status_code=500, detail="Failed to get prefetch stats")
+
+@app.get("/api/manage/queue")
+async def get_queue(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Fair-share queue state per user: weight, caps, today's usage, queued and running work.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		items = await scheduler.queue_status(db)
+		return {"items": items, "total": len(items), "slots_per_node": scheduler.SLOTS_PER_NODE}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting queue state")
+		raise HTTPException(status_code=500, detail="Failed to get queue state")
+
+@app.put("/api/manage/users/share")
+async def set_user_share(
+	name: str,
+	passkey: str,
+	weight: float | None = None,
+	max_concurrent: int | None = None,
+	daily_quota_bytes: int | None = None,
+	clear_limits: bool = False,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Set a user's fair-share weight, concurrent sync cap and daily byte quota.
+	Omitted values are left alone; clear_limits removes the cap and quota.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		if weight is not None and weight <= 0:
+			raise HTTPException(status_code=400, detail="Weight must be positive")
+		if (max_concurrent is not None and max_concurrent < 1) or (daily_quota_bytes is not None and daily_quota_bytes < 0):
+			raise HTTPException(status_code=400, detail="Invalid limits")
+		changes = {
+			"share_weight": weight,
+			"max_concurrent": max_concurrent,
+			"daily_quota_bytes": daily_quota_bytes,
+		}
+		changes = {k: v for k, v in changes.items() if v is not None}
+		if clear_limits:
+			changes = {"max_concurrent": None, "daily_quota_bytes": None, **changes}
+		if changes:
+			assignments = ", ".join(f"{column} = ?" for column in changes)
+			cur = await db.execute(
+				f"UPDATE user SET {assignments} WHERE name = ?",
+				(*changes.values(), name),
+			)
+			if cur.rowcount == 0:
+				raise HTTPException(status_code=404, detail="User not found")
+			await db.commit()
+		cur = await db.execute(
+			"SELECT share_weight, max_concurrent, daily_quota_bytes FROM user WHERE name = ?",
+			(name,),
+		)
+		row = await cur.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="User not found")
+		return {"status": "updated", "user": name, **dict(row)}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error setting user share")
+		raise HTTPException(status_code=500, detail="Failed to set user share")
+
+@app.get("/api/manage/nodes")
+async def get_nodes(passkey: str, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Registered worker nodes with how many playlists each holds and how many are migrating to it.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		cur = await db.execute(
+			"""
+			SELECT n.*,
+				(SELECT COUNT(DISTINCT playlist_id) FROM playlist WHERE node = n.name) AS playlists,
+				(SELECT COUNT(DISTINCT playlist_id) FROM playlist WHERE node_target = n.name) AS incoming
+			FROM node n ORDER BY n.name
+			"""
+		)
+		items = [dict(r) for r in await cur.fetchall()]
+		cur = await db.execute("SELECT COUNT(DISTINCT playlist_id) FROM playlist WHERE node IS NULL")
+		unplaced = (await cur.fetchone())[0]
+		return {"items": items, "total": len(items), "unplaced_playlists": unplaced}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting nodes")
+		raise HTTPException(status_code=500, detail="Failed to get nodes")
+
+@app.put("/api/manage/nodes/override")
+async def set_node_override(
+	playlist_id: str,
+	passkey: str,
+	node: str | None = None,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Pin a playlist to a node, or clear the pin when no node is given. Takes effect on the next rebalance.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		if node is not None:
+			cur = await db.execute("SELECT 1 FROM node WHERE name = ?", (node,))
+			if not await cur.fetchone():
+				raise HTTPException(status_code=404, detail="Node not found")
+		cur = await db.execute(
+			"UPDATE playlist SET node_override = ? WHERE playlist_id = ?",
+			(node, playlist_id),
+		)
+		if cur.rowcount == 0:
+			raise HTTPException(status_code=404, detail="Playlist not found")
+		await db.commit()
+		logger.info("Node override for %s set to %s", playlist_id, node)
+		return {"status": "updated", "playlist_id": playlist_id, "node_override": node}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error setting node override")
+		raise HTTPException(status_code=500, detail="Failed to set node override")
+
+@app.post("/api/tasks/rebalance")
+async def trigger_rebalance(passkey: str):
+	"""
+	Migrate playlists whose desired node has changed.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task = rebalance.delay()
+		logger.info("Queued rebalance task %s", task.id)
+		return {
+			"status": "queued",
+			"task_id": task.id,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering rebalance")
+		raise HTTPException(status_code=500, detail="Failed to trigger rebalance")
+
+@app.post("/api/tasks/downsample_history")
+async def trigger_downsample_history(passkey: str):
+	"""
+	Fold old scan and sync runs into daily rows now instead of after the next scan.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		task = downsample_history.delay()
+		logger.info("Queued history downsample task %s", task.id)
+		return {
+			"status": "queued",
+			"task_id": task.id,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error triggering history downsample")
+		raise HTTPException(status_code=500, detail="Failed to trigger history downsample")
+
+@app.get("/api/manage/download_decisions")
+async def get_download_decisions(
+	passkey: str,
+	limit: int = 100,
+	owner: str | None = None,
+	playlist_id: str | None = None,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Most recent fragment/parallelism decisions taken by the download controller.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		if not 1 <= limit <= 1000:
+			raise HTTPException(status_code=400, detail="Invalid limit")
+		filters = []
+		params: list = []
+		if owner:
+			filters.append("owner = ?")
+			params.append(owner)
+		if playlist_id:
+			filters.append("playlist_id = ?")
+			params.append(playlist_id)
+		where = f"WHERE {' AND '.join(filters)}" if filters else ""
+		cur = await db.execute(
+			f"SELECT * FROM download_decision {where} ORDER BY created_at DESC LIMIT ?",
+			(*params, limit),
+		)
+		items = [dict(r) for r in await cur.fetchall()]
+		return {"items": items, "total": len(items)}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting download decisions")
+		raise HTTPException(status_code=500, detail="Failed to get download decisions")
+
+@app.get("/api/manage/lanes")
+async def get_lanes(passkey: str, hours: int = 24, node: str | None = None, db: aiosqlite.Connection = Depends(get_db)):
+	"""
+	Per-lane queue waits (mean, max, estimated p50/p95/p99) over the last `hours`, with the
+	messages waiting in each lane's queues at the last health probe.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		if not 1 <= hours <= 24 * 30:
+			raise HTTPException(status_code=400, detail="Invalid hours")
+		items = await lanes.wait_summary(db, hours, node)
+		depth = app.state.health.result.get("broker", {}).get("depth", {})
+		for item in items:
+			item["queued"] = sum(count for queue, count in depth.items() if lanes.lane_of(queue) == item["lane"])
+		return {"items": items, "total": len(items), "hours": hours, "reserved_workers": lanes.RESERVED_WORKERS}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting lane waits")
+		raise HTTPException(status_code=500, detail="Failed to get lane waits")
+
+@app.get("/api/manage/strategy")
+async def get_client_strategy(
+	passkey: str,
+	node: str | None = None,
+	audio_only: bool = True,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Current player client/format ranking per node, as the next sync would try them,
+	with the decayed attempt/success counts and latencies behind it.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		rows = await strategy.load_outcomes(db, node)
+		nodes = sorted({row["node"] for row in rows} | ({node} if node else set()))
+		items = [
+			{
+				"node": name,
+				"ranking": strategy.ClientStrategy(
+					{"audio_only": audio_only},
+					outcomes=[row for row in rows if row["node"] == name],
+				).report(),
+			}
+			for name in nodes
+		]
+		return {
+			"items": items,
+			"total": len(items),
+			"clients": list(strategy.CLIENTS),
+			"max_attempts": strategy.MAX_ATTEMPTS,
+			"half_life_seconds": strategy.HALF_LIFE,
+		}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting client strategy")
+		raise HTTPException(status_code=500, detail="Failed to get client strategy")
+
+@app.get("/api/manage/history/trends")
+async def get_history_trends(
+	passkey: str,
+	kind: str = "sync",
+	days: int = 28,
+	bucket: str = "day",
+	node: str | None = None,
+	playlist_id: str | None = None,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Scan or sync runs per day or week: counts, items, bytes, durations, per-phase seconds
+	and download throughput, oldest first.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		if kind not in runhistory.KINDS:
+			raise HTTPException(status_code=400, detail="Invalid kind")
+		if bucket not in ("day", "week"):
+			raise HTTPException(status_code=400, detail="Invalid bucket")
+		if not 1 <= days <= runhistory.HISTORY_DAYS:
+			raise HTTPException(status_code=400, detail="Invalid days")
+		items = await runhistory.trends(db, kind, days, bucket, node, playlist_id)
+		return {"items": items, "total": len(items), "kind": kind, "days": days, "bucket": bucket}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting run history trends")
+		raise HTTPException(status_code=500, detail="Failed to get run history trends")
+
+@app.get("/api/manage/history/slowest")
+async def get_slowest_playlists(
+	passkey: str,
+	kind: str = "sync",
+	days: int = 7,
+	limit: int = 20,
+	node: str | None = None,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Playlists with the longest mean scan or sync runs over the last `days`.
+	"""
+	logger = app.state.logger
+	try:
+		if passkey != os.getenv("PASSKEY"):
+			raise HTTPException(status_code=401, detail="Invalid credentials")
+		if kind not in runhistory.KINDS:
+			raise HTTPException(status_code=400, detail="Invalid kind")
+		if not 1 <= days <= runhistory.HISTORY_DAYS:
+			raise HTTPException(status_code=400, detail="Invalid days")
+		if not 1 <= limit <= 200:
+			raise HTTPException(status_code=400, detail="Invalid limit")
+		items = await runhistory.slowest(db, kind, days, limit, node)
+		return {"items": items, "total": len(items), "kind": kind, "days": days}
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error getting slowest playlists")
+		raise HTTPException(status_code=500, detail="Failed to get slowest playlists")
+
+@app.get("/api/library/search")
+async def search_library(
+	q: str,
+	owner: str,
+	include_all: bool = False,
+	page: int = 1,
+	per_page: int = 50,
+	db: aiosqlite.Connection = Depends(get_db),
+):
+	"""
+	Full-text search over downloaded videos by title and uploader.
+
+	Non-admins only see videos in their own playlists; admins may search the whole
+	library with include_all. Each item lists the playlists that contain it.
+	"""
+	logger = app.state.logger
+	try:
+		if page < 1 or not 1 <= per_page <= 500:
+			raise HTTPException(status_code=400, detail="Invalid pagination")
+
+		cur = await db.execute(
+			"SELECT admin FROM user WHERE name = ? AND active = 1", (owner,)
+		)
+		row = await cur.fetchone()
+		if not row:
+			raise HTTPException(status_code=404, detail="Owner not found or inactive")
+		scope = None if (row["admin"] and include_all) else owner
+
+		try:
+			return await catalog.search(db, q, owner=scope, page=page, per_page=per_page)
+		except ValueError as exc:
+			raise HTTPException(status_code=400, detail=str(exc))
+	except HTTPException:
+		raise
+	except Exception:
+		logger.exception("Error searching library")
+		raise HTTPException(status_code=500, detail="Failed to search library")
 		
 # @app.get("/api/playlist/check_by_url")
 # async def check_playlist_by_url(
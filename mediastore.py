@@ -0,0 +1,222 @@
+import logging
+import os
+import time
+from pathlib import Path
+
+import aiosqlite
+
+import shared
+from helpers import policy_key
+
+logger = logging.getLogger("dev")
+
+# Objects live in {root}/_media/{policy_key}/{video_id[:2]}/{video_id}{ext}; playlist
+# folders hold hardlinks to them, so an object with a link count of 1 is unused
+MEDIA_DIR = "_media"
+
+MEDIA_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS media_object (
+		video_id TEXT NOT NULL,
+		policy_key TEXT NOT NULL,
+		node TEXT NOT NULL,
+		path TEXT NOT NULL,
+		file_name TEXT NOT NULL,
+		file_size INTEGER,
+		title TEXT,
+		uploader TEXT,
+		duration REAL,
+		hits INTEGER NOT NULL DEFAULT 0,
+		bytes_saved INTEGER NOT NULL DEFAULT 0,
+		created_at INTEGER NOT NULL,
+		PRIMARY KEY (video_id, policy_key, node)
+	)
+	""",
+)
+
+UPSERT_OBJECT = """
+	INSERT INTO media_object
+	(video_id, policy_key, node, path, file_name, file_size, title, uploader, duration, created_at)
+	VALUES (:video_id, :policy_key, :node, :path, :file_name, :file_size, :title, :uploader, :duration, :created_at)
+	ON CONFLICT(video_id, policy_key, node) DO UPDATE SET
+		path = excluded.path,
+		file_name = excluded.file_name,
+		file_size = excluded.file_size,
+		title = excluded.title,
+		uploader = excluded.uploader,
+		duration = excluded.duration
+"""
+
+
+async def init_media(db: aiosqlite.Connection):
+	"""
+	Create the media store index if missing. Does not commit.
+	"""
+	for statement in MEDIA_SCHEMA:
+		await db.execute(statement)
+
+
+def object_path(root: Path, video_id: str, policy: dict | str | None, suffix: str) -> Path:
+	return Path(root) / MEDIA_DIR / policy_key(policy) / video_id[:2] / f"{video_id}{suffix}"
+
+
+async def find_object(db: aiosqlite.Connection, node: str, video_id: str, policy: dict | str | None) -> dict | None:
+	"""
+	The stored object for a video under a policy on this node, if its file is still there.
+	"""
+	cur = await db.execute(
+		"""
+		SELECT video_id, path, file_name, file_size, title, uploader, duration FROM media_object
+		WHERE video_id = ? AND policy_key = ? AND node = ?
+		""",
+		(video_id, policy_key(policy), node),
+	)
+	row = await cur.fetchone()
+	if not row:
+		return None
+	item = dict(zip(("video_id", "path", "file_name", "file_size", "title", "uploader", "duration"), row))
+	return item if os.path.exists(item["path"]) else None
+
+
+def put(root: Path, node: str, policy: dict | str | None, record: dict) -> tuple[Path, list[tuple[str, list]]]:
+	"""
+	Link a freshly downloaded file (a catalog record) into the store.
+	Returns the object path and the (sql, rows) pair that indexes it.
+	"""
+	source = Path(record["file_path"])
+	target = object_path(root, record["video_id"], policy, source.suffix)
+	target.parent.mkdir(parents=True, exist_ok=True)
+	shared.link_file(source, target)
+	row = {
+		"video_id": record["video_id"],
+		"policy_key": policy_key(policy),
+		"node": node,
+		"path": str(target),
+		"file_name": source.name,
+		"file_size": record.get("file_size"),
+		"title": record.get("title"),
+		"uploader": record.get("uploader"),
+		"duration": record.get("duration"),
+		"created_at": int(time.time()),
+	}
+	return target, [(UPSERT_OBJECT, [row])]
+
+
+def reuse_statements(node: str, policy: dict | str | None, video_id: str, nbytes: int) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that counts a download avoided by linking a stored object.
+	"""
+	return [(
+		"""
+		UPDATE media_object SET hits = hits + 1, bytes_saved = bytes_saved + ?
+		WHERE video_id = ? AND policy_key = ? AND node = ?
+		""",
+		[(nbytes, video_id, policy_key(policy), node)],
+	)]
+
+
+async def collect_garbage(db: aiosqlite.Connection, root: Path, node: str) -> dict:
+	"""
+	Delete stored objects no playlist folder links to any more (link count 1) and index
+	rows whose file is gone. Commits.
+	"""
+	removed = 0
+	freed = 0
+	base = Path(root) / MEDIA_DIR
+	if base.exists():
+		for path in base.glob("*/*/*"):
+			try:
+				stat = path.stat()
+			except FileNotFoundError:
+				continue
+			if path.is_file() and stat.st_nlink == 1:
+				path.unlink(missing_ok=True)
+				removed += 1
+				freed += stat.st_size
+
+	cur = await db.execute("SELECT video_id, policy_key, path FROM media_object WHERE node = ?", (node,))
+	stale = [(vid, key, node) for vid, key, path in await cur.fetchall() if not os.path.exists(path)]
+	await db.executemany("DELETE FROM media_object WHERE video_id = ? AND policy_key = ? AND node = ?", stale)
+	await db.commit()
+	return {"removed": removed, "freed_bytes": freed, "stale_rows": len(stale)}
+
+
+async def dedup_library(db: aiosqlite.Connection, root: Path, node: str) -> dict:
+	"""
+	One-shot pass over this node's library: collapse every copy of a video under the same
+	policy into a single stored object that the shared folders and owner views link to.
+	Only playlists placed on the node are read; other nodes' files are theirs to dedup.
+	Reports the space freed and the bytes the store has saved in downloads. Commits.
+	"""
+	cur = await db.execute(
+		"""
+		SELECT m.video_id, m.owner, m.playlist_id, m.file_path, p.policy, c.title, c.uploader, c.duration
+		FROM catalog_membership m
+		JOIN playlist p ON p.owner = m.owner AND p.playlist_id = m.playlist_id
+		LEFT JOIN catalog c ON c.video_id = m.video_id
+		WHERE m.file_path IS NOT NULL AND p.node = ?
+		""",
+		(node,),
+	)
+	groups: dict[tuple[str, str], list[tuple[Path, dict]]] = {}
+	for video_id, owner, playlist_id, file_path, policy, title, uploader, duration in await cur.fetchall():
+		view_path = Path(file_path)
+		canonical_path = shared.shared_folder(root, playlist_id, policy) / view_path.name
+		record = {
+			"video_id": video_id,
+			"title": title,
+			"uploader": uploader,
+			"duration": duration,
+			"policy": policy,
+		}
+		group = groups.setdefault((video_id, policy_key(policy)), [])
+		for path in (canonical_path, view_path):
+			if path.is_file():
+				group.append((path, record))
+
+	before: dict[tuple[int, int], int] = {}
+	after: dict[tuple[int, int], int] = {}
+	statements: list[tuple[str, list]] = []
+	duplicates = 0
+	for (video_id, key), copies in groups.items():
+		if not copies:
+			continue
+		for path, _ in copies:
+			stat = path.stat()
+			before[(stat.st_dev, stat.st_ino)] = stat.st_size
+
+		first_path, record = copies[0]
+		existing = await find_object(db, node, video_id, record["policy"])
+		if existing:
+			source = Path(existing["path"])
+			stat = source.stat()
+			before[(stat.st_dev, stat.st_ino)] = stat.st_size
+		else:
+			source, rows = put(root, node, record["policy"], {
+				**record,
+				"file_path": str(first_path),
+				"file_size": first_path.stat().st_size,
+			})
+			statements += rows
+
+		for path, _ in copies:
+			if shared.link_file(source, path) != "exists":
+				duplicates += 1
+		stat = source.stat()
+		after[(stat.st_dev, stat.st_ino)] = stat.st_size
+
+	for sql, rows in statements:
+		await db.executemany(sql, rows)
+	await db.commit()
+
+	cur = await db.execute("SELECT TOTAL(bytes_saved), TOTAL(hits) FROM media_object WHERE node = ?", (node,))
+	bytes_saved, hits = await cur.fetchone()
+	reclaimed = sum(before.values()) - sum(after.values())
+	logger.info("Media dedup replaced %d copies, reclaimed %d bytes", duplicates, reclaimed)
+	return {
+		"videos": len(groups),
+		"duplicates_linked": duplicates,
+		"reclaimed_bytes": max(reclaimed, 0),
+		"download_hits": int(hits),
+		"download_bytes_saved": int(bytes_saved),
+	}
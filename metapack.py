@@ -0,0 +1,169 @@
+import json
+import logging
+import sqlite3
+import time
+import zlib
+from contextlib import closing
+from pathlib import Path
+from typing import Iterator
+
+import shared
+from catalog import media_for_info
+
+logger = logging.getLogger("dev")
+
+# One SQLite pack per shared playlist folder; hidden, so views never mirror it
+PACK_NAME = ".metadata.db"
+# Per-item fields kept from yt-dlp's info dict; formats, thumbnails, captions and
+# request headers make up most of an info.json and are dropped
+KEEP_FIELDS = (
+	"id", "title", "fulltitle", "description", "uploader", "uploader_id", "uploader_url",
+	"channel", "channel_id", "channel_url", "duration", "upload_date", "release_date",
+	"timestamp", "view_count", "like_count", "tags", "categories", "webpage_url",
+	"thumbnail", "playlist_id", "playlist_title", "playlist_index",
+	"format_id", "ext", "acodec", "vcodec", "abr", "asr", "filesize", "filesize_approx",
+)
+COMPRESS_LEVEL = 6
+
+PACK_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS item (
+		video_id TEXT PRIMARY KEY,
+		file_name TEXT,
+		updated_at INTEGER NOT NULL,
+		record BLOB NOT NULL
+	) WITHOUT ROWID
+	""",
+)
+
+
+def pack_path(folder: Path) -> Path:
+	return Path(folder) / PACK_NAME
+
+
+def trim_info(info: dict, file_name: str | None = None) -> dict:
+	"""
+	The compact metadata record kept for an item: KEEP_FIELDS that are set, plus the
+	final file name.
+	"""
+	record = {key: info[key] for key in KEEP_FIELDS if info.get(key) is not None}
+	if file_name:
+		record["file_name"] = file_name
+	return record
+
+
+def _connect(folder: Path) -> sqlite3.Connection:
+	conn = sqlite3.connect(pack_path(folder), timeout=30)
+	for statement in PACK_SCHEMA:
+		conn.execute(statement)
+	return conn
+
+
+def write(folder: Path, records: list[dict], replace: bool = True) -> int:
+	"""
+	Store trimmed records in the folder's pack in one transaction. With replace=False,
+	items already in the pack are kept. Returns the number of rows written.
+	"""
+	if not records:
+		return 0
+	now = int(time.time())
+	conflict = "REPLACE" if replace else "IGNORE"
+	with closing(_connect(folder)) as conn, conn:
+		cur = conn.executemany(
+			f"INSERT OR {conflict} INTO item (video_id, file_name, updated_at, record) VALUES (?, ?, ?, ?)",
+			[
+				(r["id"], r.get("file_name"), now, zlib.compress(json.dumps(r).encode(), COMPRESS_LEVEL))
+				for r in records
+			],
+		)
+		return cur.rowcount
+
+
+def read(folder: Path, video_id: str) -> dict | None:
+	"""
+	One item's metadata record, or None if the pack (or the item) does not exist.
+	"""
+	if not pack_path(folder).exists():
+		return None
+	with closing(sqlite3.connect(pack_path(folder), timeout=30)) as conn:
+		row = conn.execute("SELECT record FROM item WHERE video_id = ?", (video_id,)).fetchone()
+	return json.loads(zlib.decompress(row[0])) if row else None
+
+
+def iter_records(folder: Path) -> Iterator[dict]:
+	if not pack_path(folder).exists():
+		return
+	with closing(sqlite3.connect(pack_path(folder), timeout=30)) as conn:
+		for (blob,) in conn.execute("SELECT record FROM item ORDER BY video_id"):
+			yield json.loads(zlib.decompress(blob))
+
+
+def remove(folder: Path, video_ids: list[str]) -> int:
+	if not video_ids or not pack_path(folder).exists():
+		return 0
+	with closing(_connect(folder)) as conn, conn:
+		return conn.executemany("DELETE FROM item WHERE video_id = ?", [(v,) for v in video_ids]).rowcount
+
+
+def pack_info_files(pack_folder: Path, info_paths: list[Path]) -> dict:
+	"""
+	Move legacy .info.json files into a pack: trim each into a record (items already
+	packed keep theirs), commit, then delete the files. Unreadable files are left alone.
+	Sizes are counted per inode, since views hardlink the shared folder's files.
+	"""
+	pack_folder.mkdir(parents=True, exist_ok=True)
+	before = pack_path(pack_folder).stat().st_size if pack_path(pack_folder).exists() else 0
+	records: dict[str, dict] = {}
+	packed_paths = []
+	inodes: dict[tuple[int, int], int] = {}
+	for info_path in info_paths:
+		try:
+			info = json.loads(info_path.read_text())
+			stat = info_path.stat()
+		except Exception:
+			logger.warning("Skipping unreadable %s", info_path)
+			continue
+		if info.get("id"):
+			media = media_for_info(info_path)
+			records.setdefault(info["id"], trim_info(info, media.name if media else None))
+		inodes[(stat.st_dev, stat.st_ino)] = stat.st_blocks * 512
+		packed_paths.append(info_path)
+
+	written = write(pack_folder, list(records.values()), replace=False)
+	for info_path in packed_paths:
+		info_path.unlink(missing_ok=True)
+	after = pack_path(pack_folder).stat().st_size if pack_path(pack_folder).exists() else 0
+	return {
+		"files": len(packed_paths),
+		"records": written,
+		"info_bytes": sum(inodes.values()),
+		"pack_bytes": after - before,
+	}
+
+
+def migrate_library(root: Path, policies: dict[tuple[str, str], str | None]) -> dict:
+	"""
+	Pack every .info.json under root: the shared folders' own, and those left in owner
+	folders, which go to the pack of the playlist's shared folder (looked up in policies,
+	keyed by (owner, playlist_id)) or, for unknown playlists, a pack in place.
+	"""
+	root = Path(root)
+	groups: dict[Path, list[Path]] = {}
+	for info_path in (root / shared.SHARED_DIR).glob("*/*/*.info.json"):
+		groups.setdefault(info_path.parent, []).append(info_path)
+	for info_path in root.glob("*/*/*.info.json"):
+		owner, playlist_id = info_path.parent.parent.name, info_path.parent.name
+		if owner.startswith("_"):
+			continue
+		key = (owner, playlist_id)
+		folder = shared.shared_folder(root, playlist_id, policies[key]) if key in policies else info_path.parent
+		groups.setdefault(folder, []).append(info_path)
+
+	totals = {"playlists": 0, "files": 0, "records": 0, "info_bytes": 0, "pack_bytes": 0}
+	for folder, info_paths in groups.items():
+		result = pack_info_files(folder, info_paths)
+		totals["playlists"] += 1
+		for key in ("files", "records", "info_bytes", "pack_bytes"):
+			totals[key] += result[key]
+	logger.info("Packed metadata: %s", totals)
+	return totals
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+
+import aiosqlite
+from yt_dlp import YoutubeDL
+
+from download_control import ItemLogger
+from helpers import policy_key
+
+logger = logging.getLogger("dev")
+
+# Cached extractions are used for at most this long...
+PREFETCH_TTL = int(os.getenv("YTDL_PREFETCH_TTL", str(3 * 3600)))
+# ...and never closer than this to the expiry of their signed media URLs
+EXPIRY_MARGIN = 15 * 60
+# Extractions run at once by a prefetch task
+PREFETCH_WORKERS = int(os.getenv("YTDL_PREFETCH_WORKERS", "4"))
+
+# Signed googlevideo URLs carry their expiry as ?expire=<epoch> or /expire/<epoch>/
+EXPIRE_PATTERN = re.compile(r"[?&/]expire[=/](\d+)")
+
+PREFETCH_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS extraction_cache (
+		video_id TEXT NOT NULL,
+		policy_key TEXT NOT NULL,
+		node TEXT NOT NULL,
+		info BLOB NOT NULL,
+		format_id TEXT,
+		filesize INTEGER,
+		url_expires_at INTEGER,
+		expires_at INTEGER NOT NULL,
+		fetched_at INTEGER NOT NULL,
+		PRIMARY KEY (video_id, policy_key, node)
+	)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS prefetch_stats (
+		day TEXT NOT NULL,
+		node TEXT NOT NULL,
+		prefetched INTEGER NOT NULL DEFAULT 0,
+		failed INTEGER NOT NULL DEFAULT 0,
+		hits INTEGER NOT NULL DEFAULT 0,
+		misses INTEGER NOT NULL DEFAULT 0,
+		stale INTEGER NOT NULL DEFAULT 0,
+		PRIMARY KEY (day, node)
+	)
+	""",
+)
+
+STAT_COLUMNS = ("prefetched", "failed", "hits", "misses", "stale")
+
+
+async def init_prefetch(db: aiosqlite.Connection):
+	"""
+	Create the extraction cache and its counters if missing. Does not commit.
+	"""
+	for statement in PREFETCH_SCHEMA:
+		await db.execute(statement)
+
+
+def url_expiry(info: dict) -> int | None:
+	"""
+	Earliest expiry among the signed URLs of the selected formats, if they carry one.
+	"""
+	formats = info.get("requested_formats") or [info]
+	expiries = []
+	for fmt in formats:
+		for url in (fmt.get("url"), fmt.get("manifest_url")):
+			match = EXPIRE_PATTERN.search(url or "")
+			if match:
+				expiries.append(int(match.group(1)))
+	return min(expiries) if expiries else None
+
+
+def resolve(base_opts: dict, video_id: str) -> dict | None:
+	"""
+	Extract one video and select its format under the given options, without downloading.
+	Returns the sanitized info dict (what --load-info-json would read), or None on failure.
+	"""
+	opts = {
+		**base_opts,
+		"quiet": True,
+		"logger": ItemLogger(),
+	}
+	# An archived ID would be skipped by the extraction itself
+	opts.pop("download_archive", None)
+	try:
+		with YoutubeDL(opts) as ydl:
+			info = ydl.extract_info(f"https://www.youtube.com/watch?v={video_id}", download=False)
+			return ydl.sanitize_info(info, remove_private_keys=True) if info else None
+	except Exception:
+		logger.warning("Prefetch of %s failed", video_id, exc_info=True)
+		return None
+
+
+def resolve_many(base_opts: dict, video_ids: Iterable[str], workers: int = PREFETCH_WORKERS) -> Iterator[tuple[str, dict | None]]:
+	"""
+	Resolve several videos concurrently, yielding (video_id, info) in input order.
+	"""
+	video_ids = list(video_ids)
+	with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+		yield from zip(video_ids, pool.map(lambda video_id: resolve(base_opts, video_id), video_ids))
+
+
+def cache_statements(node: str, policy: dict | str | None, infos: list[dict]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that stores resolved infos, expiring at the earlier of the TTL and the URL expiry.
+	"""
+	if not infos:
+		return []
+	now = int(time.time())
+	rows = []
+	for info in infos:
+		url_expires_at = url_expiry(info)
+		expires_at = now + PREFETCH_TTL
+		if url_expires_at:
+			expires_at = min(expires_at, url_expires_at - EXPIRY_MARGIN)
+		formats = info.get("requested_formats") or [info]
+		filesize = sum(f.get("filesize") or f.get("filesize_approx") or 0 for f in formats) or None
+		rows.append((
+			info["id"], policy_key(policy), node,
+			zlib.compress(json.dumps(info).encode()),
+			info.get("format_id"), filesize, url_expires_at, expires_at, now,
+		))
+	return [(
+		"""
+		INSERT OR REPLACE INTO extraction_cache
+		(video_id, policy_key, node, info, format_id, filesize, url_expires_at, expires_at, fetched_at)
+		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+		""",
+		rows,
+	)]
+
+
+def consume_statements(node: str, policy: dict | str | None, video_ids: list[str]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that drops cache entries once a download has used (or outlived) them.
+	"""
+	if not video_ids:
+		return []
+	return [(
+		"DELETE FROM extraction_cache WHERE video_id = ? AND policy_key = ? AND node = ?",
+		[(video_id, policy_key(policy), node) for video_id in video_ids],
+	)]
+
+
+def stats_statements(node: str, **counts: int) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that adds to today's prefetch counters (prefetched, failed, hits, misses, stale).
+	"""
+	counts = {k: v for k, v in counts.items() if v}
+	if not counts:
+		return []
+	if set(counts) - set(STAT_COLUMNS):
+		raise ValueError(f"Unknown counters: {', '.join(sorted(set(counts) - set(STAT_COLUMNS)))}")
+	columns = ", ".join(counts)
+	placeholders = ", ".join("?" for _ in counts)
+	updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in counts)
+	day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+	return [(
+		f"""
+		INSERT INTO prefetch_stats (day, node, {columns}) VALUES (?, ?, {placeholders})
+		ON CONFLICT(day, node) DO UPDATE SET {updates}
+		""",
+		[(day, node, *counts.values())],
+	)]
+
+
+async def cached_ids(db: aiosqlite.Connection, node: str, policy: dict | str | None, video_ids: list[str]) -> set[str]:
+	"""
+	Which of the given IDs already have a usable cache entry.
+	"""
+	if not video_ids:
+		return set()
+	cur = await db.execute(
+		f"""
+		SELECT video_id FROM extraction_cache
+		WHERE policy_key = ? AND node = ? AND expires_at > ?
+		AND video_id IN ({",".join("?" * len(video_ids))})
+		""",
+		(policy_key(policy), node, int(time.time()), *video_ids),
+	)
+	return {row[0] for row in await cur.fetchall()}
+
+
+async def find_cached(db: aiosqlite.Connection, node: str, video_id: str, policy: dict | str | None) -> dict | None:
+	"""
+	The cached info for a video if it has not expired.
+	"""
+	cur = await db.execute(
+		"""
+		SELECT info FROM extraction_cache
+		WHERE video_id = ? AND policy_key = ? AND node = ? AND expires_at > ?
+		""",
+		(video_id, policy_key(policy), node, int(time.time())),
+	)
+	row = await cur.fetchone()
+	return json.loads(zlib.decompress(row[0])) if row else None
+
+
+async def prune_expired(db: aiosqlite.Connection) -> int:
+	"""
+	Drop expired cache entries. Commits.
+	"""
+	cur = await db.execute("DELETE FROM extraction_cache WHERE expires_at <= ?", (int(time.time()),))
+	await db.commit()
+	return cur.rowcount
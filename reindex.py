@@ -0,0 +1,456 @@
+"""
+Rebuild archives, metadata packs and catalog rows from the tags embedded in the media files.
+
+get_ydl_opts writes `youtube_id=<id>; playlist_id=<id>` into every file's comment tag.
+This walks the data root's shared folders and owner views, reads those tags with a
+process pool (ID3v2 frames are parsed directly from the MP3 header; other containers go
+through ffprobe's container-level tags, so no audio is decoded) and then:
+
+  - links files found only in an owner view into the playlist's shared folder,
+  - appends missing lines to each shared folder's archive.txt,
+  - adds missing records to each shared folder's metadata pack,
+  - links views back up and upserts catalog memberships for every playlist row,
+
+reporting conflicts (one ID in several files of a folder, catalog rows pointing at a
+different existing file) and orphans (untagged files, folders no playlist row refers to,
+catalog rows whose file is gone). Files whose size and mtime are unchanged since the last
+run (reindex_state) are not read again.
+
+Usage: python reindex.py [--workers N] [--full] [--dry-run]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import aiosqlite
+from yt_dlp.utils import locked_file
+
+import catalog
+import metapack
+import shared
+from helpers import policy_key
+
+logger = logging.getLogger("dev")
+
+REINDEX_WORKERS = int(os.getenv("YTDL_REINDEX_WORKERS", str(os.cpu_count() or 2)))
+# Containers the download policies produce
+MEDIA_SUFFIXES = (".mp3", ".m4a", ".opus", ".ogg", ".webm", ".mka", ".mkv", ".mp4", ".flac", ".aac")
+COMMENT_PATTERN = re.compile(r"youtube_id=(?P<video_id>[\w-]+)(?:;\s*playlist_id=(?P<playlist_id>[\w-]*))?")
+# Conflicts and orphans listed in the report (all are counted)
+REPORT_LIMIT = 100
+
+REINDEX_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS reindex_state (
+		path TEXT PRIMARY KEY,
+		size INTEGER NOT NULL,
+		mtime_ns INTEGER NOT NULL,
+		video_id TEXT,
+		playlist_id TEXT,
+		title TEXT,
+		uploader TEXT,
+		duration REAL,
+		error TEXT,
+		scanned_at INTEGER NOT NULL
+	)
+	""",
+)
+
+TAG_FIELDS = ("video_id", "playlist_id", "title", "uploader", "duration", "error")
+
+
+async def init_reindex(db: aiosqlite.Connection):
+	"""
+	Create the reindexer's file state table if missing. Does not commit.
+	"""
+	for statement in REINDEX_SCHEMA:
+		await db.execute(statement)
+
+
+def _syncsafe(data: bytes) -> int:
+	return (data[0] & 0x7F) << 21 | (data[1] & 0x7F) << 14 | (data[2] & 0x7F) << 7 | (data[3] & 0x7F)
+
+
+def _decode(encoding: int, data: bytes) -> str:
+	codec = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}.get(encoding, "latin-1")
+	return data.decode(codec, errors="replace").rstrip("\x00")
+
+
+def _split_terminated(encoding: int, data: bytes) -> tuple[bytes, bytes]:
+	"""
+	Split an encoded, null-terminated string off the front of data.
+	"""
+	if encoding in (1, 2):
+		for i in range(0, len(data) - 1, 2):
+			if data[i:i + 2] == b"\x00\x00":
+				return data[:i], data[i + 2:]
+		return data, b""
+	head, _, tail = data.partition(b"\x00")
+	return head, tail
+
+
+def read_id3(path: Path) -> dict:
+	"""
+	Comment, title, artist and length frames of an ID3v2.2-2.4 tag, read from the file header only.
+	"""
+	tags: dict = {"comments": []}
+	with open(path, "rb") as f:
+		header = f.read(10)
+		if len(header) < 10 or header[:3] != b"ID3":
+			return tags
+		version, flags = header[3], header[5]
+		body = f.read(_syncsafe(header[6:10]))
+	if flags & 0x80 and version < 4:
+		# Whole-tag unsynchronisation (v2.4 does it per frame)
+		body = body.replace(b"\xff\x00", b"\xff")
+	pos = 0
+	if flags & 0x40 and version >= 3:
+		pos = _syncsafe(body[:4]) if version == 4 else int.from_bytes(body[:4], "big") + 4
+
+	id_size, header_size = (3, 6) if version == 2 else (4, 10)
+	names = {
+		"comment": "COM" if version == 2 else "COMM",
+		"title": "TT2" if version == 2 else "TIT2",
+		"artist": "TP1" if version == 2 else "TPE1",
+		"length": "TLE" if version == 2 else "TLEN",
+	}
+	while pos + header_size <= len(body):
+		frame_id = body[pos:pos + id_size].decode("latin-1", errors="replace")
+		if not frame_id.strip("\x00"):
+			break
+		size_bytes = body[pos + id_size:pos + id_size + (3 if version == 2 else 4)]
+		size = _syncsafe(size_bytes) if version == 4 else int.from_bytes(size_bytes, "big")
+		format_flags = body[pos + 9] if version >= 3 else 0
+		frame = body[pos + header_size:pos + header_size + size]
+		pos += header_size + size
+		if version == 4:
+			if format_flags & 0x01:
+				# Data length indicator
+				frame = frame[4:]
+			if format_flags & 0x02:
+				frame = frame.replace(b"\xff\x00", b"\xff")
+		if not frame:
+			continue
+		encoding, payload = frame[0], frame[1:]
+		if frame_id == names["comment"]:
+			_, text = _split_terminated(encoding, payload[3:])
+			tags["comments"].append(_decode(encoding, text))
+		elif frame_id == names["title"]:
+			tags["title"] = _decode(encoding, payload)
+		elif frame_id == names["artist"]:
+			tags["artist"] = _decode(encoding, payload)
+		elif frame_id == names["length"]:
+			length = _decode(encoding, payload)
+			if length.isdigit():
+				tags["duration"] = int(length) / 1000
+	return tags
+
+
+def read_ffprobe(path: Path) -> dict:
+	"""
+	Container-level tags and duration via ffprobe (headers only, no decoding).
+	"""
+	result = subprocess.run(
+		[
+			"ffprobe", "-v", "error", "-show_entries", "format=duration:format_tags:stream_tags",
+			"-of", "json", str(path),
+		],
+		capture_output=True, text=True, timeout=60, check=True,
+	)
+	data = json.loads(result.stdout or "{}")
+	fmt = data.get("format", {})
+	# Opus/Vorbis keep their comments on the stream, other containers on the format
+	raw = {**{k: v for s in data.get("streams", []) for k, v in s.get("tags", {}).items()}, **fmt.get("tags", {})}
+	tags = {key.lower(): value for key, value in raw.items()}
+	duration = fmt.get("duration")
+	return {
+		"comments": [tags[key] for key in ("comment", "description") if tags.get(key)],
+		"title": tags.get("title"),
+		"artist": tags.get("artist"),
+		"duration": float(duration) if duration else None,
+	}
+
+
+def read_tags(path: str) -> dict:
+	"""
+	The item identity embedded in a media file. Runs in the reindexer's worker processes.
+	"""
+	path = Path(path)
+	item = dict.fromkeys(TAG_FIELDS)
+	try:
+		with open(path, "rb") as f:
+			is_id3 = f.read(3) == b"ID3"
+		if is_id3:
+			tags = read_id3(path)
+		elif shutil.which("ffprobe"):
+			tags = read_ffprobe(path)
+		else:
+			item["error"] = "ffprobe not available"
+			return item
+	except Exception as e:
+		item["error"] = f"unreadable: {e}"
+		return item
+
+	for comment in tags["comments"]:
+		match = COMMENT_PATTERN.search(comment)
+		if match:
+			item["video_id"] = match.group("video_id")
+			item["playlist_id"] = match.group("playlist_id") or None
+			break
+	else:
+		item["error"] = "no youtube_id tag"
+	item["title"] = tags.get("title")
+	item["uploader"] = tags.get("artist")
+	item["duration"] = tags.get("duration")
+	return item
+
+
+def list_media(root: Path) -> list[dict]:
+	"""
+	Media files in shared folders (kind "shared") and owner views (kind "view").
+	"""
+	root = Path(root)
+	files = []
+	for path in (root / shared.SHARED_DIR).glob("*/*/*"):
+		if path.suffix.lower() in MEDIA_SUFFIXES and shared.is_mirrored(path):
+			files.append({
+				"path": path, "kind": "shared", "folder": path.parent,
+				"playlist_id": path.parent.parent.name, "policy_key": path.parent.name,
+			})
+	for path in root.glob("*/*/*"):
+		owner = path.parent.parent.name
+		if owner.startswith("_") or path.suffix.lower() not in MEDIA_SUFFIXES or not shared.is_mirrored(path):
+			continue
+		files.append({
+			"path": path, "kind": "view", "folder": path.parent,
+			"playlist_id": path.parent.name, "owner": owner,
+		})
+	return files
+
+
+def _append_archive(folder: Path, video_ids: list[str]) -> int:
+	archive_file = folder / shared.ARCHIVE_NAME
+	with locked_file(archive_file, "a", encoding="utf-8") as f:
+		known = {line.split()[1] for line in archive_file.read_text(encoding="utf-8").splitlines() if len(line.split()) >= 2}
+		missing = [video_id for video_id in video_ids if video_id not in known]
+		f.write("".join(f"youtube {video_id}\n" for video_id in missing))
+	return len(missing)
+
+
+async def reindex(
+	db: aiosqlite.Connection,
+	root: Path,
+	workers: int = REINDEX_WORKERS,
+	full: bool = False,
+	dry_run: bool = False,
+) -> dict:
+	"""
+	Read tags of new or changed files and rebuild archives, packs and catalog rows from
+	them. With dry_run nothing on disk or in the catalog is changed (the file state is
+	still recorded, so a later real run does not read the files again). Commits.
+	"""
+	root = Path(root)
+	await init_reindex(db)
+	started = time.monotonic()
+	now = int(time.time())
+
+	files = list_media(root)
+	for item in files:
+		stat = item["path"].stat()
+		item.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, inode=(stat.st_dev, stat.st_ino))
+
+	cur = await db.execute(f"SELECT path, size, mtime_ns, {', '.join(TAG_FIELDS)} FROM reindex_state")
+	state = {row[0]: row[1:] for row in await cur.fetchall()}
+	# Views hardlink the shared files: read each inode once
+	by_inode: dict[tuple[int, int], dict] = {}
+	to_read: dict[tuple[int, int], str] = {}
+	for item in files:
+		previous = state.get(str(item["path"]))
+		if not full and previous and previous[0] == item["size"] and previous[1] == item["mtime_ns"]:
+			by_inode[item["inode"]] = dict(zip(TAG_FIELDS, previous[2:]))
+		elif item["inode"] not in to_read:
+			to_read[item["inode"]] = str(item["path"])
+	to_read = {inode: path for inode, path in to_read.items() if inode not in by_inode}
+
+	if to_read:
+		with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+			for inode, tags in zip(to_read, pool.map(read_tags, to_read.values(), chunksize=32)):
+				by_inode[inode] = tags
+	for item in files:
+		item["tags"] = by_inode[item["inode"]]
+
+	await db.executemany(
+		f"""
+		INSERT OR REPLACE INTO reindex_state (path, size, mtime_ns, {', '.join(TAG_FIELDS)}, scanned_at)
+		VALUES (?, ?, ?, {', '.join('?' * len(TAG_FIELDS))}, ?)
+		""",
+		[
+			(str(item["path"]), item["size"], item["mtime_ns"], *(item["tags"][k] for k in TAG_FIELDS), now)
+			for item in files
+			if full or state.get(str(item["path"]), (None, None))[:2] != (item["size"], item["mtime_ns"])
+		],
+	)
+	present = {str(item["path"]) for item in files}
+	await db.executemany("DELETE FROM reindex_state WHERE path = ?", [(p,) for p in state if p not in present])
+
+	report = {
+		"files": len(files),
+		"read": len(to_read),
+		"adopted": 0,
+		"archive_lines_added": 0,
+		"pack_records_added": 0,
+		"catalog_rows": 0,
+		"conflicts": [],
+		"orphans": {"untagged": [], "folders": [], "missing_files": []},
+	}
+	for item in files:
+		if not item["tags"]["video_id"]:
+			report["orphans"]["untagged"].append({"path": str(item["path"]), "error": item["tags"]["error"]})
+
+	cur = await db.execute("SELECT owner, playlist_id, policy FROM playlist")
+	rows = await cur.fetchall()
+	shared_items: dict[Path, dict[str, list[dict]]] = {}
+	view_items: dict[Path, dict[str, list[dict]]] = {}
+	for item in files:
+		if item["tags"]["video_id"]:
+			target = shared_items if item["kind"] == "shared" else view_items
+			target.setdefault(item["folder"], {}).setdefault(item["tags"]["video_id"], []).append(item)
+
+	# Files only an owner view still has go back into the shared folder before views are rebuilt
+	for owner, playlist_id, policy in rows:
+		canonical = shared.shared_folder(root, playlist_id, policy)
+		in_canonical = shared_items.setdefault(canonical, {})
+		for video_id, items in view_items.get(shared.view_folder(root, owner, playlist_id), {}).items():
+			if video_id in in_canonical:
+				continue
+			source = items[0]
+			target = canonical / source["path"].name
+			if not dry_run:
+				canonical.mkdir(parents=True, exist_ok=True)
+				shared.link_file(source["path"], target)
+			in_canonical[video_id] = [{**source, "path": target, "kind": "shared", "folder": canonical}]
+			report["adopted"] += 1
+
+	referenced = {(playlist_id, policy_key(policy)) for _, playlist_id, policy in rows}
+	for folder, items in shared_items.items():
+		if not items:
+			continue
+		if (folder.parent.name, folder.name) not in referenced:
+			report["orphans"]["folders"].append(str(folder))
+		for video_id, copies in items.items():
+			if len({c["inode"] for c in copies}) > 1:
+				report["conflicts"].append({
+					"type": "duplicate", "video_id": video_id, "paths": [str(c["path"]) for c in copies],
+				})
+		if dry_run:
+			continue
+		report["archive_lines_added"] += _append_archive(folder, sorted(items))
+		report["pack_records_added"] += metapack.write(folder, [
+			{
+				"id": video_id,
+				"title": copies[0]["tags"]["title"],
+				"uploader": copies[0]["tags"]["uploader"],
+				"duration": copies[0]["tags"]["duration"],
+				"playlist_id": copies[0]["tags"]["playlist_id"],
+				"file_name": copies[0]["path"].name,
+			}
+			for video_id, copies in items.items()
+		], replace=False)
+
+	catalog_rows = []
+	for owner, playlist_id, policy in rows:
+		canonical = shared.shared_folder(root, playlist_id, policy)
+		view = shared.view_folder(root, owner, playlist_id)
+		items = shared_items.get(canonical, {})
+		if not dry_run and canonical.exists():
+			shared.materialize_view(canonical, view)
+		cur = await db.execute(
+			"SELECT video_id, file_path FROM catalog_membership WHERE owner = ? AND playlist_id = ?",
+			(owner, playlist_id),
+		)
+		existing = dict(await cur.fetchall())
+		for video_id, copies in items.items():
+			source = copies[0]
+			file_path = view / source["path"].name
+			current = existing.get(video_id)
+			if current == str(file_path):
+				continue
+			if current and current != str(file_path) and os.path.exists(current):
+				report["conflicts"].append({
+					"type": "catalog_path", "owner": owner, "playlist_id": playlist_id,
+					"video_id": video_id, "catalog": current, "found": str(file_path),
+				})
+				continue
+			catalog_rows.append({
+				"video_id": video_id,
+				"owner": owner,
+				"playlist_id": playlist_id,
+				"title": source["tags"]["title"],
+				"uploader": source["tags"]["uploader"],
+				"duration": source["tags"]["duration"],
+				"file_path": str(file_path),
+				"file_size": source["size"],
+				"updated_at": now,
+			})
+		for video_id, file_path in existing.items():
+			if video_id not in items and file_path and not os.path.exists(file_path):
+				report["orphans"]["missing_files"].append({"owner": owner, "playlist_id": playlist_id, "video_id": video_id})
+
+	if not dry_run and catalog_rows:
+		# Tags carry less than yt-dlp did: fill missing catalog rows, never overwrite them
+		await db.executemany(
+			"""
+			INSERT INTO catalog (video_id, title, uploader, duration, updated_at)
+			VALUES (:video_id, :title, :uploader, :duration, :updated_at)
+			ON CONFLICT(video_id) DO NOTHING
+			""",
+			catalog_rows,
+		)
+		await db.executemany(catalog.UPSERT_MEMBERSHIP, catalog_rows)
+		for row in catalog_rows:
+			await catalog.execute_statements(db, catalog.item_state_statements(
+				row["owner"], row["playlist_id"], [(row["video_id"], "downloaded", None)],
+			))
+		report["catalog_rows"] = len(catalog_rows)
+	await db.commit()
+
+	report["conflict_count"] = len(report["conflicts"])
+	report["conflicts"] = report["conflicts"][:REPORT_LIMIT]
+	report["orphan_counts"] = {key: len(values) for key, values in report["orphans"].items()}
+	report["orphans"] = {key: values[:REPORT_LIMIT] for key, values in report["orphans"].items()}
+	report["seconds"] = round(time.monotonic() - started, 2)
+	logger.info(
+		"Reindex: %d files (%d read), %d archive lines, %d pack records, %d catalog rows, %d conflicts, orphans %s",
+		report["files"], report["read"], report["archive_lines_added"], report["pack_records_added"],
+		report["catalog_rows"], report["conflict_count"], report["orphan_counts"],
+	)
+	return report
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--root", type=Path, default=Path(os.getenv("DATA_ROOT_PATH", "/srv/hgst/ytdl/")))
+	parser.add_argument("--db", type=Path, default=Path(os.getenv("DB_PATH", Path(__file__).parent / ".database" / "database.db")))
+	parser.add_argument("--workers", type=int, default=REINDEX_WORKERS)
+	parser.add_argument("--full", action="store_true", help="read every file, not only new or changed ones")
+	parser.add_argument("--dry-run", action="store_true", help="report only; change no archives, packs or catalog rows")
+	args = parser.parse_args()
+
+	async def run():
+		async with aiosqlite.connect(args.db) as db:
+			await catalog.init_catalog(db)
+			return await reindex(db, args.root, args.workers, args.full, args.dry_run)
+
+	print(json.dumps(asyncio.run(run()), indent=2))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+import aiosqlite
+
+# Individual runs are kept this many days, then folded into one row per playlist and day...
+RAW_DAYS = int(os.getenv("YTDL_HISTORY_RAW_DAYS", "14"))
+# ...which are kept this long
+HISTORY_DAYS = int(os.getenv("YTDL_HISTORY_DAYS", "365"))
+
+# Seconds spent per phase, summed over a run's parallel items (so they can exceed its duration)
+PHASES = ("listing", "download", "transcode", "db")
+COUNTS = ("items_added", "items_removed", "items_failed", "bytes")
+KINDS = ("scan", "sync")
+
+HISTORY_SCHEMA = (
+	f"""
+	CREATE TABLE IF NOT EXISTS run_history (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		kind TEXT NOT NULL,
+		node TEXT,
+		playlist_id TEXT NOT NULL,
+		status TEXT NOT NULL,
+		resolution TEXT NOT NULL DEFAULT 'run',
+		runs INTEGER NOT NULL DEFAULT 1,
+		started_at INTEGER NOT NULL,
+		finished_at INTEGER NOT NULL,
+		duration_seconds REAL NOT NULL,
+		max_duration_seconds REAL NOT NULL,
+		{", ".join(f"{count} INTEGER NOT NULL DEFAULT 0" for count in COUNTS)},
+		{", ".join(f"{phase}_seconds REAL NOT NULL DEFAULT 0" for phase in PHASES)}
+	)
+	""",
+	"""
+	CREATE INDEX IF NOT EXISTS idx_run_history_started
+	ON run_history(kind, started_at)
+	""",
+	"""
+	CREATE INDEX IF NOT EXISTS idx_run_history_playlist
+	ON run_history(playlist_id, started_at)
+	""",
+)
+
+PHASE_COLUMNS = tuple(f"{phase}_seconds" for phase in PHASES)
+SUMMED_COLUMNS = ("runs", "duration_seconds", *COUNTS, *PHASE_COLUMNS)
+
+
+async def init_history(db: aiosqlite.Connection):
+	"""
+	Create the run history table if missing. Does not commit.
+	"""
+	for statement in HISTORY_SCHEMA:
+		await db.execute(statement)
+
+
+class RunTimer:
+	"""
+	Wall-clock span and per-phase seconds of one scan or sync run.
+	Phases are timed with `phase()` blocks, `iterate()` over a generator, or `add()`.
+	"""
+
+	def __init__(self, kind: str, playlist_id: str, node: str | None, clock=time.time):
+		if kind not in KINDS:
+			raise ValueError(f"Unknown run kind: {kind}")
+		self.kind = kind
+		self.playlist_id = playlist_id
+		self.node = node
+		self._clock = clock
+		self.started_at = clock()
+		self.seconds = dict.fromkeys(PHASES, 0.0)
+		self._lock = threading.Lock()
+
+	def add(self, phase: str, seconds: float):
+		with self._lock:
+			self.seconds[phase] += max(seconds or 0.0, 0.0)
+
+	@contextmanager
+	def phase(self, phase: str):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(phase, time.perf_counter() - started)
+
+	def iterate(self, phase: str, iterable: Iterable) -> Iterator:
+		"""
+		Pass a lazy iterable through, timing only the work of producing each item.
+		"""
+		iterator = iter(iterable)
+		while True:
+			with self.phase(phase):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+
+	def statements(self, status: str, items_added: int = 0, items_removed: int = 0, items_failed: int = 0, nbytes: int = 0) -> list[tuple[str, list]]:
+		"""
+		(sql, rows) pair that records the run as finished now.
+		"""
+		finished_at = self._clock()
+		duration = max(finished_at - self.started_at, 0.0)
+		return [(
+			f"""
+			INSERT INTO run_history
+			(kind, node, playlist_id, status, started_at, finished_at, duration_seconds, max_duration_seconds,
+			{", ".join(COUNTS)}, {", ".join(PHASE_COLUMNS)})
+			VALUES ({", ".join("?" * (8 + len(COUNTS) + len(PHASE_COLUMNS)))})
+			""",
+			[(
+				self.kind, self.node, self.playlist_id, status, int(self.started_at), int(finished_at), duration, duration,
+				items_added, items_removed, items_failed, nbytes,
+				*(round(self.seconds[phase], 3) for phase in PHASES),
+			)],
+		)]
+
+
+async def downsample(db: aiosqlite.Connection, raw_days: int = RAW_DAYS, history_days: int = HISTORY_DAYS) -> dict:
+	"""
+	Fold runs older than raw_days into one row per (day, kind, node, playlist, status)
+	with summed counts and timings, and drop rows older than history_days. Commits.
+	"""
+	now = int(time.time())
+	cutoff = (now - raw_days * 86400) // 86400 * 86400
+	await db.execute("BEGIN IMMEDIATE")
+	try:
+		cur = await db.execute(
+			f"""
+			INSERT INTO run_history
+			(kind, node, playlist_id, status, resolution, started_at, finished_at, max_duration_seconds, {", ".join(SUMMED_COLUMNS)})
+			SELECT kind, node, playlist_id, status, 'day', started_at / 86400 * 86400, MAX(finished_at), MAX(max_duration_seconds),
+				{", ".join(f"SUM({column})" for column in SUMMED_COLUMNS)}
+			FROM run_history
+			WHERE resolution = 'run' AND started_at < ?
+			GROUP BY started_at / 86400, kind, node, playlist_id, status
+			""",
+			(cutoff,),
+		)
+		folded = cur.rowcount
+		cur = await db.execute("DELETE FROM run_history WHERE resolution = 'run' AND started_at < ?", (cutoff,))
+		runs = cur.rowcount
+		cur = await db.execute("DELETE FROM run_history WHERE started_at < ?", (now - history_days * 86400,))
+		expired = cur.rowcount
+		await db.commit()
+	except Exception:
+		await db.rollback()
+		raise
+	return {"runs_folded": runs, "day_rows": folded, "expired": expired}
+
+
+def _filters(kind: str | None, node: str | None, playlist_id: str | None, since: int) -> tuple[str, list]:
+	filters, params = ["started_at >= ?"], [since]
+	for column, value in (("kind", kind), ("node", node), ("playlist_id", playlist_id)):
+		if value is not None:
+			filters.append(f"{column} = ?")
+			params.append(value)
+	return " AND ".join(filters), params
+
+
+async def trends(
+	db: aiosqlite.Connection,
+	kind: str | None = "sync",
+	days: int = 28,
+	bucket: str = "day",
+	node: str | None = None,
+	playlist_id: str | None = None,
+) -> list[dict]:
+	"""
+	Runs, items, bytes and timings per day or week, with mean duration and download
+	throughput (bytes per second spent downloading).
+	"""
+	width = {"day": 86400, "week": 7 * 86400}[bucket]
+	where, params = _filters(kind, node, playlist_id, int(time.time()) - days * 86400)
+	cur = await db.execute(
+		f"""
+		SELECT started_at / {width} * {width} AS period, {", ".join(f"SUM({column})" for column in SUMMED_COLUMNS)},
+			MAX(max_duration_seconds), SUM(CASE WHEN status IN ('error', 'failed') THEN runs ELSE 0 END)
+		FROM run_history WHERE {where}
+		GROUP BY period ORDER BY period
+		""",
+		params,
+	)
+	items = []
+	for row in await cur.fetchall():
+		item = dict(zip(("period", *SUMMED_COLUMNS), row[:1 + len(SUMMED_COLUMNS)]))
+		item["max_duration_seconds"], item["errors"] = row[-2], row[-1]
+		item["mean_duration_seconds"] = item["duration_seconds"] / item["runs"] if item["runs"] else None
+		item["download_bytes_per_second"] = item["bytes"] / item["download_seconds"] if item["download_seconds"] else None
+		items.append(item)
+	return items
+
+
+async def slowest(
+	db: aiosqlite.Connection,
+	kind: str | None = "sync",
+	days: int = 7,
+	limit: int = 20,
+	node: str | None = None,
+) -> list[dict]:
+	"""
+	Playlists by mean run duration over the last `days`, with their per-item time and throughput.
+	"""
+	where, params = _filters(kind, node, None, int(time.time()) - days * 86400)
+	cur = await db.execute(
+		f"""
+		SELECT playlist_id, {", ".join(f"SUM({column})" for column in SUMMED_COLUMNS)}, MAX(max_duration_seconds)
+		FROM run_history WHERE {where}
+		GROUP BY playlist_id
+		ORDER BY SUM(duration_seconds) / SUM(runs) DESC
+		LIMIT ?
+		""",
+		(*params, limit),
+	)
+	items = []
+	for row in await cur.fetchall():
+		item = dict(zip(("playlist_id", *SUMMED_COLUMNS), row[:1 + len(SUMMED_COLUMNS)]))
+		item["max_duration_seconds"] = row[-1]
+		item["mean_duration_seconds"] = item["duration_seconds"] / item["runs"]
+		item["seconds_per_item"] = item["duration_seconds"] / item["items_added"] if item["items_added"] else None
+		item["download_bytes_per_second"] = item["bytes"] / item["download_seconds"] if item["download_seconds"] else None
+		items.append(item)
+	return items
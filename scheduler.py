@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+import aiosqlite
+
+import lanes
+
+logger = logging.getLogger("dev")
+
+# Sync tasks a node runs at once unless its autoscaler sets node.slots; the rest wait here,
+# not in the broker, so ordering stays fair
+SLOTS_PER_NODE = int(os.getenv("YTDL_SLOTS_PER_NODE", "2"))
+# A running item older than this belongs to a lost worker and no longer holds a slot
+RUNNING_TTL = int(os.getenv("YTDL_RUNNING_TTL", str(6 * 3600)))
+# Finished items are kept this long for the admin view
+DONE_RETENTION = 24 * 3600
+# Virtual cost of an item with no size estimate (e.g. a removals-only sync)
+MIN_COST = 1024**2
+
+# Lanes in dispatch order; priority is for first syncs and user-triggered updates
+LANES = ("priority", "routine")
+
+# Added to the user table by main.py
+USER_SHARE_COLUMNS = (
+	("share_weight", "REAL NOT NULL DEFAULT 1"),
+	("max_concurrent", "INTEGER"),
+	("daily_quota_bytes", "INTEGER"),
+)
+
+SCHEDULER_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS work_queue (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		account TEXT NOT NULL,
+		owners TEXT NOT NULL,
+		playlist_id TEXT NOT NULL,
+		node TEXT,
+		lane TEXT NOT NULL,
+		payload TEXT NOT NULL,
+		cost INTEGER NOT NULL,
+		virtual_start REAL NOT NULL,
+		virtual_finish REAL NOT NULL,
+		state TEXT NOT NULL DEFAULT 'queued',
+		created_at INTEGER NOT NULL,
+		started_at INTEGER,
+		finished_at INTEGER,
+		not_before INTEGER,
+		bytes INTEGER
+	)
+	""",
+	"""
+	CREATE INDEX IF NOT EXISTS idx_work_queue_dispatch
+	ON work_queue(state, node, lane, virtual_finish)
+	""",
+	"""
+	CREATE TABLE IF NOT EXISTS user_usage (
+		owner TEXT NOT NULL,
+		day TEXT NOT NULL,
+		bytes INTEGER NOT NULL DEFAULT 0,
+		PRIMARY KEY (owner, day)
+	)
+	""",
+)
+
+
+async def init_scheduler(db: aiosqlite.Connection):
+	"""
+	Create the work queue and usage tables if missing. Does not commit.
+	"""
+	for statement in SCHEDULER_SCHEMA:
+		await db.execute(statement)
+
+
+def today() -> str:
+	return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+async def _share(db: aiosqlite.Connection, owner: str) -> dict:
+	cur = await db.execute(
+		"SELECT share_weight, max_concurrent, daily_quota_bytes FROM user WHERE name = ?",
+		(owner,),
+	)
+	row = await cur.fetchone()
+	if not row:
+		return {"weight": 1.0, "max_concurrent": None, "daily_quota_bytes": None}
+	return {"weight": max(row[0] or 1.0, 1e-3), "max_concurrent": row[1], "daily_quota_bytes": row[2]}
+
+
+async def submit(
+	db: aiosqlite.Connection,
+	owners: list[str],
+	playlist_id: str,
+	node: str | None,
+	payload: dict,
+	cost: int,
+	lane: str = "routine",
+	delay: int = 0,
+) -> int:
+	"""
+	Queue a sync for the owners of a shared playlist. Weighted fair queuing: the item's
+	virtual finish is max(system virtual time, the account's last finish) + cost / weight,
+	and dispatch takes the smallest. The first owner is the account charged. With a delay
+	the item is not dispatched before then. Commits.
+	"""
+	if lane not in LANES:
+		raise ValueError(f"Unknown lane: {lane}")
+	account = owners[0]
+	share = await _share(db, account)
+	await db.execute("BEGIN IMMEDIATE")
+	try:
+		cur = await db.execute(
+			"""
+			SELECT
+				(SELECT COALESCE(MAX(virtual_start), 0) FROM work_queue WHERE state != 'queued'),
+				(SELECT MAX(virtual_finish) FROM work_queue WHERE account = ?)
+			""",
+			(account,),
+		)
+		system_time, last_finish = await cur.fetchone()
+		start = max(system_time, last_finish or 0)
+		finish = start + max(cost, MIN_COST) / share["weight"]
+		cur = await db.execute(
+			"""
+			INSERT INTO work_queue
+			(account, owners, playlist_id, node, lane, payload, cost, virtual_start, virtual_finish, created_at, not_before)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			(
+				account, json.dumps(owners), playlist_id, node, lane, json.dumps(payload), cost,
+				start, finish, int(time.time()), int(time.time()) + delay if delay else None,
+			),
+		)
+		await db.commit()
+		return cur.lastrowid
+	except Exception:
+		await db.rollback()
+		raise
+
+
+async def claim(db: aiosqlite.Connection, node: str | None) -> list[dict]:
+	"""
+	Claim as many queued items for this node as it has free slots (node.slots, else
+	SLOTS_PER_NODE), priority lane first, skipping accounts at their concurrency cap or
+	over today's byte quota. The priority lane also gets the node's reserved workers'
+	slots (lanes.RESERVED_WORKERS), which routine items never fill. Commits.
+	"""
+	now = int(time.time())
+	await db.execute("BEGIN IMMEDIATE")
+	try:
+		cur = await db.execute(
+			"""
+			SELECT COUNT(*), TOTAL(lane != 'priority') FROM work_queue
+			WHERE state = 'running' AND node IS ? AND started_at >= ?
+			""",
+			(node, now - RUNNING_TTL),
+		)
+		running_here, running_routine = await cur.fetchone()
+		cur = await db.execute("SELECT slots FROM node WHERE name IS ?", (node,))
+		row = await cur.fetchone()
+		slots = row[0] if row and row[0] else SLOTS_PER_NODE
+		free = slots + lanes.RESERVED_WORKERS - running_here
+		if free <= 0:
+			await db.rollback()
+			return []
+
+		cur = await db.execute(
+			"""
+			SELECT account, COUNT(*) FROM work_queue
+			WHERE state = 'running' AND started_at >= ? GROUP BY account
+			""",
+			(now - RUNNING_TTL,),
+		)
+		running = dict(await cur.fetchall())
+		cur = await db.execute("SELECT owner, bytes FROM user_usage WHERE day = ?", (today(),))
+		used = dict(await cur.fetchall())
+
+		claimed = []
+		shares: dict[str, dict] = {}
+		for lane in LANES:
+			# Routine items stay off the reserved slots
+			limit = free if lane == "priority" else min(free, len(claimed) + slots - int(running_routine))
+			cur = await db.execute(
+				"""
+				SELECT id, account, owners, playlist_id, node, lane, payload, cost FROM work_queue
+				WHERE state = 'queued' AND node IS ? AND lane = ? AND (not_before IS NULL OR not_before <= ?)
+				ORDER BY virtual_finish, id
+				""",
+				(node, lane, now),
+			)
+			for row in await cur.fetchall():
+				if len(claimed) >= limit:
+					break
+				account = row[1]
+				if account not in shares:
+					shares[account] = await _share(db, account)
+				share = shares[account]
+				if share["max_concurrent"] is not None and running.get(account, 0) >= share["max_concurrent"]:
+					continue
+				if share["daily_quota_bytes"] is not None and used.get(account, 0) >= share["daily_quota_bytes"]:
+					continue
+				running[account] = running.get(account, 0) + 1
+				claimed.append(dict(zip(("id", "account", "owners", "playlist_id", "node", "lane", "payload", "cost"), row)))
+
+		await db.executemany(
+			"UPDATE work_queue SET state = 'running', started_at = ? WHERE id = ?",
+			[(now, item["id"]) for item in claimed],
+		)
+		await db.commit()
+	except Exception:
+		await db.rollback()
+		raise
+
+	for item in claimed:
+		item["owners"] = json.loads(item["owners"])
+		item["payload"] = json.loads(item["payload"])
+	return claimed
+
+
+async def next_wakeup(db: aiosqlite.Connection, node: str | None) -> int | None:
+	"""
+	When claim could next find work for this node that it cannot find now: the earliest
+	future not_before of a queued item, or the next UTC midnight if a queued item's account
+	is over today's quota. None if neither applies.
+	"""
+	now = int(time.time())
+	cur = await db.execute(
+		"SELECT MIN(not_before) FROM work_queue WHERE state = 'queued' AND node IS ? AND not_before > ?",
+		(node, now),
+	)
+	wakeup = (await cur.fetchone())[0]
+	cur = await db.execute(
+		"""
+		SELECT 1 FROM work_queue w
+		JOIN user u ON u.name = w.account
+		LEFT JOIN user_usage uu ON uu.owner = w.account AND uu.day = ?
+		WHERE w.state = 'queued' AND w.node IS ? AND u.daily_quota_bytes IS NOT NULL
+		AND COALESCE(uu.bytes, 0) >= u.daily_quota_bytes
+		LIMIT 1
+		""",
+		(today(), node),
+	)
+	if await cur.fetchone():
+		midnight = (now // 86400 + 1) * 86400
+		wakeup = min(wakeup, midnight) if wakeup else midnight
+	return wakeup
+
+
+async def requeue(db: aiosqlite.Connection, work_id: int):
+	"""
+	Put a claimed item back, e.g. when sending it to the broker failed. Commits.
+	"""
+	await db.execute("UPDATE work_queue SET state = 'queued', started_at = NULL WHERE id = ?", (work_id,))
+	await db.commit()
+
+
+async def finish(db: aiosqlite.Connection, work_id: int, nbytes: int) -> str | None:
+	"""
+	Mark an item done, charge its bytes to the owners' daily usage (split evenly) and prune
+	old finished items. Returns the item's node so the caller can dispatch there. Commits.
+	"""
+	now = int(time.time())
+	cur = await db.execute("SELECT owners, node FROM work_queue WHERE id = ?", (work_id,))
+	row = await cur.fetchone()
+	if not row:
+		return None
+	owners = json.loads(row[0])
+	await db.execute(
+		"UPDATE work_queue SET state = 'done', finished_at = ?, bytes = ? WHERE id = ?",
+		(now, nbytes, work_id),
+	)
+	if nbytes:
+		share = nbytes // len(owners)
+		await db.executemany(
+			"""
+			INSERT INTO user_usage (owner, day, bytes) VALUES (?, ?, ?)
+			ON CONFLICT(owner, day) DO UPDATE SET bytes = bytes + excluded.bytes
+			""",
+			[(owner, today(), share) for owner in owners],
+		)
+	await db.execute("DELETE FROM work_queue WHERE state = 'done' AND finished_at < ?", (now - DONE_RETENTION,))
+	await db.commit()
+	return row[1]
+
+
+async def queue_status(db: aiosqlite.Connection) -> list[dict]:
+	"""
+	Per-user queue state: share settings, today's usage, queued work per lane and running items.
+	"""
+	now = int(time.time())
+	cur = await db.execute(
+		"""
+		SELECT u.name, u.share_weight, u.max_concurrent, u.daily_quota_bytes,
+			COALESCE(uu.bytes, 0),
+			(SELECT COUNT(*) FROM work_queue w WHERE w.account = u.name AND w.state = 'queued' AND w.lane = 'priority'),
+			(SELECT COUNT(*) FROM work_queue w WHERE w.account = u.name AND w.state = 'queued' AND w.lane = 'routine'),
+			(SELECT TOTAL(cost) FROM work_queue w WHERE w.account = u.name AND w.state = 'queued'),
+			(SELECT COUNT(*) FROM work_queue w WHERE w.account = u.name AND w.state = 'running' AND w.started_at >= ?),
+			(SELECT MIN(virtual_finish) FROM work_queue w WHERE w.account = u.name AND w.state = 'queued')
+		FROM user u
+		LEFT JOIN user_usage uu ON uu.owner = u.name AND uu.day = ?
+		WHERE u.active = 1
+		ORDER BY u.name
+		""",
+		(now - RUNNING_TTL, today()),
+	)
+	keys = (
+		"owner", "weight", "max_concurrent", "daily_quota_bytes", "used_today_bytes",
+		"queued_priority", "queued_routine", "queued_bytes", "running", "next_virtual_finish",
+	)
+	return [dict(zip(keys, row)) for row in await cur.fetchall()]
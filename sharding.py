@@ -0,0 +1,174 @@
+import bisect
+import hashlib
+import logging
+import time
+
+import aiosqlite
+
+logger = logging.getLogger("dev")
+
+# Points per node on the ring; more points give a more even spread
+VIRTUAL_NODES = 64
+DEFAULT_QUEUE = "celery"
+
+NODE_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS node (
+		name TEXT PRIMARY KEY,
+		data_root TEXT NOT NULL,
+		rsync_target TEXT,
+		active INTEGER NOT NULL DEFAULT 1,
+		last_seen INTEGER NOT NULL
+	)
+	""",
+)
+
+# node.slots: sync slots set by the node's autoscaler (NULL: scheduler.SLOTS_PER_NODE)
+# node.workers: worker pool sizes the autoscaler last reported, as JSON
+NODE_CAPACITY_COLUMNS = (
+	("slots", "INTEGER"),
+	("workers", "TEXT"),
+)
+
+# playlist.node: node currently holding the files
+# playlist.node_override: admin-pinned node, takes precedence over the ring
+# playlist.node_target: node a migration is moving the files to
+PLAYLIST_NODE_COLUMNS = (
+	("node", "TEXT"),
+	("node_override", "TEXT"),
+	("node_target", "TEXT"),
+)
+
+
+async def init_nodes(db: aiosqlite.Connection):
+	"""
+	Create the node registry if missing. Does not commit.
+	"""
+	for statement in NODE_SCHEMA:
+		await db.execute(statement)
+
+
+def node_queue(name: str | None) -> str:
+	"""
+	Queue consumed only by the given node's workers; the default queue if there is no node.
+	"""
+	return f"node.{name}" if name else DEFAULT_QUEUE
+
+
+def _hash(key: str) -> int:
+	return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+	"""
+	Consistent hash ring over node names. Adding or removing a node only moves
+	the keys that land on its points.
+	"""
+
+	def __init__(self, nodes: list[str], virtual_nodes: int = VIRTUAL_NODES):
+		self.nodes = sorted(set(nodes))
+		points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+		self._keys = [point for point, _ in points]
+		self._nodes = [node for _, node in points]
+
+	def node_for(self, key: str) -> str | None:
+		if not self._keys:
+			return None
+		index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+		return self._nodes[index]
+
+
+def desired_node(ring: HashRing, playlist_id: str, override: str | None) -> str | None:
+	"""
+	Node a playlist should live on: the stored override if it names a ring member, else the ring's choice.
+	Playlists are keyed by playlist_id so every owner of the same playlist lands on the same node.
+	"""
+	if override and override in ring.nodes:
+		return override
+	return ring.node_for(playlist_id)
+
+
+async def register_node(db: aiosqlite.Connection, name: str, data_root: str, rsync_target: str | None = None):
+	"""
+	Upsert this node as active. Called when a worker comes up.
+	"""
+	await db.execute(
+		"""
+		INSERT INTO node (name, data_root, rsync_target, active, last_seen) VALUES (?, ?, ?, 1, ?)
+		ON CONFLICT(name) DO UPDATE SET
+			data_root = excluded.data_root,
+			rsync_target = excluded.rsync_target,
+			active = 1,
+			last_seen = excluded.last_seen
+		""",
+		(name, data_root, rsync_target, int(time.time())),
+	)
+	await db.commit()
+
+
+async def set_node_active(db: aiosqlite.Connection, name: str, active: bool) -> bool:
+	cur = await db.execute("UPDATE node SET active = ? WHERE name = ?", (int(active), name))
+	await db.commit()
+	return cur.rowcount > 0
+
+
+async def load_ring(db: aiosqlite.Connection) -> tuple[HashRing, dict[str, dict]]:
+	"""
+	Ring over the active nodes, plus every known node by name (for data roots and rsync targets).
+	"""
+	cur = await db.execute("SELECT name, data_root, rsync_target, active, last_seen FROM node")
+	nodes = {row[0]: dict(zip(("name", "data_root", "rsync_target", "active", "last_seen"), row)) for row in await cur.fetchall()}
+	ring = HashRing([name for name, node in nodes.items() if node["active"]])
+	return ring, nodes
+
+
+async def place_unassigned(db: aiosqlite.Connection) -> int:
+	"""
+	Give playlists without a node their desired node. Nothing has to move for them. Does not commit.
+	"""
+	ring, _ = await load_ring(db)
+	cur = await db.execute(
+		"""
+		SELECT playlist_id, MAX(node_override), MAX(node) FROM playlist
+		GROUP BY playlist_id
+		HAVING SUM(node IS NULL) > 0
+		"""
+	)
+	placed = 0
+	for playlist_id, override, existing in await cur.fetchall():
+		# Another owner's row already places this playlist; keep the files together
+		node = existing or desired_node(ring, playlist_id, override)
+		if node is None:
+			continue
+		await db.execute("UPDATE playlist SET node = ? WHERE playlist_id = ? AND node IS NULL", (node, playlist_id))
+		placed += 1
+	return placed
+
+
+async def plan_rebalance(db: aiosqlite.Connection) -> list[dict]:
+	"""
+	Moves needed to bring every active playlist onto its desired node.
+	Playlists already being migrated are left alone.
+	"""
+	await place_unassigned(db)
+	await db.commit()
+	ring, _ = await load_ring(db)
+	cur = await db.execute(
+		"""
+		SELECT playlist_id, MAX(node), MAX(node_override), MAX(node_target), GROUP_CONCAT(owner, char(31))
+		FROM playlist WHERE active = 1
+		GROUP BY playlist_id
+		"""
+	)
+	moves = []
+	for playlist_id, node, override, target, owners in await cur.fetchall():
+		desired = desired_node(ring, playlist_id, override)
+		if desired is None or target is not None or node is None or node == desired:
+			continue
+		moves.append({
+			"playlist_id": playlist_id,
+			"owners": owners.split(chr(31)),
+			"source": node,
+			"target": desired,
+		})
+	return moves
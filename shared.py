@@ -0,0 +1,146 @@
+import fcntl
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from yt_dlp.utils import locked_file
+
+from helpers import policy_key
+
+logger = logging.getLogger("dev")
+
+# Canonical copies live in {root}/_shared/{playlist_id}/{policy_key}/; owner folders
+# {root}/{owner}/{playlist_id}/ are views made of links to them
+SHARED_DIR = "_shared"
+ARCHIVE_NAME = "archive.txt"
+# Files yt-dlp is still writing; never linked into views
+TRANSIENT_SUFFIXES = (".part", ".ytdl", ".temp", ".tmp")
+# linux/fs.h FICLONE: share extents with the source (btrfs, xfs) instead of copying
+FICLONE = 0x40049409
+
+
+def shared_folder(root: Path, playlist_id: str, policy: dict | str | None) -> Path:
+	return Path(root) / SHARED_DIR / playlist_id / policy_key(policy)
+
+
+def view_folder(root: Path, owner: str, playlist_id: str) -> Path:
+	return Path(root) / owner / playlist_id
+
+
+def is_mirrored(path: Path) -> bool:
+	"""
+	Whether a file in a canonical folder belongs in the owner views.
+	"""
+	name = path.name
+	return (
+		path.is_file()
+		and name != ARCHIVE_NAME
+		and not name.startswith(".")
+		and not name.endswith(TRANSIENT_SUFFIXES)
+		and ".part-Frag" not in name
+	)
+
+
+def link_file(src: Path, dst: Path) -> str:
+	"""
+	Make dst the same file as src: hardlink, else reflink, else copy.
+	Replaces dst atomically. Returns the method used, or "exists" if dst already is src.
+	"""
+	try:
+		if os.path.samefile(src, dst):
+			return "exists"
+	except FileNotFoundError:
+		pass
+	tmp = dst.with_name(f".{dst.name}.link")
+	tmp.unlink(missing_ok=True)
+	try:
+		os.link(src, tmp)
+		method = "hardlink"
+	except OSError:
+		# Different filesystem or no hardlink support
+		try:
+			with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+				fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+			shutil.copystat(src, tmp)
+			method = "reflink"
+		except OSError:
+			shutil.copy2(src, tmp)
+			method = "copy"
+	os.replace(tmp, dst)
+	return method
+
+
+def materialize_view(canonical: Path, view: Path) -> dict:
+	"""
+	Make an owner's view mirror the canonical folder: link missing or diverged files, drop ones no longer there.
+	"""
+	view.mkdir(parents=True, exist_ok=True)
+	names = {p.name for p in canonical.iterdir() if is_mirrored(p)} if canonical.exists() else set()
+	linked = 0
+	pruned = 0
+	for name in names:
+		try:
+			if link_file(canonical / name, view / name) != "exists":
+				linked += 1
+		except FileNotFoundError:
+			# Replaced by a postprocessor between listing and linking
+			continue
+	for path in view.iterdir():
+		if path.is_file() and path.name not in names:
+			path.unlink(missing_ok=True)
+			pruned += 1
+	return {"linked": linked, "pruned": pruned}
+
+
+def adopt_legacy_views(canonical: Path, views: list[Path]) -> int:
+	"""
+	Fold per-owner folders from before shared playlists into the canonical folder.
+	Their files are linked in (not redownloaded) and their archive lines merged; a view
+	without an archive.txt has already been adopted. Returns the number of files adopted.
+	"""
+	canonical.mkdir(parents=True, exist_ok=True)
+	archive_file = canonical / ARCHIVE_NAME
+	adopted = 0
+	for view in views:
+		legacy_archive = view / ARCHIVE_NAME
+		if not legacy_archive.exists():
+			continue
+		for path in view.iterdir():
+			if is_mirrored(path) and not (canonical / path.name).exists():
+				link_file(path, canonical / path.name)
+				adopted += 1
+		with locked_file(archive_file, "a", encoding="utf-8") as f:
+			known = set(archive_file.read_text(encoding="utf-8").splitlines())
+			for line in legacy_archive.read_text(encoding="utf-8").splitlines():
+				if line.strip() and line not in known:
+					f.write(line + "\n")
+					known.add(line)
+		legacy_archive.unlink()
+		logger.info("Adopted legacy folder %s into %s", view, canonical)
+	return adopted
+
+
+def referenced_folders(rows: list[tuple[str, str | None]]) -> set[tuple[str, str]]:
+	"""
+	(playlist_id, policy_key) pairs still referenced by active (playlist_id, policy) rows.
+	"""
+	return {(playlist_id, policy_key(policy)) for playlist_id, policy in rows}
+
+
+def remove_unreferenced(root: Path, referenced: set[tuple[str, str]]) -> int:
+	"""
+	Delete canonical folders no active owner references. Returns the number removed.
+	"""
+	removed = 0
+	base = Path(root) / SHARED_DIR
+	if not base.exists():
+		return 0
+	for folder in base.glob("*/*"):
+		if folder.is_dir() and (folder.parent.name, folder.name) not in referenced:
+			shutil.rmtree(folder, ignore_errors=True)
+			removed += 1
+	for playlist_dir in base.iterdir():
+		if playlist_dir.is_dir() and not any(playlist_dir.iterdir()):
+			playlist_dir.rmdir()
+	return removed
@@ -0,0 +1,190 @@
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+from yt_dlp.utils import locked_file
+
+import shared
+
+logger = logging.getLogger("dev")
+
+# Fast local directory (SSD/tmpfs) downloads and transcodes run in; unset downloads straight into the library
+STAGING_PATH = os.getenv("YTDL_STAGING_PATH")
+# Bytes a node keeps in staging (in-flight estimates plus finished, uncommitted files)
+STAGING_MAX_BYTES = int(os.getenv("YTDL_STAGING_MAX_BYTES", str(16 * 1024**3)))
+# Finished items moved into the library together
+COMMIT_BATCH = int(os.getenv("YTDL_STAGING_COMMIT_BATCH", "8"))
+# file: fsync every file and the folder after each move; batch: fsync every file, the folder
+# once per batch; off: leave it to the kernel
+FSYNC_POLICY = os.getenv("YTDL_STAGING_FSYNC", "batch")
+FSYNC_POLICIES = ("file", "batch", "off")
+
+# Large sequential writes for the copy onto the library disk
+COPY_CHUNK = 16 * 1024**2
+# Suffix of a copy into the library that has not been renamed into place yet; the name
+# also carries the writer's pid, so cleanup can tell live copies from abandoned ones
+INCOMING_SUFFIX = ".staging"
+
+
+def fsync_dir(folder: Path):
+	fd = os.open(folder, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def move_file(source: Path, target: Path, fsync: bool = True, sync_dir: bool = True) -> Path:
+	"""
+	Move a file into the library atomically: a rename on the same filesystem, otherwise
+	a sequential copy to a hidden temporary name next to the target, then a rename.
+	With fsync the data is on disk before the rename, and with sync_dir as well the
+	rename itself is made durable (callers fsyncing the folder once per batch pass False).
+	"""
+	if os.stat(source).st_dev == os.stat(target.parent).st_dev:
+		if fsync:
+			with open(source, "rb") as f:
+				os.fsync(f.fileno())
+		os.replace(source, target)
+	else:
+		incoming = target.with_name(f".{target.name}.{os.getpid()}{INCOMING_SUFFIX}")
+		try:
+			with open(source, "rb") as src, open(incoming, "wb") as dst:
+				shutil.copyfileobj(src, dst, COPY_CHUNK)
+				if fsync:
+					dst.flush()
+					os.fsync(dst.fileno())
+			os.replace(incoming, target)
+		except BaseException:
+			incoming.unlink(missing_ok=True)
+			raise
+		source.unlink()
+	if fsync and sync_dir:
+		fsync_dir(target.parent)
+	return target
+
+
+def _pid_alive(pid: int) -> bool:
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+
+def clean_stale(staging_root: Path, node: str, data_root: Path) -> dict:
+	"""
+	Remove what crashed or killed workers left behind: run folders under this node's
+	staging directory whose process is gone, and half-copied files in the shared folders
+	whose writer is gone. Other workers of the same node may be running while this does.
+	"""
+	removed_runs = 0
+	node_folder = Path(staging_root) / node
+	if node_folder.is_dir():
+		for run in node_folder.iterdir():
+			pid = run.name.split("-", 1)[0]
+			if pid.isdigit() and int(pid) != os.getpid() and _pid_alive(int(pid)):
+				continue
+			shutil.rmtree(run, ignore_errors=True)
+			removed_runs += 1
+
+	removed_incoming = 0
+	for path in (Path(data_root) / shared.SHARED_DIR).glob(f"*/*/.*{INCOMING_SUFFIX}"):
+		pid = path.name[:-len(INCOMING_SUFFIX)].rpartition(".")[2]
+		if pid.isdigit() and int(pid) != os.getpid() and _pid_alive(int(pid)):
+			continue
+		path.unlink(missing_ok=True)
+		removed_incoming += 1
+	return {"runs": removed_runs, "incoming": removed_incoming}
+
+
+class StagingArea:
+	"""
+	One sync run's folder in the staging directory.
+
+	yt-dlp writes fragments, .part files and ffmpeg output here; finished files wait in
+	`pending` until a batch is committed, which moves them into the playlist folder one
+	after another and only then appends them to its archive. Space is accounted from the
+	size estimates of running items plus the real size of pending ones.
+	"""
+
+	def __init__(
+		self,
+		staging_root: Path,
+		node: str,
+		playlist_folder: Path,
+		max_bytes: int = STAGING_MAX_BYTES,
+		batch_size: int = COMMIT_BATCH,
+		fsync: str = FSYNC_POLICY,
+	):
+		if fsync not in FSYNC_POLICIES:
+			raise ValueError(f"Unknown fsync policy: {fsync}")
+		# Named after the process so a restarted worker can tell its dead runs from live ones
+		self.folder = Path(staging_root) / node / f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+		self.folder.mkdir(parents=True)
+		self.playlist_folder = Path(playlist_folder)
+		self.archive_file = self.playlist_folder / shared.ARCHIVE_NAME
+		self.max_bytes = max_bytes
+		self.batch_size = max(1, batch_size)
+		self.fsync = fsync
+		self.reserved: dict[str, int] = {}
+		self.pending: list[tuple[str, dict]] = []
+
+	def used(self) -> int:
+		return sum(self.reserved.values()) + sum(record.get("file_size") or 0 for _, record in self.pending)
+
+	def fits(self, nbytes: int) -> bool:
+		# An item larger than the whole cap still runs, alone
+		return (not self.reserved and not self.pending) or self.used() + nbytes <= self.max_bytes
+
+	def reserve(self, video_id: str, nbytes: int):
+		self.reserved[video_id] = nbytes
+
+	def release(self, video_id: str):
+		self.reserved.pop(video_id, None)
+
+	def add(self, video_id: str, record: dict) -> bool:
+		"""
+		Queue a finished download for the next commit. Returns True once a batch is full.
+		"""
+		self.release(video_id)
+		self.pending.append((video_id, record))
+		return len(self.pending) >= self.batch_size
+
+	def commit(self) -> list[tuple[str, dict]]:
+		"""
+		Move the pending files into the playlist folder and archive them. Returns the
+		(video_id, record) pairs committed, with file_path pointing into the library.
+		Items that fail to move stay out of the archive, so the next scan fetches them again.
+		"""
+		committed = []
+		for video_id, record in self.pending:
+			source = Path(record["file_path"])
+			target = self.playlist_folder / source.name
+			try:
+				move_file(source, target, fsync=self.fsync != "off", sync_dir=self.fsync == "file")
+			except OSError:
+				logger.exception("Failed to commit %s to %s", source, target)
+				continue
+			committed.append((video_id, {**record, "file_path": str(target)}))
+		self.pending = []
+		if not committed:
+			return committed
+
+		if self.fsync == "batch":
+			fsync_dir(self.playlist_folder)
+		# Archived only once the files are in place; a crash before this re-downloads them
+		with locked_file(self.archive_file, "a", encoding="utf-8") as f:
+			f.write("".join(f"youtube {video_id}\n" for video_id, _ in committed))
+			if self.fsync != "off":
+				f.flush()
+				os.fsync(f.fileno())
+		logger.info("Committed %d staged items to %s", len(committed), self.playlist_folder)
+		return committed
+
+	def close(self):
+		shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+import aiosqlite
+
+logger = logging.getLogger("dev")
+
+# Downloads are not admitted if they would leave less than this free on the data volume
+LOW_WATER_BYTES = int(os.getenv("YTDL_LOW_WATER_BYTES", str(20 * 1024**3)))
+# Reservations older than this belong to crashed workers and are dropped
+RESERVATION_TTL = int(os.getenv("YTDL_RESERVATION_TTL", str(6 * 3600)))
+# Seconds to wait before retrying a sync that was deferred for lack of space
+DEFER_SECONDS = int(os.getenv("YTDL_DEFER_SECONDS", "900"))
+
+# Bytes per second of media by policy when the listing has no size hints
+BYTES_PER_SECOND = {
+	"mp3": 192_000 // 8,
+	"passthrough": 160_000 // 8,
+	"video": 2_500_000 // 8,
+}
+# Source and output coexist while ffmpeg runs, plus fragments/.part overhead
+SIZE_FACTOR = 2.0
+UNKNOWN_ITEM_BYTES = 64 * 1024**2
+
+RESERVATION_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS disk_reservation (
+		node TEXT NOT NULL,
+		owner TEXT NOT NULL,
+		playlist_id TEXT NOT NULL,
+		video_id TEXT NOT NULL,
+		bytes INTEGER NOT NULL,
+		created_at INTEGER NOT NULL,
+		PRIMARY KEY (node, owner, playlist_id, video_id)
+	)
+	""",
+)
+
+
+async def init_reservations(db: aiosqlite.Connection):
+	"""
+	Create the disk reservation ledger if missing. Does not commit.
+	"""
+	cur = await db.execute("PRAGMA table_info(disk_reservation)")
+	columns = {row[1] for row in await cur.fetchall()}
+	if columns and "node" not in columns:
+		# Ledgers from before reservations were per node; entries only live as long as a
+		# download, so the table is rebuilt rather than migrated
+		await db.execute("DROP TABLE disk_reservation")
+	for statement in RESERVATION_SCHEMA:
+		await db.execute(statement)
+
+
+def estimate_size(entry: dict, policy: dict | None = None) -> int:
+	"""
+	Estimate the bytes an item needs while downloading from its flat playlist metadata.
+	Uses filesize/filesize_approx when present, otherwise duration times the policy's bitrate.
+	"""
+	policy = policy or {}
+	size = entry.get("filesize") or entry.get("filesize_approx")
+	if not size:
+		if not policy.get("audio_only", True):
+			rate = BYTES_PER_SECOND["video"]
+		else:
+			rate = BYTES_PER_SECOND.get(policy.get("format", "mp3"), BYTES_PER_SECOND["mp3"])
+		duration = entry.get("duration")
+		size = duration * rate if duration else UNKNOWN_ITEM_BYTES
+	return int(size * SIZE_FACTOR)
+
+
+async def reserved_bytes(db: aiosqlite.Connection, node: str) -> int:
+	"""
+	Bytes held by the node's live reservations; other nodes' downloads land on their own disks.
+	"""
+	cur = await db.execute(
+		"SELECT TOTAL(bytes) FROM disk_reservation WHERE node = ? AND created_at >= ?",
+		(node, int(time.time()) - RESERVATION_TTL),
+	)
+	return int((await cur.fetchone())[0])
+
+
+async def reserve(
+	db: aiosqlite.Connection,
+	root: Path,
+	node: str,
+	owner: str,
+	playlist_id: str,
+	video_id: str,
+	nbytes: int,
+) -> bool:
+	"""
+	Atomically reserve space for one item on the node's data volume at root.
+	Returns False if admitting it would cross the low-water mark.
+	"""
+	await db.execute("BEGIN IMMEDIATE")
+	try:
+		await db.execute(
+			"DELETE FROM disk_reservation WHERE node = ? AND created_at < ?",
+			(node, int(time.time()) - RESERVATION_TTL),
+		)
+		free = shutil.disk_usage(root).free
+		if free - await reserved_bytes(db, node) - nbytes < LOW_WATER_BYTES:
+			await db.rollback()
+			return False
+		await db.execute(
+			"""
+			INSERT OR REPLACE INTO disk_reservation (node, owner, playlist_id, video_id, bytes, created_at)
+			VALUES (?, ?, ?, ?, ?, ?)
+			""",
+			(node, owner, playlist_id, video_id, nbytes, int(time.time())),
+		)
+		await db.commit()
+		return True
+	except Exception:
+		await db.rollback()
+		raise
+
+
+def release_statements(node: str, owner: str, playlist_id: str, video_ids: list[str]) -> list[tuple[str, list]]:
+	"""
+	(sql, rows) pair that drops reservations for finished or abandoned items.
+	"""
+	if not video_ids:
+		return []
+	return [(
+		"DELETE FROM disk_reservation WHERE node = ? AND owner = ? AND playlist_id = ? AND video_id = ?",
+		[(node, owner, playlist_id, video_id) for video_id in video_ids],
+	)]
+
+
+async def space_status(db: aiosqlite.Connection, root: Path, node: str) -> dict:
+	"""
+	Used, free and reserved space on the node's data volume, and what is left for new admissions.
+	"""
+	usage = shutil.disk_usage(root)
+	reserved = await reserved_bytes(db, node)
+	cur = await db.execute(
+		"SELECT COUNT(*) FROM disk_reservation WHERE node = ? AND created_at >= ?",
+		(node, int(time.time()) - RESERVATION_TTL),
+	)
+	reservations = (await cur.fetchone())[0]
+	available = usage.free - reserved - LOW_WATER_BYTES
+	return {
+		"node": node,
+		"total": usage.total,
+		"used": usage.used,
+		"free": usage.free,
+		"reserved": reserved,
+		"reservations": reservations,
+		"low_water": LOW_WATER_BYTES,
+		"available": max(available, 0),
+		"admitting": available > 0,
+	}
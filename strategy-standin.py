@@ -0,0 +1,138 @@
+"""
+Exercise the player client strategy against scripted download attempts.
+
+Runs strategy.ClientStrategy with strategy.ScriptedAttempt standing in for yt-dlp, so every
+attempt's error and duration are fixed and the strategy's clock is the fake's own. Checks
+that a client refused with a failover signature is left at once for another client, that
+a missing format moves on to the other format of the same client, that errors about the
+video itself neither fail over nor count against the choice, and that the ranking follows
+the recorded outcomes (a refused client drops, the next one takes over), also after they
+are written to and read back from SQLite.
+Exits non-zero on the first check that does not hold.
+
+Usage: python strategy-standin.py [--clients default,tv,web_safari,android] [--items 20]
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiosqlite
+
+from strategy import ClientStrategy, ScriptedAttempt, init_strategy, load_outcomes
+
+NODE = "standin"
+
+
+def check(condition: bool, message: str):
+	print(f"  {'ok' if condition else 'FAIL'}  {message}")
+	if not condition:
+		sys.exit(1)
+
+
+def run_items(client_strategy: ClientStrategy, attempt: ScriptedAttempt, items: int) -> list[dict]:
+	return [client_strategy.run(attempt, {"quiet": True}) for _ in range(items)]
+
+
+def failover(clients: tuple[str, ...]):
+	print("Client refused with a 403:")
+	first, second = clients[0], clients[1]
+	attempt = ScriptedAttempt(errors={first: "ERROR: unable to download video data: HTTP Error 403: Forbidden"})
+	client_strategy = ClientStrategy(clients=clients, clock=attempt.clock)
+	outcome = client_strategy.run(attempt, {"quiet": True})
+	tried = [(step["client"], step["format"]) for step in outcome["strategy"]]
+	check(outcome["error"] is None, f"item downloaded after {len(tried)} attempts: {tried}")
+	check(tried[0][0] == first and tried[1][0] == second, f"went straight from {first} to {second}")
+	check(
+		attempt.calls[-1] == tried[-1] and len(attempt.calls) == len(tried),
+		"every attempt reached the fake once",
+	)
+	check(
+		outcome["info"]["format"] == client_strategy.formats[tried[-1][1]],
+		"the successful attempt got the choice's format selector",
+	)
+
+
+def format_failover(clients: tuple[str, ...]):
+	print("Format not available:")
+	attempt = ScriptedAttempt(errors={(clients[0], "direct"): "ERROR: Requested format is not available"})
+	client_strategy = ClientStrategy(clients=clients, clock=attempt.clock)
+	outcome = client_strategy.run(attempt, {"quiet": True})
+	tried = [(step["client"], step["format"]) for step in outcome["strategy"]]
+	check(tried == [(clients[0], "direct"), (clients[0], "hls")], f"kept the client, changed the format: {tried}")
+
+
+def item_errors(clients: tuple[str, ...]):
+	print("Video unavailable:")
+	attempt = ScriptedAttempt(errors={client: "ERROR: Video unavailable" for client in clients})
+	client_strategy = ClientStrategy(clients=clients, clock=attempt.clock)
+	before = client_strategy.ranking()
+	outcome = client_strategy.run(attempt, {"quiet": True})
+	check(len(outcome["strategy"]) == 1, "no failover for an error about the video")
+	check(client_strategy.ranking() == before, "ranking unchanged")
+	check(client_strategy.statements(NODE) == [], "nothing recorded against the choice")
+
+
+def ranking(clients: tuple[str, ...], items: int) -> list[tuple[str, list]]:
+	print("Ranking from outcomes:")
+	blocked, second, third = clients[:3]
+	attempt = ScriptedAttempt(errors={blocked: "ERROR: Sign in to confirm you're not a bot"})
+	# Outcome buckets follow the strategy's clock; start at the real time so they are not pruned on load
+	attempt.now = time.time()
+	client_strategy = ClientStrategy(clients=clients, clock=attempt.clock)
+	check(client_strategy.ranking()[0][0] == blocked, f"{blocked} is tried first before any outcome")
+	outcomes = run_items(client_strategy, attempt, items)
+	check(all(outcome["error"] is None for outcome in outcomes), f"all {items} items downloaded")
+	ranked = client_strategy.ranking()
+	check(ranked[-1][0] == blocked and ranked[-2][0] == blocked, f"{blocked} dropped to the bottom: {ranked}")
+	first_attempts = [outcome["strategy"][0]["client"] for outcome in outcomes]
+	check(first_attempts.count(blocked) < items / 2, f"{blocked} tried first {first_attempts.count(blocked)} of {items} times")
+
+	check(ranked[0][0] == second, f"{second} took over")
+
+	# The client that took over starts being refused as well
+	attempt.errors[second] = "ERROR: unable to download video data: HTTP Error 403: Forbidden"
+	outcomes = run_items(client_strategy, attempt, items)
+	check(all(outcome["error"] is None for outcome in outcomes), f"all {items} items downloaded")
+	check(client_strategy.ranking()[0][0] == third, f"{third} ranks first once {second} is refused")
+	for item in client_strategy.report()[:3]:
+		print(f"       {item['client']:>12}/{item['format']:<6} score {item['score']:.3f} latency {item['latency']}")
+	return client_strategy.statements(NODE)
+
+
+async def persisted(clients: tuple[str, ...], statements: list[tuple[str, list]]):
+	print("Ranking read back from SQLite:")
+	with tempfile.TemporaryDirectory(prefix="ytdl-strategy-") as tmp:
+		async with aiosqlite.connect(Path(tmp) / "database.db") as db:
+			await init_strategy(db)
+			for sql, rows in statements:
+				await db.executemany(sql, rows)
+			await db.commit()
+			outcomes = await load_outcomes(db, NODE)
+	check(bool(outcomes), f"{len(outcomes)} outcome rows stored")
+	client_strategy = ClientStrategy(clients=clients, outcomes=outcomes)
+	ranked = client_strategy.ranking()
+	check(ranked[-1][0] == clients[0], f"a new run starts with {clients[0]} still ranked down")
+	check(ranked[0][0] == clients[2], f"and {clients[2]} first")
+
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--clients", default="default,tv,web_safari,android")
+	parser.add_argument("--items", type=int, default=20)
+	args = parser.parse_args()
+	clients = tuple(client.strip() for client in args.clients.split(",") if client.strip())
+	if len(clients) < 3:
+		parser.error("need at least three clients")
+
+	failover(clients)
+	format_failover(clients)
+	item_errors(clients)
+	asyncio.run(persisted(clients, ranking(clients, args.items)))
+	print("All checks passed")
+
+
+if __name__ == "__main__":
+	main()
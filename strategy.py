@@ -0,0 +1,346 @@
+import logging
+import os
+import threading
+import time
+
+import aiosqlite
+
+logger = logging.getLogger("dev")
+
+# YouTube player clients tried, in this order until their track record says otherwise
+CLIENTS = tuple(c.strip() for c in os.getenv("YTDL_PLAYER_CLIENTS", "default,tv,web_safari,android").split(",") if c.strip())
+# Attempts per item across client/format choices before it is reported as failed
+MAX_ATTEMPTS = int(os.getenv("YTDL_STRATEGY_MAX_ATTEMPTS", "3"))
+# Outcomes lose half their weight every this many seconds, so a client that recovers is tried again
+HALF_LIFE = float(os.getenv("YTDL_STRATEGY_HALF_LIFE", str(6 * 3600)))
+# Hourly outcome buckets older than this are dropped
+HISTORY = 7 * 86400
+BUCKET_SECONDS = 3600
+
+# Format choices per policy kind; "direct" prefers non-HLS and "hls" prefers HLS. Both fall
+# back to anything, so an HLS-only video costs no extra extraction on the direct arm
+FORMATS = {
+	"audio": {
+		"direct": "bestaudio[protocol!=m3u8_native][protocol!=m3u8]/bestaudio/best",
+		"hls": "bestaudio[protocol^=m3u8]/bestaudio/best",
+	},
+	"video": {
+		"direct": "bestvideo*[protocol!=m3u8_native][protocol!=m3u8]+bestaudio[protocol!=m3u8_native][protocol!=m3u8]/bestvideo*+bestaudio/best",
+		"hls": "bestvideo*[protocol^=m3u8]+bestaudio/bestvideo*+bestaudio/best",
+	},
+}
+
+# Errors that say this client (or this format) will not work right now: the next attempt
+# moves on at once instead of retrying, and the choice is ranked down
+FAILOVER_SIGNATURES = (
+	("HTTP Error 403", "client"),
+	("confirm you’re not a bot", "client"),
+	("confirm you're not a bot", "client"),
+	("PO Token", "client"),
+	("po_token", "client"),
+	("nsig extraction failed", "client"),
+	("Only images are available", "client"),
+	("Requested format is not available", "format"),
+)
+# Errors about the video itself; no client fixes them and they say nothing about the choice
+ITEM_SIGNATURES = (
+	"Video unavailable",
+	"Private video",
+	"This video has been removed",
+	"This video is not available",
+	"members-only",
+	"Join this channel",
+	"copyright",
+	"has been terminated",
+	"Premieres in",
+	"live event will begin",
+)
+
+# failovers: attempts ended by a failover signature; blocked: those that were about the client
+COUNTERS = ("attempts", "successes", "failovers", "blocked", "seconds")
+
+STRATEGY_SCHEMA = (
+	"""
+	CREATE TABLE IF NOT EXISTS client_outcome (
+		bucket INTEGER NOT NULL,
+		node TEXT NOT NULL,
+		client TEXT NOT NULL,
+		format TEXT NOT NULL,
+		attempts INTEGER NOT NULL DEFAULT 0,
+		successes INTEGER NOT NULL DEFAULT 0,
+		failovers INTEGER NOT NULL DEFAULT 0,
+		blocked INTEGER NOT NULL DEFAULT 0,
+		seconds REAL NOT NULL DEFAULT 0,
+		last_error TEXT,
+		PRIMARY KEY (bucket, node, client, format)
+	)
+	""",
+)
+
+
+async def init_strategy(db: aiosqlite.Connection):
+	"""
+	Create the client/format outcome counters if missing. Does not commit.
+	"""
+	for statement in STRATEGY_SCHEMA:
+		await db.execute(statement)
+
+
+def client_args(client: str) -> list[str]:
+	# android_sdkless is part of yt-dlp's default set and commonly answers with 403s
+	return ["default", "-android_sdkless"] if client == "default" else [client]
+
+
+def extractor_args(client: str | None = None) -> dict:
+	"""
+	yt-dlp extractor_args for one player client (the first configured one by default).
+	"""
+	return {"youtube": {"player_client": client_args(client or CLIENTS[0])}}
+
+
+def failover_kind(error: str | None) -> str | None:
+	"""
+	"client" or "format" if the error is one a different choice may avoid, else None.
+	"""
+	if not error:
+		return None
+	for signature, kind in FAILOVER_SIGNATURES:
+		if signature in error:
+			return kind
+	return None
+
+
+def is_item_error(error: str | None) -> bool:
+	return bool(error) and any(signature in error for signature in ITEM_SIGNATURES)
+
+
+async def load_outcomes(db: aiosqlite.Connection, node: str | None = None) -> list[dict]:
+	"""
+	Outcome buckets within HISTORY, for one node or all. Drops older buckets. Commits.
+	"""
+	now = int(time.time())
+	await db.execute("DELETE FROM client_outcome WHERE bucket < ?", (now - HISTORY,))
+	await db.commit()
+	columns = ("bucket", "node", "client", "format", *COUNTERS, "last_error")
+	if node is None:
+		cur = await db.execute(f"SELECT {', '.join(columns)} FROM client_outcome ORDER BY bucket")
+	else:
+		cur = await db.execute(f"SELECT {', '.join(columns)} FROM client_outcome WHERE node = ? ORDER BY bucket", (node,))
+	return [dict(zip(columns, row)) for row in await cur.fetchall()]
+
+
+class ClientStrategy:
+	"""
+	Orders (player client, format) choices by their recent success on this node.
+
+	Each choice keeps decayed attempt/success counts and the seconds its successful
+	attempts took, seeded from the stored hourly buckets and updated live as the run's
+	downloads finish. The score is the smoothed success rate (unknown choices start at
+	one half), capped by the client's rate over all its formats when the client itself
+	is being refused; choices with the same rounded score go by latency, then by
+	configured order. `run` tries an item with the best choice and, on a failover signature, moves
+	straight to the next choice that uses a different client (or format).
+	"""
+
+	def __init__(
+		self,
+		policy: dict | None = None,
+		clients: tuple[str, ...] = CLIENTS,
+		outcomes: list[dict] | None = None,
+		max_attempts: int = MAX_ATTEMPTS,
+		half_life: float = HALF_LIFE,
+		clock=time.time,
+	):
+		kind = "audio" if (policy or {}).get("audio_only", True) else "video"
+		self.formats = FORMATS[kind]
+		self.arms = [(client, fmt) for client in clients for fmt in self.formats]
+		self.max_attempts = max(1, max_attempts)
+		self.half_life = half_life
+		self._clock = clock
+		self._lock = threading.Lock()
+		self._stats = {arm: dict.fromkeys(COUNTERS, 0.0) for arm in self.arms}
+		self._last_error: dict[tuple[str, str], str] = {}
+		# This run's outcomes, added to the current bucket by statements()
+		self._deltas: dict[tuple[str, str], dict] = {}
+		now = self._clock()
+		for row in outcomes or []:
+			arm = (row["client"], row["format"])
+			if arm not in self._stats:
+				continue
+			weight = 0.5 ** (max(0.0, now - row["bucket"] - BUCKET_SECONDS) / self.half_life)
+			for key in COUNTERS:
+				self._stats[arm][key] += row[key] * weight
+			if row["last_error"]:
+				self._last_error[arm] = row["last_error"]
+
+	def score(self, arm: tuple[str, str]) -> float:
+		stats = self._stats[arm]
+		siblings = [self._stats[other] for other in self.arms if other[0] == arm[0]]
+		successes = sum(s["successes"] for s in siblings)
+		blocked = sum(s["blocked"] for s in siblings)
+		return min(
+			(stats["successes"] + 1) / (stats["attempts"] + 2),
+			(successes + 1) / (successes + blocked + 2),
+		)
+
+	def latency(self, arm: tuple[str, str]) -> float | None:
+		stats = self._stats[arm]
+		return stats["seconds"] / stats["successes"] if stats["successes"] > 0.5 else None
+
+	def ranking(self) -> list[tuple[str, str]]:
+		with self._lock:
+			order = {arm: i for i, arm in enumerate(self.arms)}
+			return sorted(self.arms, key=lambda arm: (
+				-round(self.score(arm), 1),
+				self.latency(arm) if self.latency(arm) is not None else float("inf"),
+				order[arm],
+			))
+
+	def report(self) -> list[dict]:
+		"""
+		The current ranking with the figures behind it.
+		"""
+		items = []
+		for arm in self.ranking():
+			stats = self._stats[arm]
+			latency = self.latency(arm)
+			items.append({
+				"client": arm[0],
+				"format": arm[1],
+				"score": round(self.score(arm), 3),
+				"attempts": round(stats["attempts"], 2),
+				"successes": round(stats["successes"], 2),
+				"failovers": round(stats["failovers"], 2),
+				"blocked": round(stats["blocked"], 2),
+				"latency": round(latency, 2) if latency is not None else None,
+				"last_error": self._last_error.get(arm),
+			})
+		return items
+
+	def apply(self, base_opts: dict, arm: tuple[str, str]) -> dict:
+		"""
+		yt-dlp options with the choice's player client and format selector.
+		"""
+		client, fmt = arm
+		extractor = dict(base_opts.get("extractor_args") or {})
+		extractor["youtube"] = {**extractor.get("youtube", {}), "player_client": client_args(client)}
+		return {**base_opts, "extractor_args": extractor, "format": self.formats[fmt]}
+
+	def observe(self, arm: tuple[str, str], error: str | None, seconds: float):
+		"""
+		Record one attempt. Errors about the video itself are not held against the choice.
+		"""
+		if is_item_error(error):
+			return
+		kind = failover_kind(error)
+		counts = {
+			"attempts": 1,
+			"successes": 0 if error else 1,
+			"failovers": 1 if kind else 0,
+			"blocked": 1 if kind == "client" else 0,
+			"seconds": 0.0 if error else max(seconds, 0.0),
+		}
+		with self._lock:
+			delta = self._deltas.setdefault(arm, {**dict.fromkeys(COUNTERS, 0), "last_error": None})
+			for key, value in counts.items():
+				self._stats[arm][key] += value
+				delta[key] += value
+			if error:
+				self._last_error[arm] = error
+				delta["last_error"] = error[:500]
+
+	def run(self, attempt, base_opts: dict, info: dict | None = None) -> dict:
+		"""
+		Download one item with `attempt(arm, opts, info)`, failing over between choices.
+		Returns the last attempt's outcome with the choices tried under "strategy".
+		A prefetched info is only offered to the first attempt.
+		"""
+		tried = []
+		skip_clients: set[str] = set()
+		skip_formats: set[str] = set()
+		outcome = None
+		for arm in self.ranking():
+			if len(tried) >= self.max_attempts:
+				break
+			if arm[0] in skip_clients or arm[1] in skip_formats:
+				continue
+			started = self._clock()
+			outcome = attempt(arm, self.apply(base_opts, arm), None if tried else info)
+			error = outcome.get("error")
+			self.observe(arm, error, self._clock() - started)
+			tried.append({"client": arm[0], "format": arm[1], "error": error})
+			kind = failover_kind(error)
+			if kind is None:
+				break
+			logger.info("Player client %s/%s failed (%s), failing over", arm[0], arm[1], kind)
+			if kind == "client":
+				skip_clients.add(arm[0])
+			else:
+				skip_formats.add(arm[1])
+		return {**outcome, "strategy": tried}
+
+	def statements(self, node: str) -> list[tuple[str, list]]:
+		"""
+		(sql, rows) pair that adds this run's outcomes to the node's current hourly bucket.
+		"""
+		with self._lock:
+			deltas, self._deltas = self._deltas, {}
+		if not deltas:
+			return []
+		bucket = int(self._clock()) // BUCKET_SECONDS * BUCKET_SECONDS
+		return [(
+			"""
+			INSERT INTO client_outcome (bucket, node, client, format, attempts, successes, failovers, blocked, seconds, last_error)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			ON CONFLICT(bucket, node, client, format) DO UPDATE SET
+				attempts = attempts + excluded.attempts,
+				successes = successes + excluded.successes,
+				failovers = failovers + excluded.failovers,
+				blocked = blocked + excluded.blocked,
+				seconds = seconds + excluded.seconds,
+				last_error = COALESCE(excluded.last_error, last_error)
+			""",
+			[
+				(bucket, node, client, fmt, *(d[key] for key in COUNTERS), d["last_error"])
+				for (client, fmt), d in deltas.items()
+			],
+		)]
+
+
+class ScriptedAttempt:
+	"""
+	Deterministic stand-in for a download attempt. `errors` maps a client or a
+	(client, format) pair to the error it fails with (missing: success); `seconds` the same
+	way to how long an attempt takes. The attempt advances its own clock by that much, so
+	pass `clock` to the strategy for exact latencies. Every call is kept in `calls`.
+	"""
+
+	def __init__(self, errors: dict | None = None, seconds: dict | None = None, default_seconds: float = 10.0, nbytes: int = 4 * 1024**2):
+		self.errors = errors or {}
+		self.seconds = seconds or {}
+		self.default_seconds = default_seconds
+		self.nbytes = nbytes
+		self.now = 0.0
+		self.calls: list[tuple[str, str]] = []
+
+	def clock(self) -> float:
+		return self.now
+
+	def _lookup(self, table: dict, arm: tuple[str, str], default):
+		return table.get(arm, table.get(arm[0], default))
+
+	def __call__(self, arm: tuple[str, str], opts: dict, info: dict | None) -> dict:
+		self.calls.append(arm)
+		seconds = self._lookup(self.seconds, arm, self.default_seconds)
+		self.now += seconds
+		error = self._lookup(self.errors, arm, None)
+		return {
+			"url": None,
+			"info": None if error else {"id": "scripted", "format": opts["format"]},
+			"cache": "hit" if info is not None else "miss",
+			"bytes": 0 if error else self.nbytes,
+			"seconds": seconds,
+			"postprocess_seconds": 0.0,
+			"error": error,
+			"throttled": False,
+		}
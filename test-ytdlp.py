@@ -1,6 +1,8 @@
 from pathlib import Path
 from yt_dlp import YoutubeDL
 
+import strategy
+
 
 def main() -> None:
     url = "https://www.youtube.com/watch?v=3triLkS0nq4"
@@ -13,12 +15,8 @@ def main() -> None:
         # ✅ use cookies exported via Cookie-Editor (Netscape format)
         "cookiefile": "./cookies.txt",
 
-        # ✅ avoid android_sdkless which commonly causes 403s
-        "extractor_args": {
-            "youtube": {
-                "player_client": ["android", "tv"],
-            }
-        },
+        # ✅ same player client list the server starts with (see strategy.CLIENTS)
+        "extractor_args": strategy.extractor_args(),
 
         # "postprocessors": [
         #     {
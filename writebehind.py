@@ -0,0 +1,183 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+logger = logging.getLogger("dev")
+
+# Flush once this many statements are buffered...
+FLUSH_SIZE = int(os.getenv("YTDL_FLUSH_SIZE", "200"))
+# ...or this many seconds after the oldest buffered write, whichever comes first
+FLUSH_INTERVAL = float(os.getenv("YTDL_FLUSH_INTERVAL", "2.0"))
+# Flushes kept for latency/batch-size percentiles
+STATS_WINDOW = 256
+
+
+def percentile(values: list[float], pct: float) -> float:
+	if not values:
+		return 0.0
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class WriteBehindBuffer:
+	"""
+	Worker-side buffer that batches DB writes into one transaction.
+
+	Writes are queued as (sql, rows) pairs and flushed together on size, on a
+	background timer, on task end and on worker shutdown. flush() returns only
+	once the batch is committed, so callers that flush before acknowledging a
+	task get durable writes. A failed flush puts the batch back in front of
+	anything queued since and re-raises.
+	"""
+
+	def __init__(self, db_path: Path, flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+		self.db_path = Path(db_path)
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self._ops: list[tuple[str, list]] = []
+		self._pending = 0
+		self._oldest: float | None = None
+		self._lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		self._wake = threading.Event()
+		self._stop = threading.Event()
+		self._thread: threading.Thread | None = None
+		self._conn: sqlite3.Connection | None = None
+		self._latencies: deque[float] = deque(maxlen=STATS_WINDOW)
+		self._batches: deque[int] = deque(maxlen=STATS_WINDOW)
+		self.flushes = 0
+		self.flushed_statements = 0
+
+	def execute(self, sql: str, params: tuple | dict = ()):
+		self.executemany(sql, [params])
+
+	def executemany(self, sql: str, rows: list):
+		if not rows:
+			return
+		with self._lock:
+			self._ops.append((sql, list(rows)))
+			self._pending += len(rows)
+			if self._oldest is None:
+				self._oldest = time.monotonic()
+			full = self._pending >= self.flush_size
+		self._ensure_thread()
+		if full:
+			self._wake.set()
+
+	def extend(self, statements: list[tuple[str, list]]):
+		"""
+		Queue several (sql, rows) statements, e.g. from catalog.ingest_statements().
+		"""
+		for sql, rows in statements:
+			self.executemany(sql, rows)
+
+	def flush(self) -> int:
+		"""
+		Commit everything buffered in a single transaction. Returns the number of rows written.
+		"""
+		with self._flush_lock:
+			with self._lock:
+				ops, self._ops = self._ops, []
+				count, self._pending = self._pending, 0
+				self._oldest = None
+			if not ops:
+				return 0
+
+			started = time.perf_counter()
+			try:
+				conn = self._connect()
+				conn.execute("BEGIN IMMEDIATE")
+				try:
+					for sql, rows in ops:
+						conn.executemany(sql, rows)
+					conn.commit()
+				except Exception:
+					conn.rollback()
+					raise
+			except Exception:
+				with self._lock:
+					self._ops = ops + self._ops
+					self._pending += count
+					self._oldest = self._oldest or time.monotonic()
+				logger.exception("Write-behind flush of %d rows failed", count)
+				raise
+
+			latency = time.perf_counter() - started
+			self._latencies.append(latency)
+			self._batches.append(count)
+			self.flushes += 1
+			self.flushed_statements += count
+			logger.debug("Write-behind flushed %d rows in %.1f ms", count, latency * 1000)
+			return count
+
+	def stats(self) -> dict:
+		latencies = list(self._latencies)
+		batches = list(self._batches)
+		return {
+			"flushes": self.flushes,
+			"rows": self.flushed_statements,
+			"pending": self._pending,
+			"batch_p50": percentile(batches, 50),
+			"batch_max": max(batches, default=0),
+			"latency_ms_p50": percentile(latencies, 50) * 1000,
+			"latency_ms_p95": percentile(latencies, 95) * 1000,
+			"latency_ms_max": max(latencies, default=0.0) * 1000,
+		}
+
+	def close(self):
+		"""
+		Stop the background flusher and write out whatever is left.
+		"""
+		self._stop.set()
+		self._wake.set()
+		if self._thread is not None:
+			self._thread.join(timeout=self.flush_interval * 4)
+			self._thread = None
+		self.flush()
+		if self._conn is not None:
+			self._conn.close()
+			self._conn = None
+		logger.info("Write-behind buffer closed: %s", self.stats())
+
+	def _connect(self) -> sqlite3.Connection:
+		if self._conn is None:
+			self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+			# WAL lets the API keep reading while a batch commits
+			self._conn.execute("PRAGMA journal_mode=WAL")
+		return self._conn
+
+	def _ensure_thread(self):
+		if self._thread is not None and self._thread.is_alive():
+			return
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while not self._stop.is_set():
+			with self._lock:
+				oldest = self._oldest
+				full = self._pending >= self.flush_size
+			if oldest is None:
+				timeout = self.flush_interval
+			else:
+				timeout = max(0.0, oldest + self.flush_interval - time.monotonic())
+			if not full and timeout > 0:
+				self._wake.wait(timeout)
+			self._wake.clear()
+			if self._stop.is_set():
+				break
+			with self._lock:
+				due = self._pending >= self.flush_size or (
+					self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval
+				)
+			if due:
+				try:
+					self.flush()
+				except Exception:
+					# Batch was requeued; back off before the next attempt
+					self._stop.wait(self.flush_interval)